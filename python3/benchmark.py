@@ -11,9 +11,16 @@ n_clients = int(sys.argv[1])
 n_reqs = int(sys.argv[2])
 block = sys.argv[3] == "block"
 log_lvl = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+batch_size = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+# server : zerobot.Server, sharded:N : zerobot.ShardedServer avec N shards
+server_kind = sys.argv[6] if len(sys.argv) > 6 else "server"
 logging.basicConfig(level=log_lvl)
 	
-server = zerobot.Server("tcp://*:8000","tcp://*:8001","tcp://*:8002")
+if server_kind.startswith("sharded"):
+	n_shards = int(server_kind.split(":")[1]) if ":" in server_kind else 1
+	server = zerobot.ShardedServer("tcp://*:8000","tcp://*:8001","tcp://*:8002", n_shards=n_shards)
+else:
+	server = zerobot.Server("tcp://*:8000","tcp://*:8001","tcp://*:8002")
 server.start(False)
 time.sleep(0.1)
 
@@ -57,7 +64,7 @@ t.start()
 """
 
 class ClientBenchmark(threading.Thread):
-	def __init__(self, identity, n_reqs, block):
+	def __init__(self, identity, n_reqs, block, batch_size=0):
 		threading.Thread.__init__(self)
 		self.client = zerobot.AsyncClient(identity, "tcp://localhost:8000", "cool")
 		self.client.start(False)
@@ -70,6 +77,7 @@ class ClientBenchmark(threading.Thread):
 		"""
 		self.n_reqs = n_reqs
 		self.block = block
+		self.batch_size = batch_size
 		self.n = 0
 		self.event = threading.Event()
 		self.setDaemon(True)
@@ -78,6 +86,10 @@ class ClientBenchmark(threading.Thread):
 
 		kwargs = {'c':'0'*100,'b':'2'*100,'a':'3'*100}
 		cb = None if self.block else self.cb
+
+		if self.batch_size:
+			self.run_batch()
+			return
 		
 		for i in range(self.n_reqs):
 			"""if i%2:
@@ -97,6 +109,16 @@ class ClientBenchmark(threading.Thread):
 			#for i in range(self.n_reqs): self.client.recv_multipart()
 			while not self.event.is_set(): self.event.wait(1)
 
+	def run_batch(self):
+		cb = None if self.block else self.cb_batch
+		for i in range(0, self.n_reqs, self.batch_size):
+			with self.client.batch(block=self.block, cb_fct=cb) as batch:
+				for j in range(min(self.batch_size, self.n_reqs-i)):
+					batch.ping(42)
+
+		if not self.block:
+			while not self.event.is_set(): self.event.wait(1)
+
 	def close(self):
 		self.client.close()
 		self.event.set()
@@ -105,11 +127,15 @@ class ClientBenchmark(threading.Thread):
 		self.n += 1
 		if self.n == self.n_reqs: self.event.set()
 
-def benchmark(nb_clients, nb_reqs, msg, block):
+	def cb_batch(self, results):
+		self.n += len(results)
+		if self.n == self.n_reqs: self.event.set()
+
+def benchmark(nb_clients, nb_reqs, msg, block, batch_size=0):
 
 	clients = []
 	for i in range(nb_clients):
-		client = ClientBenchmark("remote-%s"%i, nb_reqs, block)
+		client = ClientBenchmark("remote-%s"%i, nb_reqs, block, batch_size)
 		clients.append(client)
 	
 	start = time.time()
@@ -123,10 +149,11 @@ def benchmark(nb_clients, nb_reqs, msg, block):
 	tot_reqs = nb_clients*nb_reqs
 	average = ellapsed/tot_reqs
 	reqs_sec = round(tot_reqs/ellapsed)
-	print('%s clients, %s reqs %s (tot:%sreqs) : %0.2fs, average : %0.2fms, reqs/s : %s'
-		% (nb_clients, nb_reqs, 'block' if block else 'async', tot_reqs, ellapsed, average*1000, reqs_sec))
+	print('%s, %s clients, %s reqs %s%s (tot:%sreqs) : %0.2fs, average : %0.2fms, reqs/s : %s'
+		% (server_kind, nb_clients, nb_reqs, 'block' if block else 'async', ' batch %s'%batch_size if batch_size else '',
+			tot_reqs, ellapsed, average*1000, reqs_sec))
 
 	for i in range(nb_clients):
 		clients[i].close()
 
-benchmark(n_clients, n_reqs, "coucou", block)
+benchmark(n_clients, n_reqs, "coucou", block, batch_size)
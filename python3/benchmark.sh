@@ -1,7 +1,37 @@
-LOG_LVL=$1
+LOG_LVL=${1:-20}
 
 ./benchmark.py 10 10 block $LOG_LVL
 ./benchmark.py 10 1000 block $LOG_LVL
 ./benchmark.py 10 2000 block $LOG_LVL
 ./benchmark.py 10 10 async $LOG_LVL
 ./benchmark.py 10 1000 async $LOG_LVL
+# batch size sweep
+./benchmark.py 10 1000 block $LOG_LVL 1
+./benchmark.py 10 1000 block $LOG_LVL 10
+./benchmark.py 10 1000 block $LOG_LVL 100
+./benchmark.py 10 1000 async $LOG_LVL 10
+./benchmark.py 10 1000 async $LOG_LVL 100
+# Server vs ShardedServer (routage dans les devices + shards)
+./benchmark.py 10 1000 async $LOG_LVL 0 server
+./benchmark.py 10 1000 async $LOG_LVL 0 sharded:1
+./benchmark.py 10 1000 async $LOG_LVL 0 sharded:4
+# sharded broker sweep
+./benchmark_broker.py 8 10000 100
+for n in 1 2 4 8; do ./benchmark_broker.py --shards $n --processes 8 10000 100; done
+# broker mirroring modes
+for m in on off nosub 10; do ./benchmark_broker.py --mirror $m 8 10000 100; done
+# AsyncService scheduler, test/sleep mix
+./benchmark_scheduler.py 4 10 5
+./benchmark_scheduler.py --priority --limit 3 4 10 5
+# cpu-bound methods, thread vs process workers
+./benchmark_pool.py
+# coroutine service vs thread workers, 1000 sleep(1)
+./benchmark_asyncio_service.py 1000
+# generator method, whole response vs stream
+./benchmark_stream.py 50000
+# numpy arrays, attachments vs base64 in json
+./benchmark_attachments.py 1 5 10 50
+# event callbacks, thread per callback vs executor vs inline
+./benchmark_events.py 10000
+# producer-side event batching, off vs 10 vs 100 per batch
+./benchmark_event_batching.py 100000
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Compare :class:`zerobot.AsyncClient` (appels non bloquants + callback) et
+:class:`zerobot.aio.AsyncioClient` : appels/s et nombre maximum de threads
+pendant que *n_reqs* appels ``ping`` sont en vol.
+
+usage : ./benchmark_aio.py n_reqs [async|asyncio]
+"""
+
+import zerobot
+from zerobot.aio import AsyncioClient
+
+import sys
+import time
+import asyncio
+import threading
+import logging
+
+n_reqs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+modes = sys.argv[2:] or ["async", "asyncio"]
+logging.basicConfig(level=30)
+
+server = zerobot.Server("tcp://*:8200","tcp://*:8201","tcp://*:8202","tcp://*:8203","tcp://*:8204")
+server.start(False)
+
+class Cool:
+	def ping(self, num):
+		return num+42
+
+cool = zerobot.Service("cool", "tcp://localhost:8201", Cool())
+cool.start(False)
+time.sleep(0.2)
+
+
+class ThreadCounter(threading.Thread):
+	""" Relève le nombre maximum de threads actifs. """
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.peak = threading.active_count()
+		self.e_stop = threading.Event()
+
+	def run(self):
+		while not self.e_stop.is_set():
+			self.peak = max(self.peak, threading.active_count())
+			time.sleep(0.001)
+
+	def stop(self):
+		self.e_stop.set()
+		self.join()
+		return self.peak
+
+def bench_async():
+	client = zerobot.AsyncClient("bench-async", "tcp://localhost:8200", "cool")
+	client.start(False)
+	time.sleep(0.2)
+	done = threading.Event()
+	count = [0]
+	lock = threading.Lock()
+	def cb(response):
+		with lock:
+			count[0] += 1
+			if count[0] == n_reqs: done.set()
+	counter = ThreadCounter()
+	counter.start()
+	start = time.time()
+	for i in range(n_reqs):
+		client.ping(i, block=False, cb_fct=cb)
+	done.wait()
+	ellapsed = time.time()-start
+	peak = counter.stop()
+	client.close()
+	return ellapsed, peak
+
+def bench_asyncio():
+	async def run():
+		client = AsyncioClient("bench-asyncio", "tcp://localhost:8200", "cool")
+		client.start()
+		await asyncio.sleep(0.2)
+		counter = ThreadCounter()
+		counter.start()
+		start = time.time()
+		await asyncio.gather(*[ client.ping(i) for i in range(n_reqs) ])
+		ellapsed = time.time()-start
+		peak = counter.stop()
+		client.close()
+		return ellapsed, peak
+	return asyncio.run(run())
+
+for mode in modes:
+	ellapsed, peak = bench_async() if mode == "async" else bench_asyncio()
+	print('%-8s %s reqs : %0.2fs, reqs/s : %s, peak threads : %s'
+		% (mode, n_reqs, ellapsed, round(n_reqs/ellapsed), peak))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+*n_reqs* appels simultanés d'une méthode qui attend une seconde, exposée par
+un :class:`zerobot.aio.AsyncioService` (``await asyncio.sleep(1)``) ou par
+un :class:`zerobot.AsyncService` (``time.sleep(1)``, au plus 50 workers).
+Affiche la durée totale et le nombre maximum de threads du processus.
+Chaque mode est lancé dans un processus séparé.
+
+usage : ./benchmark_asyncio_service.py n_reqs [asyncio|async]
+"""
+
+import zerobot
+from zerobot.aio import AsyncioClient, AsyncioService
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import subprocess
+import logging
+
+n_reqs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+modes = sys.argv[2:] or ["asyncio", "async"]
+logging.basicConfig(level=30)
+
+
+class Cool:
+	def sleep(self, t):
+		time.sleep(t)
+		return t
+
+class AsyncCool:
+	async def sleep(self, t):
+		await asyncio.sleep(t)
+		return t
+
+
+class ThreadCounter(threading.Thread):
+	""" Relève le nombre maximum de threads actifs. """
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.peak = threading.active_count()
+		self.e_stop = threading.Event()
+
+	def run(self):
+		while not self.e_stop.is_set():
+			self.peak = max(self.peak, threading.active_count())
+			time.sleep(0.01)
+
+	def stop(self):
+		self.e_stop.set()
+		self.join()
+		return self.peak
+
+def bench(mode):
+	server = zerobot.Server("tcp://*:8600","tcp://*:8601","tcp://*:8602","tcp://*:8603","tcp://*:8604")
+	server.start(False)
+	if mode == "asyncio":
+		service = AsyncioService("cool", "tcp://localhost:8601", AsyncCool())
+		t = threading.Thread(target=asyncio.run, args=(service.run(),))
+		t.daemon = True
+		t.start()
+	else:
+		service = zerobot.AsyncService("cool", "tcp://localhost:8601", Cool(), max_workers=50, dynamic_workers=True)
+		service.start(False)
+	time.sleep(0.2)
+
+	async def run():
+		client = AsyncioClient("bench", "tcp://localhost:8600", "cool")
+		client.start()
+		await asyncio.sleep(0.2)
+		counter = ThreadCounter()
+		counter.start()
+		start = time.time()
+		await asyncio.gather(*[ client.sleep(1) for _ in range(n_reqs) ])
+		ellapsed = time.time()-start
+		peak = counter.stop()
+		client.close()
+		return ellapsed, peak
+	ellapsed, peak = asyncio.run(run())
+	print('%-8s %s sleep(1) : %0.2fs, calls/s : %0.1f, peak threads : %s'
+		% (mode, n_reqs, ellapsed, n_reqs/ellapsed, peak))
+	sys.stdout.flush()
+	os._exit(0)
+
+if __name__ == '__main__':
+	if len(modes) == 1:
+		bench(modes[0])
+	else:
+		for mode in modes:
+			subprocess.call([sys.executable, __file__, str(n_reqs), mode])
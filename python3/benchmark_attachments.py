@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Aller-retour de tableaux numpy de 1 à 50 Mo (float64) entre un client et un
+service qui renvoie le tableau reçu. Les tableaux sont envoyés en pièces
+jointes (frames séparés, sans copie) ou, pour comparer, encodés en base64
+dans le corps json. Affiche la latence moyenne et le débit pour chaque taille.
+Chaque mode est lancé dans un processus séparé.
+
+usage : ./benchmark_attachments.py [options] [sizes_mb...]
+"""
+
+import zerobot
+
+import os
+import sys
+import time
+import base64
+import optparse
+import subprocess
+import logging
+
+import numpy
+
+parser = optparse.OptionParser("usage: %prog [options] [sizes_mb...]")
+parser.add_option("-m", "--mode",
+	action="store", dest="mode", default="both",
+	help="frames, base64 or both")
+parser.add_option("-n", "--n-calls",
+	action="store", dest="n_calls", type="int", default=10,
+	help="calls per size")
+(options, args) = parser.parse_args()
+
+sizes = [ int(size) for size in args ] or [1, 5, 10, 50]
+logging.basicConfig(level=30)
+
+
+class Echo:
+	def echo(self, a):
+		return a
+
+	def echo_b64(self, d):
+		a = numpy.frombuffer(base64.b64decode(d['data']), dtype=d['dtype'])
+		return {'data': base64.b64encode(a.tobytes()).decode(), 'dtype': a.dtype.str}
+
+
+def bench(mode):
+	server = zerobot.Server("tcp://*:8700","tcp://*:8701","tcp://*:8702","tcp://*:8703","tcp://*:8704")
+	server.start(False)
+	service = zerobot.Service("echo", "tcp://localhost:8701", Echo())
+	service.start(False)
+	client = zerobot.Client("bench", "tcp://localhost:8700", "echo")
+	client.start(False)
+	time.sleep(0.5)
+
+	for size in sizes:
+		a = numpy.random.random(size*2**20//8)
+		start = time.time()
+		for _ in range(options.n_calls):
+			if mode == "frames":
+				r = client.echo(a, timeout=60)
+			else:
+				d = client.echo_b64({'data': base64.b64encode(a.tobytes()).decode(), 'dtype': a.dtype.str}, timeout=60)
+				r = numpy.frombuffer(base64.b64decode(d['data']), dtype=d['dtype'])
+		ellapsed = time.time()-start
+		assert r.shape == a.shape
+		print('%-6s %3s MB : %0.1f ms/call, %0.1f MB/s'
+			% (mode, size, ellapsed/options.n_calls*1000, 2*size*options.n_calls/ellapsed))
+		sys.stdout.flush()
+	os._exit(0)
+
+if __name__ == '__main__':
+	if options.mode != "both":
+		bench(options.mode)
+	for mode in ["frames", "base64"]:
+		subprocess.call([sys.executable, __file__, "-m", mode, "-n", str(options.n_calls)] + [ str(size) for size in sizes ])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Mesure le débit du :class:`zerobot.Server` et le temps CPU qu'il consomme
+par message. Les clients et le service d'écho utilisent directement des
+sockets zmq pour que seul le coût du serveur soit mesuré.
+
+Avec ``--shards N`` un :class:`zerobot.ShardedServer` est utilisé, ses shards
+sont des threads ou des processus (``--processes``). Le temps CPU compte
+aussi celui des shards lancés dans des processus.
+
+``--mirror`` choisit la recopie des messages sur le publisher :
+
+* on : un abonné lit tout le publisher (comportement historique)
+* off : un abonné est connecté mais la recopie est désactivée
+* nosub : recopie activée mais personne n'est abonné
+* N : un abonné, un message sur N est recopié
+
+usage : ./benchmark_broker.py [options] n_clients n_msgs [payload_size]
+"""
+
+import zerobot
+import zmq
+
+import os
+import sys
+import time
+import optparse
+import threading
+import multiprocessing
+
+parser = optparse.OptionParser("usage: %prog [options] n_clients n_msgs [payload_size]")
+parser.add_option("-s", "--shards",
+	action="store", dest="shards", type="int", default=0,
+	help="number of shards, 0 for zerobot.Server")
+parser.add_option("-p", "--processes",
+	action="store_true", dest="processes", default=False,
+	help="run the shards in processes")
+parser.add_option("-m", "--mirror",
+	action="store", dest="mirror", default="on",
+	help="on, off, nosub or N (1-in-N sampling)")
+(options, args) = parser.parse_args()
+
+n_clients = int(args[0]) if len(args) > 0 else 4
+n_msgs = int(args[1]) if len(args) > 1 else 10000
+payload_size = int(args[2]) if len(args) > 2 else 100
+n_shards = options.shards
+processes = options.processes
+mirror = options.mirror
+
+FRONTEND = "tcp://localhost:8100"
+BACKEND = "tcp://localhost:8101"
+
+
+def run_server(e_stop, q_cpu):
+	addrs = ("tcp://*:8100","tcp://*:8101","tcp://*:8102","tcp://*:8103","tcp://*:8104")
+	if n_shards:
+		server = zerobot.ShardedServer(*addrs, n_shards=n_shards, processes=processes)
+	else:
+		server = zerobot.Server(*addrs)
+	if mirror == "off":
+		server.set_mirror(False)
+	elif mirror.isdigit():
+		server.set_mirror(sample=int(mirror))
+	server.start(False)
+	e_stop.wait()
+	server.stop()
+	# user+sys du serveur et des shards terminés
+	q_cpu.put(sum(os.times()[:4]))
+
+def echo(ctx, e_stop):
+	socket = ctx.socket(zmq.DEALER)
+	socket.identity = b"echo"
+	socket.connect(BACKEND)
+	poller = zmq.Poller()
+	poller.register(socket, zmq.POLLIN)
+	while not e_stop.is_set():
+		if poller.poll(100):
+			socket.send_multipart(socket.recv_multipart(copy=False), copy=False)
+	socket.close()
+
+def log(ctx, e_stop):
+	""" Abonné au publisher, comme scripts/log.py. """
+	socket = ctx.socket(zmq.SUB)
+	socket.setsockopt(zmq.SUBSCRIBE, b"")
+	socket.connect("tcp://localhost:8102")
+	poller = zmq.Poller()
+	poller.register(socket, zmq.POLLIN)
+	while not e_stop.is_set():
+		if poller.poll(100):
+			socket.recv_multipart(copy=False)
+	socket.close()
+
+def client(ctx, i, frames):
+	socket = ctx.socket(zmq.DEALER)
+	socket.identity = ("bench-%s" % i).encode()
+	socket.connect(FRONTEND)
+	# fenêtre de messages en vol pour ne pas mesurer que la latence
+	window = 100
+	sent = 0
+	for _ in range(min(window, n_msgs)):
+		socket.send_multipart(frames, copy=False)
+		sent += 1
+	for _ in range(n_msgs):
+		socket.recv_multipart(copy=False)
+		if sent < n_msgs:
+			socket.send_multipart(frames, copy=False)
+			sent += 1
+	socket.close()
+
+def benchmark():
+	e_stop_server = multiprocessing.Event()
+	q_cpu = multiprocessing.Queue()
+	p = multiprocessing.Process(target=run_server, args=(e_stop_server, q_cpu))
+	p.start()
+	time.sleep(2 if processes else 0.5)
+
+	ctx = zmq.Context()
+	e_stop = threading.Event()
+	t_echo = threading.Thread(target=echo, args=(ctx, e_stop))
+	t_echo.start()
+	if mirror != "nosub":
+		t_log = threading.Thread(target=log, args=(ctx, e_stop))
+		t_log.start()
+	time.sleep(0.2)
+
+	request = zerobot.Request(0, "echo", ["x"*payload_size])
+	frames = [b"echo"] + zerobot.pack_msg(request, zerobot.get_codec('json'))
+	clients = [ threading.Thread(target=client, args=(ctx, i, frames)) for i in range(n_clients) ]
+	start = time.time()
+	for t in clients: t.start()
+	for t in clients: t.join()
+	ellapsed = time.time()-start
+
+	e_stop_server.set()
+	cpu = q_cpu.get()
+	p.join()
+	e_stop.set()
+	t_echo.join()
+	if mirror != "nosub":
+		t_log.join()
+	ctx.term()
+
+	# chaque requête traverse le serveur deux fois (aller et retour)
+	tot_msgs = 2*n_clients*n_msgs
+	shards = '%s %s shards' % (n_shards, 'process' if processes else 'thread') if n_shards else 'Server'
+	print('%s, mirror %s, %s clients, %s msgs of %s bytes : %0.2fs, msgs/s : %s, server cpu/msg : %0.2fus'
+		% (shards, mirror, n_clients, n_msgs, payload_size, ellapsed, round(tot_msgs/ellapsed), cpu/tot_msgs*1E6))
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Coût de *n* clients vers des services différents : un :class:`zerobot.AsyncClient`
+par service ou un :class:`zerobot.ChannelProxy` par service sur un seul
+:class:`zerobot.Channel`. Mesure le temps de création, la mémoire (RSS),
+le nombre de file descriptors et de threads. Chaque mode est lancé dans
+un processus séparé.
+
+usage : ./benchmark_channel.py n [clients|channel]
+"""
+
+import zerobot
+
+import os
+import sys
+import time
+import resource
+import threading
+import subprocess
+import logging
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+modes = sys.argv[2:] or ["clients", "channel"]
+logging.basicConfig(level=30)
+
+ADDR = "tcp://localhost:8500"
+
+def rss_kb():
+	with open("/proc/self/status") as f:
+		for line in f:
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1])
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def n_fds():
+	return len(os.listdir("/proc/self/fd"))
+
+def bench(mode):
+	server = zerobot.Server("tcp://*:8500","tcp://*:8501","tcp://*:8502","tcp://*:8503","tcp://*:8504")
+	server.start(False)
+	time.sleep(0.2)
+	rss_start, fds_start, threads_start = rss_kb(), n_fds(), threading.active_count()
+
+	start = time.time()
+	if mode == "clients":
+		clients = []
+		for i in range(n):
+			client = zerobot.AsyncClient("bench-%s" % i, ADDR, "service-%s" % i)
+			client.start(False)
+			clients.append(client)
+	else:
+		channel = zerobot.Channel.get(ADDR)
+		clients = [ channel.proxy("service-%s" % i) for i in range(n) ]
+	ellapsed = time.time()-start
+	time.sleep(0.5)
+
+	print('%-8s %s clients : startup %0.3fs, rss +%0.1fMB, fds +%s, threads +%s'
+		% (mode, n, ellapsed, (rss_kb()-rss_start)/1024, n_fds()-fds_start,
+			threading.active_count()-threads_start))
+	sys.stdout.flush()
+	os._exit(0)
+
+if len(modes) == 1:
+	bench(modes[0])
+else:
+	for mode in modes:
+		subprocess.call([sys.executable, __file__, str(n), mode])
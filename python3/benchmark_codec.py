@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Compare les codecs disponibles : temps d'encodage+décodage d'une requête
+et de sa réponse, et nombre d'octets envoyés (header compris), avec un uid
+uuid1 en chaîne ou un uid entier (:class:`zerobot.UidGenerator`).
+
+usage : ./benchmark_codec.py [n_iterations]
+"""
+
+import zerobot
+
+import sys
+import time
+import uuid
+
+n_iter = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+kwargs = {'c':'0'*100,'b':'2'*100,'a':'3'*100}
+big_array = [i*0.5 for i in range(10000)]
+
+UIDS = [
+	("uuid1", lambda: str(uuid.uuid1())),
+	("counter", zerobot.UidGenerator(True).next),
+]
+
+CASES = [
+	# nom, fonction construisant (requête, réponse), diviseur du nombre d'itérations
+	("ping", lambda uid: (zerobot.Request(uid, "ping", [42]), zerobot.Response(uid, 84)), 1),
+	("test(**kwargs)", lambda uid: (zerobot.Request(uid, "test", [], kwargs),
+		zerobot.Response(uid, [kwargs['a'],kwargs['b'],kwargs['c']])), 1),
+	("echo(big_array)", lambda uid: (zerobot.Request(uid, "echo", [big_array]),
+		zerobot.Response(uid, big_array)), 100),
+]
+
+def bench(codec, request, response, n):
+	start = time.time()
+	for _ in range(n):
+		req_frames = zerobot.pack_msg(request, codec)
+		zerobot.unpack_msg(zerobot.Request, req_frames)
+		rep_frames = zerobot.pack_msg(response, codec)
+		zerobot.unpack_msg(zerobot.Response, rep_frames)
+	ellapsed = time.time()-start
+	n_bytes = sum(map(len, req_frames)) + sum(map(len, rep_frames))
+	return ellapsed/n, n_bytes
+
+print('%-10s %14s' % ('uid', 'us/uid'))
+for uid_name, make_uid in UIDS:
+	start = time.time()
+	for _ in range(n_iter):
+		make_uid()
+	print('%-10s %14.2f' % (uid_name, (time.time()-start)/n_iter*1E6))
+print()
+
+print('%-16s %-10s %-10s %14s %14s' % ('case', 'codec', 'uid', 'us/msg', 'bytes'))
+for name, make_msgs, div in CASES:
+	codecs = [None] + [zerobot.get_codec(c) for c in zerobot.available_codecs()]
+	for codec in codecs:
+		for uid_name, make_uid in UIDS:
+			request, response = make_msgs(make_uid())
+			average, n_bytes = bench(codec, request, response, max(1, n_iter//div))
+			print('%-16s %-10s %-10s %14.2f %14s' % (name, codec.name if codec else 'legacy',
+				uid_name, average*1E6, n_bytes))
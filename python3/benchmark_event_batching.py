@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Un client publie *n_events* petits events (clés ``odom`` et ``bat``
+alternées) aussi vite que possible à travers un :class:`zerobot.Server`
+lancé dans un autre processus, un second client les reçoit avec un
+callback inline. Les events sont envoyés un par un puis regroupés par
+paquets de *batch* au plus (``ev_batch``).
+Affiche le nombre d'events reçus par seconde, les events perdus et le temps
+CPU du serveur par event. Chaque taille de paquet est lancée dans un
+processus séparé.
+
+usage : ./benchmark_event_batching.py [options] [n_events]
+"""
+
+import zerobot
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+import multiprocessing
+import logging
+
+parser = optparse.OptionParser("usage: %prog [options] [n_events]")
+parser.add_option("-b", "--batch",
+	action="store", dest="batch", default="0,10,100",
+	help="comma separated list of batch sizes (0: no batching)")
+parser.add_option("-d", "--delay",
+	action="store", dest="delay", type="float", default=0.001,
+	help="max batching delay in seconds")
+(options, args) = parser.parse_args()
+
+n_events = int(args[0]) if args else 100000
+logging.basicConfig(level=30)
+
+
+def run_server(e_stop, q_cpu):
+	server = zerobot.Server("tcp://*:8850","tcp://*:8851","tcp://*:8852","tcp://*:8853","tcp://*:8854")
+	server.start(False)
+	e_stop.wait()
+	server.stop()
+	# user+sys du serveur
+	q_cpu.put(sum(os.times()[:2]))
+
+def bench(batch):
+	e_stop, q_cpu = multiprocessing.Event(), multiprocessing.Queue()
+	p = multiprocessing.Process(target=run_server, args=(e_stop, q_cpu))
+	p.start()
+	time.sleep(0.5)
+
+	subscriber = zerobot.Client("dashboard", "tcp://localhost:8850", "none", "tcp://localhost:8854")
+	received = [0]
+	times = [None, None]
+	def cb(key, id_from, obj):
+		now = time.time()
+		if not received[0]:
+			times[0] = now
+		times[1] = now
+		received[0] += 1
+	subscriber.add_callback("odom", cb, inline=True)
+	subscriber.add_callback("bat", cb, inline=True)
+	subscriber.start(False)
+	publisher = zerobot.Client("robot", "tcp://localhost:8850", "none", None, "tcp://localhost:8853",
+		ev_batch=batch, ev_batch_delay=options.delay)
+	time.sleep(0.5)
+
+	start = time.time()
+	for i in range(n_events):
+		publisher.send_event("odom" if i % 2 else "bat", {"seq": i, "x": 1.0})
+	# attend que plus rien n'arrive
+	n = -1
+	while n != received[0]:
+		n = received[0]
+		time.sleep(0.5)
+	ellapsed = times[1] - start
+
+	e_stop.set()
+	cpu = q_cpu.get()
+	p.join()
+	print("batch %3s : %8.0f events/s, %6s lost, server cpu %5.1f us/event"
+		% (batch, n/ellapsed, n_events - n, cpu/max(n, 1)*1e6))
+	sys.stdout.flush()
+	os._exit(0)
+
+if __name__ == '__main__':
+	if len(options.batch.split(",")) == 1:
+		bench(int(options.batch))
+	for batch in options.batch.split(","):
+		subprocess.call([sys.executable, __file__, "-b", batch, "-d", str(options.delay), str(n_events)])
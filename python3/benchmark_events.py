@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Un client publie *n_events* events ``odom`` aussi vite que possible à
+travers un :class:`zerobot.Server` (lancé avec le publieur dans un autre
+processus), un second client les reçoit avec 1, 10 et 100 callbacks.
+Affiche le nombre d'events traités par seconde, les events perdus (file
+d'envoi du publisher pleine) et le temps CPU du processus abonné par event.
+
+Modes de réception :
+
+* thread : un thread par callback et par event (ancien comportement)
+* executor : callbacks exécutés par un nombre borné de threads
+* inline : callbacks appelés directement par l'ioloop
+
+usage : ./benchmark_events.py [options] [n_events]
+"""
+
+import zerobot
+import zmq
+
+import sys
+import time
+import json
+import optparse
+import threading
+import multiprocessing
+import logging
+
+parser = optparse.OptionParser("usage: %prog [options] [n_events]")
+parser.add_option("-m", "--modes",
+	action="store", dest="modes", default="thread,executor,inline",
+	help="comma separated list of thread, executor, inline")
+parser.add_option("-c", "--callbacks",
+	action="store", dest="callbacks", default="1,10,100",
+	help="comma separated list of callback counts")
+(options, args) = parser.parse_args()
+
+n_events = int(args[0]) if args else 10000
+logging.basicConfig(level=30)
+
+
+class ThreadPerCallbackClient(zerobot.Client):
+	""" Un thread par callback et par event, comme avant l'executor. """
+	def _process_ev(self, fd, _ev):
+		while True:
+			try:
+				mmsg = fd.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			ev_key, id_from, msg = map(lambda x: x.decode(), mmsg)
+			obj = json.loads(msg)
+			for cb in self.callbacks[ev_key]:
+				t = threading.Thread(target=cb, args=(ev_key, id_from, obj))
+				t.daemon = True
+				t.start()
+
+
+def publish(e_ready, e_go):
+	server = zerobot.Server("tcp://*:8800","tcp://*:8801","tcp://*:8802","tcp://*:8803","tcp://*:8804")
+	server.start(False)
+	publisher = zerobot.Client("odometry", "tcp://localhost:8800", "none", None, "tcp://localhost:8803")
+	e_ready.set()
+	while True:
+		e_go.wait()
+		e_go.clear()
+		for i in range(n_events):
+			publisher.send_event("odom", {"seq": i, "x": 1.0, "y": 2.0, "theta": 0.5})
+
+def bench(mode, n_callbacks, e_go):
+	klass = ThreadPerCallbackClient if mode == "thread" else zerobot.Client
+	client = klass("dashboard-%s-%s" % (mode, n_callbacks), "tcp://localhost:8800", "none", "tcp://localhost:8804")
+	calls = []
+	times = [None, None]
+	def cb(key, id_from, obj):
+		now = time.time()
+		if not calls:
+			times[0] = now
+		times[1] = now
+		calls.append(obj["seq"])
+	for _ in range(n_callbacks):
+		client.add_callback("odom", cb, inline=(mode == "inline"))
+	client.start(False)
+	time.sleep(0.5)
+
+	cpu = time.process_time()
+	e_go.set()
+	# attend que plus rien n'arrive
+	n = -1
+	while n != len(calls):
+		n = len(calls)
+		time.sleep(1)
+	cpu = time.process_time() - cpu
+	received = n // n_callbacks
+	ellapsed = times[-1] - times[0]
+	print("%-8s %3s callbacks : %8.0f events/s, %5s lost, cpu %6.1f us/event"
+		% (mode, n_callbacks, received/ellapsed, n_events - received, cpu/max(received, 1)*1e6))
+	sys.stdout.flush()
+	# arrêt depuis l'ioloop pour ne plus lire les sockets avant de les fermer
+	client.ioloop.add_callback(client.ioloop.stop)
+	time.sleep(0.1)
+	client.close()
+
+if __name__ == '__main__':
+	e_ready, e_go = multiprocessing.Event(), multiprocessing.Event()
+	p = multiprocessing.Process(target=publish, args=(e_ready, e_go))
+	p.daemon = True
+	p.start()
+	e_ready.wait()
+	time.sleep(0.5)
+	for mode in options.modes.split(","):
+		for n_callbacks in map(int, options.callbacks.split(",")):
+			bench(mode, n_callbacks, e_go)
+	p.terminate()
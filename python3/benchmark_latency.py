@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Latence (p50/p99) et nombre maximum de threads d'un :class:`zerobot.AsyncClient`
+suivant le mode de *dispatch* des réponses.
+
+usage : ./benchmark_latency.py n_reqs [inline|ipc ...]
+"""
+
+import zerobot
+
+import sys
+import time
+import threading
+import logging
+
+n_reqs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+modes = sys.argv[2:] or ["ipc", "inline"]
+logging.basicConfig(level=30)
+
+server = zerobot.Server("tcp://*:8400","tcp://*:8401","tcp://*:8402","tcp://*:8403","tcp://*:8404")
+server.start(False)
+
+class Cool:
+	def ping(self, num):
+		return num+42
+
+cool = zerobot.Service("cool", "tcp://localhost:8401", Cool())
+cool.start(False)
+time.sleep(0.2)
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values)-1, int(len(values)*p/100))]
+
+def bench(dispatch):
+	client = zerobot.AsyncClient("bench-%s" % dispatch, "tcp://localhost:8400", "cool", dispatch=dispatch)
+	client.start(False)
+	time.sleep(0.2)
+	peak_threads = threading.active_count()
+
+	# appels bloquants : latence d'un aller-retour
+	latencies = []
+	for i in range(n_reqs):
+		start = time.time()
+		client.ping(i, block=True)
+		latencies.append(time.time()-start)
+
+	# appels avec callback : latence jusqu'à l'exécution du callback
+	cb_latencies = []
+	done = threading.Event()
+	lock = threading.Lock()
+	def make_cb(start):
+		def cb(response):
+			with lock:
+				cb_latencies.append(time.time()-start)
+				if len(cb_latencies) == n_reqs: done.set()
+		return cb
+	for i in range(n_reqs):
+		client.ping(i, block=False, cb_fct=make_cb(time.time()))
+		peak_threads = max(peak_threads, threading.active_count())
+	while not done.wait(0.001):
+		peak_threads = max(peak_threads, threading.active_count())
+
+	client.close()
+	print('%-8s block p50 : %0.3fms, p99 : %0.3fms | callback p50 : %0.3fms, p99 : %0.3fms | peak threads : %s'
+		% (dispatch, percentile(latencies, 50)*1000, percentile(latencies, 99)*1000,
+			percentile(cb_latencies, 50)*1000, percentile(cb_latencies, 99)*1000, peak_threads))
+
+for mode in modes:
+	bench(mode)
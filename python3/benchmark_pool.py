@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Méthode qui utilise le CPU exposée par un :class:`zerobot.AsyncService`
+(workers threads, limités par le GIL) ou par un
+:class:`zerobot.ProcessPoolService` (workers processus). Affiche le nombre
+d'appels par seconde pour 1 à *max_workers* workers (par défaut le nombre
+de cpus), chaque mesure est lancée dans un processus séparé.
+
+Les clients utilisent directement des sockets zmq, autant d'appels que de
+workers sont en cours en permanence.
+
+usage : ./benchmark_pool.py [options] [max_workers]
+"""
+
+import zerobot
+import zmq
+
+import os
+import sys
+import time
+import subprocess
+import optparse
+import threading
+import logging
+
+parser = optparse.OptionParser("usage: %prog [options] [max_workers]")
+parser.add_option("-m", "--mode",
+	action="store", dest="mode", default="both",
+	help="threads, processes or both")
+parser.add_option("-w", "--workers",
+	action="store", dest="workers", type="int", default=0,
+	help="run only with this number of workers")
+parser.add_option("-n", "--n",
+	action="store", dest="n", type="int", default=200000,
+	help="iterations of a cpu call")
+parser.add_option("-d", "--duration",
+	action="store", dest="duration", type="float", default=3,
+	help="duration of each run")
+(options, args) = parser.parse_args()
+
+max_workers = int(args[0]) if args else os.cpu_count()
+logging.basicConfig(level=30)
+
+
+class Planner:
+	def cpu(self, n):
+		r = 0
+		for i in range(n):
+			r += i*i % 7
+		return r
+
+
+def client(ctx, i, counter, e_stop):
+	socket = ctx.socket(zmq.DEALER)
+	socket.identity = ("bench-%s" % i).encode()
+	socket.connect("tcp://localhost:8300")
+	poller = zmq.Poller()
+	poller.register(socket, zmq.POLLIN)
+	frames = [b"planner"] + zerobot.pack_msg(zerobot.Request(i, "cpu", [options.n]), zerobot.get_codec('json'))
+	while not e_stop.is_set():
+		socket.send_multipart(frames)
+		while not e_stop.is_set() and not poller.poll(100):
+			pass
+		if e_stop.is_set():
+			break
+		socket.recv_multipart()
+		counter[i] += 1
+	socket.close(0)
+
+def run(mode, n_workers):
+	server = zerobot.Server("tcp://*:8300","tcp://*:8301","tcp://*:8302","tcp://*:8303","tcp://*:8304")
+	server.start(False)
+	klass = zerobot.ProcessPoolService if mode == "processes" else zerobot.AsyncService
+	service = klass("planner", "tcp://localhost:8301", Planner(), init_workers=n_workers)
+	service.start(False)
+	# attend que les workers soient prêts
+	while len(service._free_workers) < n_workers:
+		time.sleep(0.05)
+	time.sleep(0.2)
+
+	ctx = zmq.Context()
+	e_stop = threading.Event()
+	counter = [0]*n_workers
+	threads = [ threading.Thread(target=client, args=(ctx, i, counter, e_stop)) for i in range(n_workers) ]
+	for t in threads: t.start()
+	time.sleep(options.duration)
+	e_stop.set()
+	for t in threads: t.join()
+	ctx.term()
+	print('%-9s %2s workers : %0.1f calls/s' % (mode, n_workers, sum(counter)/options.duration))
+	sys.stdout.flush()
+	if mode == "processes":
+		for worker in service._workers.values():
+			worker.close()
+	os._exit(0)
+
+if __name__ == '__main__':
+	if options.workers:
+		run(options.mode, options.workers)
+	modes = ["threads", "processes"] if options.mode == "both" else [options.mode]
+	print('%s cpus, cpu(%s)' % (os.cpu_count(), options.n))
+	sys.stdout.flush()
+	for mode in modes:
+		for n_workers in range(1, max_workers+1):
+			# chaque mesure dans un processus séparé
+			subprocess.call([sys.executable, __file__, "-m", mode, "-w", str(n_workers),
+				"-n", str(options.n), "-d", str(options.duration)])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Charge mixte sur un :class:`zerobot.AsyncService` : des clients appellent en
+boucle la méthode lente ``sleep`` pendant que d'autres appellent la méthode
+rapide ``test``. Affiche la latence par méthode (médiane, 99e centile, max).
+
+Sans option le service exécute les requêtes dans leur ordre d'arrivée, les
+``sleep`` occupent tous les workers et les ``test`` attendent derrière.
+``--priority`` fait passer ``test`` devant, ``--limit N`` limite à N le
+nombre de ``sleep`` exécutés simultanément.
+
+Les clients utilisent directement des sockets zmq pour que seul le service
+soit mesuré.
+
+usage : ./benchmark_scheduler.py [options] n_fast_clients n_slow_clients duration
+"""
+
+import zerobot
+import zmq
+
+import time
+import optparse
+import threading
+import logging
+
+parser = optparse.OptionParser("usage: %prog [options] n_fast_clients n_slow_clients duration")
+parser.add_option("-w", "--workers",
+	action="store", dest="workers", type="int", default=5,
+	help="number of workers of the service")
+parser.add_option("-p", "--priority",
+	action="store_true", dest="priority", default=False,
+	help="serve test before sleep")
+parser.add_option("-l", "--limit",
+	action="store", dest="limit", type="int", default=0,
+	help="max concurrent sleep calls, 0 for no limit")
+parser.add_option("-s", "--sleep",
+	action="store", dest="sleep", type="float", default=0.2,
+	help="duration of a sleep call")
+(options, args) = parser.parse_args()
+
+n_fast = int(args[0]) if len(args) > 0 else 4
+n_slow = int(args[1]) if len(args) > 1 else 10
+duration = float(args[2]) if len(args) > 2 else 5
+logging.basicConfig(level=30)
+
+class Cool:
+	def test(self, a=3, b=4, c=5):
+		return a,b,c
+
+	def sleep(self, n):
+		time.sleep(n)
+		return "ok"
+
+
+def client(ctx, i, fct, args, latencies, e_stop):
+	socket = ctx.socket(zmq.DEALER)
+	socket.identity = ("bench-%s-%s" % (fct, i)).encode()
+	socket.connect("tcp://localhost:8200")
+	poller = zmq.Poller()
+	poller.register(socket, zmq.POLLIN)
+	uid = 0
+	while not e_stop.is_set():
+		uid += 1
+		request = zerobot.Request(uid, fct, args)
+		start = time.time()
+		socket.send_multipart([b"cool"] + zerobot.pack_msg(request, zerobot.get_codec('json')))
+		while not e_stop.is_set() and not poller.poll(100):
+			pass
+		if e_stop.is_set():
+			break
+		socket.recv_multipart()
+		latencies.append(time.time()-start)
+	socket.close(0)
+
+def percentile(values, p):
+	return values[min(len(values)-1, int(len(values)*p))]
+
+def benchmark():
+	server = zerobot.Server("tcp://*:8200","tcp://*:8201","tcp://*:8202","tcp://*:8203","tcp://*:8204")
+	server.start(False)
+	priorities = {'test': 0} if options.priority else None
+	limits = {'sleep': options.limit} if options.limit else None
+	cool = zerobot.AsyncService("cool", "tcp://localhost:8201", Cool(),
+		init_workers=options.workers, priorities=priorities, concurrency_limits=limits)
+	cool.start(False)
+	time.sleep(0.5)
+
+	ctx = zmq.Context()
+	e_stop = threading.Event()
+	latencies = {'test': [], 'sleep': []}
+	threads = [ threading.Thread(target=client, args=(ctx, i, 'test', [], latencies['test'], e_stop))
+		for i in range(n_fast) ]
+	threads += [ threading.Thread(target=client, args=(ctx, i, 'sleep', [options.sleep], latencies['sleep'], e_stop))
+		for i in range(n_slow) ]
+	for t in threads: t.start()
+	time.sleep(duration)
+	e_stop.set()
+	for t in threads: t.join()
+	ctx.term()
+
+	mode = []
+	if options.priority: mode.append('priority')
+	if options.limit: mode.append('sleep limit %s' % options.limit)
+	print('%s workers, %s fast + %s slow clients, %s' % (options.workers, n_fast, n_slow, ', '.join(mode) or 'fifo'))
+	for fct, values in sorted(latencies.items()):
+		values.sort()
+		if not values:
+			print('  %-6s no response' % fct)
+			continue
+		print('  %-6s %6s reqs, p50 : %0.2fms, p99 : %0.2fms, max : %0.2fms'
+			% (fct, len(values), percentile(values, 0.5)*1000, percentile(values, 0.99)*1000, values[-1]*1000))
+
+	cool.stop()
+	server.stop()
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Méthode qui renvoie *n_items* points (listes de *size* floats), appelée
+normalement (la liste entière dans une seule réponse) ou avec
+``stream=True`` (paquets de *chunk* points, *window* paquets d'avance).
+Affiche le délai avant le premier point, la durée totale et le pic de
+mémoire allouée par le processus (serveur, service et client), mesuré avec
+:mod:`tracemalloc`. Chaque mode est lancé dans un processus séparé.
+
+usage : ./benchmark_stream.py [options] [n_items]
+"""
+
+import zerobot
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+import tracemalloc
+import logging
+
+parser = optparse.OptionParser("usage: %prog [options] [n_items]")
+parser.add_option("-m", "--mode",
+	action="store", dest="mode", default="both",
+	help="call, stream or both")
+parser.add_option("-s", "--size",
+	action="store", dest="size", type="int", default=100,
+	help="floats per item")
+parser.add_option("-c", "--chunk",
+	action="store", dest="chunk", type="int", default=100,
+	help="items per chunk")
+parser.add_option("-w", "--window",
+	action="store", dest="window", type="int", default=4,
+	help="chunks sent in advance")
+(options, args) = parser.parse_args()
+
+n_items = int(args[0]) if args else 100000
+logging.basicConfig(level=30)
+
+
+class Lidar:
+	def scans(self, n, size):
+		for i in range(n):
+			yield [ float(i) ]*size
+
+
+def bench(mode):
+	server = zerobot.Server("tcp://*:8900","tcp://*:8901","tcp://*:8902","tcp://*:8903","tcp://*:8904")
+	server.start(False)
+	service = zerobot.Service("lidar", "tcp://localhost:8901", Lidar())
+	service.start(False)
+	client = zerobot.Client("bench", "tcp://localhost:8900", "lidar",
+		stream_window=options.window, stream_chunk_size=options.chunk)
+	client.start(False)
+	time.sleep(0.5)
+
+	tracemalloc.start()
+	start = time.time()
+	first = None
+	n = 0
+	if mode == "stream":
+		for _item in client.scans(n_items, options.size, stream=True, timeout=60):
+			if first is None:
+				first = time.time()-start
+			n += 1
+	else:
+		for _item in client.scans(n_items, options.size, timeout=600):
+			if first is None:
+				first = time.time()-start
+			n += 1
+	ellapsed = time.time()-start
+	_current, peak = tracemalloc.get_traced_memory()
+	print('%-6s %s items : first item %0.3fs, total %0.2fs, peak memory %0.1f MB'
+		% (mode, n, first, ellapsed, peak/2**20))
+	sys.stdout.flush()
+	os._exit(0)
+
+if __name__ == '__main__':
+	if options.mode != "both":
+		bench(options.mode)
+	for mode in ["call", "stream"]:
+		subprocess.call([sys.executable, __file__, "-m", mode, "-s", str(options.size),
+			"-c", str(options.chunk), "-w", str(options.window), str(n_items)])
@@ -21,20 +21,54 @@ parser.add_option("-b", "--backend",
 parser.add_option("-p", "--publish",
 	action="store", dest="publish", default="tcp://*:5002",
 	help="publish bind addr. ex : tcp://*:5002")
+parser.add_option("-c", "--control",
+	action="store", dest="control", default=None,
+	help="control bind addr (PAUSE/RESUME/TERMINATE). ex : tcp://*:5005")
+parser.add_option("-s", "--shards",
+	action="store", dest="shards", type="int", default=0,
+	help="number of routing shards, 0 for a single routing loop")
+parser.add_option("--processes",
+	action="store_true", dest="processes", default=False,
+	help="run the shards in processes")
+parser.add_option("-m", "--mirror",
+	action="store", dest="mirror", default="on",
+	help="mirror routed messages on the publisher : on, off or N (1-in-N sampling)")
+parser.add_option("-i", "--mirror_ids",
+	action="store", dest="mirror_ids", default="",
+	help="only mirror messages from/to these identities, separated by coma. ex: id_client1,id_client5")
+parser.add_option("-e", "--ev_cache",
+	action="store", dest="ev_cache", type="int", default=0,
+	help="keep the last value of up to N event keys for new subscribers, 0 to disable")
+parser.add_option("--ev_cache_ttl",
+	action="store", dest="ev_cache_ttl", type="float", default=None,
+	help="lifetime of the cached event values in seconds")
 parser.add_option("-l", "--log_lvl",
 	action="store", dest="log_lvl", default=20,
 	help="log level")
 
 
-(options, _args) = parser.parse_args()
+# les shards lancés dans des processus réimportent ce module
+if __name__ == '__main__':
+	(options, _args) = parser.parse_args()
 
 
-logging.basicConfig(level=options.log_lvl)
+	logging.basicConfig(level=options.log_lvl)
 
-d = {}
-if options.frontend: d["ft_bind_addr"] = options.frontend
-if options.backend: d["bc_bind_addr"] = options.backend
-if options.publish: d["pb_bind_addr"] = options.publish
+	d = {}
+	if options.frontend: d["ft_bind_addr"] = options.frontend
+	if options.backend: d["bc_bind_addr"] = options.backend
+	if options.publish: d["pb_bind_addr"] = options.publish
+	if options.control: d["ctrl_bind_addr"] = options.control
+	if options.ev_cache: d["ev_cache"] = zerobot.EventCache(options.ev_cache, ttl=options.ev_cache_ttl)
 
-server = zerobot.Server(**d)
-server.start()
+	if options.shards:
+		server = zerobot.ShardedServer(n_shards=options.shards, processes=options.processes, **d)
+	else:
+		server = zerobot.Server(**d)
+	mirror_ids = list(filter(lambda x: bool(x), options.mirror_ids.split(',')))
+	if options.mirror == "off":
+		server.set_mirror(False)
+	else:
+		sample = int(options.mirror) if options.mirror.isdigit() else 1
+		server.set_mirror(True, sample, mirror_ids or None)
+	server.start()
@@ -19,6 +19,7 @@ setup(
     author_email = "thomas.recouvreux@gmail.com",
     description = ("An architecture that allow fast communication between clients."),
     install_requires=['pyzmq'],
+    extras_require={'msgpack': ['msgpack']},
     tests_require=[],
     keywords = "zmq rpc robot",
     url = "http://github.com/utcoupe/zerobot",
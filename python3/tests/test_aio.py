@@ -0,0 +1,242 @@
+
+import unittest
+
+import time
+import json
+import threading
+import asyncio
+import zmq
+import zmq.asyncio
+
+from zerobot import *
+from zerobot.aio import AsyncioClient, AsyncioService
+
+
+class AsyncioClientTestCase(unittest.TestCase):
+	service_id = b"service"
+
+	def setUp(self):
+		self.ctx = zmq.asyncio.Context()
+		self.socket = self.ctx.socket(zmq.ROUTER)
+		self.socket.setsockopt(zmq.IDENTITY, b"server")
+		self.socket.bind("inproc://server")
+		self.client = AsyncioClient("client", "inproc://server", self.service_id.decode(), ctx=self.ctx)
+
+	def tearDown(self):
+		self.client.close()
+		self.socket.close()
+		self.ctx.term()
+
+	async def serve(self, n, f=lambda r: Response(r.uid, r.args[0]+42)):
+		""" Répond à *n* requêtes, dans l'ordre inverse de leur arrivée. """
+		requests = []
+		for _ in range(n):
+			msg = await self.socket.recv_multipart()
+			self.assertEqual(msg[1], self.service_id)
+			request, codec = unpack_msg(Request, msg[2:])
+			requests.append((msg[0], request, codec))
+		for id_from, request, codec in reversed(requests):
+			response = f(request)
+			await self.socket.send_multipart([id_from, self.service_id] + pack_msg(response, codec))
+
+	def test_call(self):
+		async def run():
+			server = asyncio.ensure_future(self.serve(100))
+			results = await asyncio.gather(*[ self.client.ping(i) for i in range(100) ])
+			await server
+			return results
+		self.assertEqual(asyncio.run(run()), [ i+42 for i in range(100) ])
+		self.assertEqual(self.client._pending, {})
+
+	def test_error(self):
+		async def run():
+			server = asyncio.ensure_future(self.serve(1, lambda r: Response(r.uid, None, {'error': 'oups', 'tb': ''})))
+			try:
+				await self.client.ping(1)
+			finally:
+				await server
+		self.assertRaises(ZeroBotException, asyncio.run, run())
+
+	def test_stream(self):
+		async def run():
+			async def serve():
+				msg = await self.socket.recv_multipart()
+				request, codec = unpack_msg(Request, msg[2:])
+				for seq in range(3):
+					chunk = StreamChunk(request.uid, [seq, seq], None, seq, seq < 2)
+					await self.socket.send_multipart([msg[0], self.service_id] + pack_msg(chunk, codec))
+			server = asyncio.ensure_future(serve())
+			items = [ item async for item in self.client.lines(stream=True, timeout=1) ]
+			await server
+			return items
+		self.assertEqual(asyncio.run(run()), [0, 0, 1, 1, 2, 2])
+		self.assertEqual(self.client._streams, {})
+
+	def test_stream_out_of_order(self):
+		async def run():
+			async def serve():
+				msg = await self.socket.recv_multipart()
+				request, codec = unpack_msg(Request, msg[2:])
+				for seq in [2, 0, 1]:
+					chunk = StreamChunk(request.uid, [seq, seq], None, seq, seq < 2)
+					await self.socket.send_multipart([msg[0], self.service_id] + pack_msg(chunk, codec))
+			server = asyncio.ensure_future(serve())
+			items = [ item async for item in self.client.lines(stream=True, timeout=1) ]
+			await server
+			return items
+		self.assertEqual(asyncio.run(run()), [0, 0, 1, 1, 2, 2])
+		self.assertEqual(self.client._streams, {})
+
+	def test_timeout(self):
+		async def run():
+			await self.client.ping(1, timeout=0.05)
+		self.assertRaises(ZeroBotTimeout, asyncio.run, run())
+		self.assertEqual(self.client._pending, {})
+
+class AsyncioServiceTestCase(unittest.TestCase):
+	client_id = b"client"
+	service_id = b"service"
+
+	class Abc:
+		async def sleep(self, t):
+			await asyncio.sleep(t)
+			return t
+
+		def ping(self, num):
+			return num+42
+
+		async def alines(self, n):
+			for i in range(n):
+				await asyncio.sleep(0)
+				yield i
+
+		def lines(self, n):
+			for i in range(n):
+				yield i
+
+		def notify(self, key):
+			# méthode classique, exécutée dans l'executor
+			self.send_event(key, {'thread': threading.current_thread().name})
+			return key
+
+	def setUp(self):
+		self.ctx = zmq.asyncio.Context()
+		self.socket = self.ctx.socket(zmq.ROUTER)
+		self.socket.setsockopt(zmq.IDENTITY, b"server")
+		self.socket.bind("inproc://server")
+		self.service = AsyncioService(self.service_id.decode(), "inproc://server", self.Abc(), ctx=self.ctx)
+
+	def tearDown(self):
+		self.service.close()
+		self.socket.close()
+		self.ctx.term()
+
+	def call(self, requests, codec=None):
+		""" Envoie les *requests* au service et renvoie les réponses dans leur ordre d'arrivée. """
+		async def run():
+			self.service.start()
+			for request in requests:
+				await self.socket.send_multipart([self.service_id, self.client_id] + pack_msg(request, codec))
+			responses = []
+			for _ in requests:
+				msg = await self.socket.recv_multipart()
+				self.assertEqual(msg[:2], [self.service_id, self.client_id])
+				responses.append(unpack_msg(Response, msg[2:])[0])
+			return responses
+		return asyncio.run(run())
+
+	def test_concurrent(self):
+		# les coroutines ne s'attendent pas les unes les autres
+		start = time.time()
+		responses = self.call([ Request(i, "sleep", [0.2]) for i in range(500) ])
+		self.assertLess(time.time()-start, 1)
+		self.assertEqual(sorted(int(r.uid) for r in responses), list(range(500)))
+		self.assertEqual(self.service._tasks, set())
+
+	def test_sync(self):
+		# la méthode classique passe devant le sleep
+		responses = self.call([Request("1", "sleep", [0.1]), Request("2", "ping", [1])])
+		self.assertEqual([ (r.uid, r.data) for r in responses ], [("2", 43), ("1", 0.1)])
+
+	def test_errors(self):
+		responses = self.call([Request("1", "_protected"), Request("2", "unknown")])
+		for response in responses:
+			self.assertIsNotNone(response.error)
+
+	def test_stream(self):
+		async def run():
+			self.service.start()
+			chunks = []
+			for fct in ("alines", "lines"):
+				await self.socket.send_multipart([self.service_id, self.client_id]
+					+ pack_msg(StreamRequest(fct, fct, [5], {}, 2, 2), get_codec('json')))
+				for i in range(3):
+					if i == 2:
+						# la fenêtre est pleine
+						self.assertEqual(await self.socket.poll(100), 0)
+						await self.socket.send_multipart([self.service_id, self.client_id]
+							+ pack_msg(StreamCredit(fct, 2), get_codec('json')))
+					chunk, _codec = unpack_msg(Response, (await self.socket.recv_multipart())[2:])
+					chunks.append((chunk.uid, chunk.data, chunk.more))
+			return chunks
+		self.assertEqual(asyncio.run(run()), [ (fct, data, more) for fct in ("alines", "lines")
+			for data, more in [([0, 1], True), ([2, 3], True), ([4], False)] ])
+		self.assertEqual(self.service._streams, {})
+
+	def test_streams_max_tasks(self):
+		# autant de streams en attente de crédit que de places
+		self.service.max_tasks = 2
+		codec = get_codec('json')
+		async def run():
+			self.service.start()
+			uids = ["s1", "s2"]
+			for uid in uids:
+				await self.socket.send_multipart([self.service_id, self.client_id]
+					+ pack_msg(StreamRequest(uid, "alines", [2], {}, 1, 1), codec))
+			chunks = []
+			for _ in range(2):
+				for _ in uids:
+					msg = await asyncio.wait_for(self.socket.recv_multipart(), 2)
+					chunk, _codec = unpack_msg(Response, msg[2:])
+					chunks.append((chunk.uid, chunk.data))
+				# les crédits sont reçus bien que les deux places soient prises par les streams
+				for uid in uids:
+					await self.socket.send_multipart([self.service_id, self.client_id]
+						+ pack_msg(StreamCredit(uid, 1), codec))
+			return sorted(chunks)
+		self.assertEqual(asyncio.run(run()), [("s1", [0]), ("s1", [1]), ("s2", [0]), ("s2", [1])])
+
+	def test_send_event(self):
+		events = self.ctx.socket(zmq.ROUTER)
+		events.bind("inproc://events")
+		service = AsyncioService("ev", "inproc://server", self.Abc(), ctx=self.ctx,
+			ev_push_addr="inproc://events")
+		async def run():
+			service.start()
+			await self.socket.send_multipart([b"ev", self.client_id] + pack_msg(Request("1", "notify", ["pos"])))
+			msg = await asyncio.wait_for(self.socket.recv_multipart(), 2)
+			response, _codec = unpack_msg(Response, msg[2:])
+			self.assertEqual((response.data, response.error), ("pos", None))
+			return await asyncio.wait_for(events.recv_multipart(), 1)
+		try:
+			_identity, key, obj = asyncio.run(run())
+		finally:
+			service.close()
+			events.close()
+		# envoyé par la boucle pour le thread de l'executor
+		self.assertEqual(key, b"pos")
+		self.assertNotEqual(json.loads(obj)['thread'], threading.current_thread().name)
+
+	def test_generator(self):
+		# sans stream, les générateurs sont renvoyés en une seule réponse
+		responses = self.call([Request("4", "alines", [3]), Request("5", "lines", [3])])
+		self.assertEqual([ r.data for r in responses ], [[0, 1, 2]]*2)
+
+	def test_batch(self):
+		batch = BatchRequest("3", [Request(0, "sleep", [0.05]), Request(1, "ping", [1])])
+		response, = self.call([batch], get_codec('json'))
+		self.assertEqual(response.uid, "3")
+		self.assertEqual(batch_results(response.data), [0.05, 43])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import time
+import threading
+
+from zerobot import *
+
+from test_client import _ClientTest
+
+
+def service_handler(msg, request, send):
+	""" Répond par le service appelé et l'argument. """
+	send(Response(request.uid, [msg[1].decode(), request.args[0]]))
+
+
+class ChannelTestCase(_ClientTest, unittest.TestCase):
+	PORT = 9160
+
+	def create_client(self):
+		return Channel.get(self.addr, ctx=self.ctx, callback_workers=2, timer_tick=0.01)
+
+	def proxy(self):
+		return self.client.proxy(self.service_id.decode())
+
+	def test_shared(self):
+		self.assertIs(Channel.get(self.addr), self.client)
+		self.assertIs(self.client.proxy("a"), self.client.proxy("a"))
+
+	def test_proxies(self):
+		n = 10
+		self.serve(2*n, service_handler)
+		a = self.client.proxy("a")
+		b = self.client.proxy("b")
+		results = []
+		ev = threading.Event()
+		def cb(response):
+			results.append(tuple(response.data))
+			if len(results) == n: ev.set()
+		for i in range(n):
+			b.ping(i, block=False, cb_fct=cb)
+		for i in range(n):
+			self.assertEqual(a.ping(i, timeout=1), ["a", i])
+		ev.wait(1)
+		self.assertEqual(sorted(results), [ ("b", i) for i in range(n) ])
+		self.assertEqual(a._resp_events, {})
+		self.assertEqual(b._resp_events, {})
+
+	def test_timeout(self):
+		a = self.client.proxy("a")
+		self.assertRaises(ZeroBotTimeout, a.ping, 1, timeout=0.1)
+		ev = threading.Event()
+		errors = []
+		def cb(response):
+			errors.append(response.error['error'])
+			ev.set()
+		a.ping(1, block=False, timeout=0.1, cb_fct=cb)
+		ev.wait(1)
+		self.assertEqual(errors, ['timeout'])
+		self.assertEqual(a._resp_events, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,417 @@
+import unittest
+
+import time
+import json
+import collections
+import threading
+import tracemalloc
+
+from zerobot import *
+
+
+def ping_handler(msg, request, send):
+	""" Répond aux pings (ou batch de pings) par l'argument + 42. """
+	if isinstance(request, BatchRequest):
+		send(Response(request.uid, [ [r.args[0]+42, None] for r in request.requests ]))
+	else:
+		send(Response(request.uid, request.args[0]+42))
+
+def echo_handler(msg, request, send):
+	""" Renvoie les arguments tels quels. """
+	send(Response(request.uid, request.args))
+
+
+class _ClientTest:
+	"""
+	Tests communs aux clients et aux proxies d'un
+	:class:`zerobot.channel.Channel` : la socket ROUTER joue le serveur et
+	le service, :meth:`proxy` renvoie l'objet appelé.
+	"""
+	PORT = 9150
+	service_id = b"service"
+
+	def setUp(self):
+		self.ctx = zmq.Context()
+		self.socket = self.ctx.socket(zmq.ROUTER)
+		self.socket.setsockopt(zmq.IDENTITY, b"server")
+		self.socket.bind("tcp://*:%s"%self.PORT)
+		self.addr = "tcp://localhost:%s"%self.PORT
+		self._servers = []
+		self.client = self.create_client()
+		time.sleep(0.1)
+
+	def tearDown(self):
+		for server in self._servers:
+			server.join(1)
+		self.client.close()
+		self.socket.close()
+		self.ctx.term()
+		time.sleep(0.1)
+
+	def create_client(self):
+		client = self.KLASS("client", self.addr, self.service_id.decode(), ctx=self.ctx, **self.KWARGS)
+		client.start(False)
+		return client
+
+	def proxy(self):
+		""" Objet dont les méthodes appellent le service. """
+		return self.client
+
+	def start_server(self, f):
+		""" Lance *f* dans un thread, attendu à la fin du test. """
+		t = threading.Thread(target=f)
+		t.daemon = True
+		t.start()
+		self._servers.append(t)
+		return t
+
+	def serve(self, n=1, handler=ping_handler):
+		"""
+		Répond à *n* requêtes dans un thread : *handler(msg, request, send)*,
+		*send(obj)* renvoie *obj* à l'appelant.
+		"""
+		def f():
+			for _ in range(n):
+				msg = self.socket.recv_multipart()
+				request, codec = unpack_msg(Request, msg[2:])
+				handler(msg, request, lambda obj: self.socket.send_multipart(msg[:2] + pack_msg(obj, codec)))
+		return self.start_server(f)
+
+	def test_attachments(self):
+		server = self.serve(2, echo_handler)
+		proxy = self.proxy()
+		self.assertEqual(proxy.echo(b"\x00" * 100000, 1, timeout=1), [b"\x00" * 100000, 1])
+		if numpy is not None:
+			a = numpy.random.random((100, 100))
+			echo = proxy.echo(a, timeout=1)[0]
+			self.assertEqual(echo.dtype, a.dtype)
+			self.assertTrue((echo == a).all())
+		else:
+			proxy.echo(None, timeout=1)
+		server.join(1)
+
+	def test_stream(self):
+		credits = []
+		def lines(msg, request, send):
+			# 25 éléments par paquets de 10, le service attend les crédits
+			self.assertEqual((request.window, request.chunk_size), (2, 10))
+			send(StreamChunk(request.uid, list(range(10)), None, 0, True))
+			send(StreamChunk(request.uid, list(range(10, 20)), None, 1, True))
+			credit, _codec = unpack_msg(Request, self.socket.recv_multipart()[2:])
+			credits.append(credit.credit)
+			send(StreamChunk(request.uid, list(range(20, 25)), None, 2, False))
+		server = self.serve(1, lines)
+		self.client.stream_window = 2
+		self.client.stream_chunk_size = 10
+		proxy = self.proxy()
+		self.assertEqual(list(proxy.lines(stream=True, timeout=1)), list(range(25)))
+		server.join(1)
+		self.assertEqual(credits, [1])
+		self.assertEqual(proxy._streams, {})
+
+	def test_stream_out_of_order(self):
+		def lines(msg, request, send):
+			# paquets en vol dans le désordre, le dernier arrive en premier
+			for seq in [3, 1, 0, 2]:
+				send(StreamChunk(request.uid, [seq, seq], None, seq, seq < 3))
+		server = self.serve(1, lines)
+		proxy = self.proxy()
+		self.assertEqual(list(proxy.lines(stream=True, timeout=1)), [0, 0, 1, 1, 2, 2, 3, 3])
+		server.join(1)
+		self.assertEqual(proxy._streams, {})
+
+	def test_stream_unread(self):
+		def lines(msg, request, send):
+			for seq in [1, 0]:
+				send(StreamChunk(request.uid, [seq], None, seq, seq < 1))
+		server = self.serve(1, lines)
+		proxy = self.proxy()
+		stream = proxy.lines(stream=True, timeout=1)
+		server.join(1)
+		time.sleep(0.1)
+		# le stream est oublié une fois tous ses paquets reçus, même s'il n'est pas lu
+		self.assertEqual(proxy._streams, {})
+		self.assertEqual(list(stream), [0, 1])
+
+
+class ClientTestCase(_ClientTest, unittest.TestCase):
+	KLASS = Client
+	KWARGS = {}
+
+	def test_concurrent_callers(self):
+		n = 20
+		# les réponses sont envoyées dans l'ordre inverse des requêtes
+		def f():
+			msgs = [ self.socket.recv_multipart() for _ in range(n) ]
+			for msg in reversed(msgs):
+				request, codec = unpack_msg(Request, msg[2:])
+				ping_handler(msg, request, lambda obj: self.socket.send_multipart(msg[:2] + pack_msg(obj, codec)))
+		self.start_server(f)
+		senders = set()
+		send_and_process = self.client._send_and_process
+		def record_sender(frames):
+			senders.add(threading.get_ident())
+			send_and_process(frames)
+		self.client._send_and_process = record_sender
+		results = {}
+		def call(i):
+			results[i] = self.client.ping(i, timeout=2)
+		callers = [ threading.Thread(target=call, args=(i,)) for i in range(n) ]
+		for t in callers: t.start()
+		for t in callers: t.join()
+		self.assertEqual(results, { i: i+42 for i in range(n) })
+		self.assertEqual(self.client._resp_events, {})
+		# seul le thread de l'ioloop utilise la socket
+		self.assertEqual(senders, {self.client._loop_thread})
+
+	def test_stale_response(self):
+		def f():
+			# la première réponse arrive après le timeout de l'appel
+			msgs = [ self.socket.recv_multipart() for _ in range(2) ]
+			for msg in msgs:
+				request, codec = unpack_msg(Request, msg[2:])
+				ping_handler(msg, request, lambda obj: self.socket.send_multipart(msg[:2] + pack_msg(obj, codec)))
+		self.start_server(f)
+		self.assertRaises(ZeroBotTimeout, self.client.ping, 1, timeout=0.1)
+		self.assertEqual(self.client.ping(2, timeout=1), 44)
+		self.assertEqual(self.client._resp_events, {})
+
+class AsyncClientTestCase(_ClientTest, unittest.TestCase):
+	KLASS = AsyncClient
+	KWARGS = {'dispatch': 'inline', 'callback_workers': 2}
+
+	def test_block(self):
+		self.serve()
+		self.assertEqual(self.client.ping(1, block=True, timeout=1), 43)
+		self.assertEqual(self.client._resp_events, {})
+
+	def test_batch(self):
+		self.serve(2)
+		with self.client.batch(timeout=1) as batch:
+			for i in range(10):
+				batch.ping(i)
+		self.assertEqual(batch.results, [ i+42 for i in range(10) ])
+
+		ev = threading.Event()
+		batch = self.client.batch(block=False, cb_fct=lambda results: ev.set())
+		batch.ping(1)
+		batch.send()
+		ev.wait(1)
+		self.assertEqual(batch.results, [43])
+
+	def test_callbacks(self):
+		threads = set()
+		results = []
+		ev = threading.Event()
+		def cb(response):
+			threads.add(threading.current_thread().name)
+			results.append(response.data)
+			if len(results) == 10: ev.set()
+		self.serve(10)
+		for i in range(10):
+			self.client.ping(i, block=False, cb_fct=cb)
+		ev.wait(1)
+		self.assertEqual(sorted(results), [ i+42 for i in range(10) ])
+		# les callbacks sont exécutés par les threads de l'executor
+		self.assertTrue(threads <= {"Callbacks-client-0", "Callbacks-client-1"})
+
+	def test_callback_queue_full(self):
+		client = AsyncClient("full", self.addr, self.service_id.decode(),
+			ctx=self.ctx, callback_workers=1, callback_queue=1)
+		client.start(False)
+		time.sleep(0.1)
+		nested = []
+		def cb(response):
+			if not nested:
+				# occupe le seul worker jusqu'à ce que la file déborde
+				start = time.time()
+				while not client._executor.dropped and time.time()-start < 1:
+					time.sleep(0.01)
+				# appel bloquant depuis un callback, l'ioloop ne doit pas être bloquée
+				nested.append(client.ping(100, block=True, timeout=2))
+		self.serve(4)
+		try:
+			resp_evs = [ client.ping(i, block=False, cb_fct=cb) for i in range(3) ]
+			for resp_ev in resp_evs:
+				resp_ev.wait(2)
+			time.sleep(0.1)
+			self.assertEqual(nested, [142])
+			# les callbacks qui ne tiennent pas dans la file sont abandonnés, pas les réponses
+			self.assertGreaterEqual(client._executor.dropped, 1)
+			self.assertEqual([ resp_ev.response.data for resp_ev in resp_evs ], [42, 43, 44])
+		finally:
+			client.close()
+
+	def test_cache(self):
+		requests = []
+		def handler(msg, request, send):
+			requests.append(request.fct)
+			if request.fct == 'help':
+				send(Response(request.uid, {'ping': {'cached': {'ttl': 10, 'maxsize': 10}}, 'echo': {'cached': None}}))
+			else:
+				ping_handler(msg, request, send)
+		self.serve(4, handler)
+		client = AsyncClient("cached", self.addr, self.service_id.decode(), ctx=self.ctx, cache=True)
+		client.start(False)
+		time.sleep(0.1)
+		try:
+			client.load_cache_policy(timeout=1)
+			self.assertEqual(list(client.caches), ['ping'])
+			self.assertEqual([ client.ping(1, timeout=1) for _ in range(3) ], [43]*3)
+			self.assertEqual(client.echo(1, timeout=1), 43)
+			resp_ev = client.ping(1, block=False)
+			self.assertTrue(resp_ev.is_set())
+			self.assertEqual(resp_ev.response.data, 43)
+			resp_ev = client.ping(2, block=False)
+			resp_ev.wait(1)
+			self.assertEqual(client.ping(2, timeout=1), 44)
+			self.assertEqual(requests, ['help', 'ping', 'echo', 'ping'])
+			stats = client.cache_stats()['ping']
+			self.assertEqual((stats['hits'], stats['misses']), (4, 2))
+		finally:
+			client.close()
+
+class AsyncClientTimeoutsTestCase(unittest.TestCase):
+
+	class DeafClient(AsyncClient):
+		""" Les requêtes ne sont jamais envoyées, aucune réponse ne revient. """
+		def send_multipart(self, msg):
+			pass
+
+	def setUp(self):
+		self.ctx = zmq.Context()
+
+	def tearDown(self):
+		self.client.close()
+		self.ctx.term()
+		time.sleep(0.1)
+
+	def test_stress_timeouts(self):
+		n = 100000
+		self.client = self.DeafClient("deaf", "inproc://nowhere", "service", ctx=self.ctx,
+			callback_workers=2, timer_tick=0.01)
+		self.client.start(False)
+		n_threads = threading.active_count()
+		tracemalloc.start()
+		mem_start = tracemalloc.get_traced_memory()[0]
+
+		errors = []
+		ev = threading.Event()
+		def cb(response):
+			errors.append(response.error['error'])
+			if len(errors) == n: ev.set()
+		peak_threads = n_threads
+		for i in range(n):
+			self.client.ping(i, block=False, timeout=0.5, cb_fct=cb)
+			if i % 1000 == 0:
+				peak_threads = max(peak_threads, threading.active_count())
+		while not ev.wait(0.01):
+			peak_threads = max(peak_threads, threading.active_count())
+
+		mem_end = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		self.assertEqual(errors, ['timeout']*n)
+		# seuls les threads de l'executor ont été créés
+		self.assertLessEqual(peak_threads, n_threads+2)
+		# plus rien n'est gardé pour les appels expirés
+		self.assertEqual(len(self.client._resp_events), 0)
+		self.assertEqual(len(self.client._timeouts), 0)
+		self.assertLess(mem_end-mem_start, 5*1024*1024)
+
+	def test_forget_pending(self):
+		self.client = self.DeafClient("deaf", "inproc://nowhere", "service", ctx=self.ctx,
+			pending_ttl=0.1, timer_tick=0.01)
+		self.client.start(False)
+		for i in range(100):
+			self.client.ping(i, block=False)
+		self.assertEqual(len(self.client._resp_events), 100)
+		time.sleep(0.3)
+		self.assertEqual(len(self.client._resp_events), 0)
+
+	def test_idle_no_tick(self):
+		self.client = self.DeafClient("deaf", "inproc://nowhere", "service", ctx=self.ctx,
+			pending_ttl=0, timer_tick=0.01)
+		ticks = []
+		process_timeouts = self.client._process_timeouts
+		def count_ticks():
+			ticks.append(time.time())
+			process_timeouts()
+		self.client._process_timeouts = count_ticks
+		self.client.start(False)
+		# sans appel en attente l'ioloop n'est pas réveillée
+		self.client.ping(0, block=False)
+		time.sleep(0.1)
+		self.assertEqual(ticks, [])
+		self.client.ping(1, block=False, timeout=0.05)
+		time.sleep(0.2)
+		n_ticks = len(ticks)
+		self.assertGreater(n_ticks, 0)
+		self.assertEqual(len(self.client._timeouts), 0)
+		# plus de tick une fois le timer expiré
+		time.sleep(0.1)
+		self.assertEqual(len(ticks), n_ticks)
+		self.assertIsNone(self.client._tick_handle)
+
+class EventCallbacksTestCase(unittest.TestCase):
+	PORT = 9170
+
+	def setUp(self):
+		self.ctx = zmq.Context()
+		self.publisher = self.ctx.socket(zmq.PUB)
+		self.publisher.bind("tcp://*:%s"%self.PORT)
+		self.client = Client("client", "tcp://localhost:%s"%(self.PORT+1), "service",
+			"tcp://localhost:%s"%self.PORT, ctx=self.ctx, ev_workers=2)
+		self.client.start(False)
+
+	def tearDown(self):
+		self.client.close()
+		self.publisher.close()
+		self.ctx.term()
+		time.sleep(0.1)
+
+	def publish(self, key, obj):
+		self.publisher.send_multipart([key.encode(), b"robot", json.dumps(obj).encode()])
+
+	def test_callbacks(self):
+		received = collections.defaultdict(list)
+		threads = set()
+		def cb(key, id_from, obj):
+			threads.add(threading.current_thread().name)
+			received[key].append((id_from, obj))
+		def inline_cb(key, id_from, obj):
+			received["inline"].append(obj)
+		self.client.add_callback("pos", cb)
+		self.client.add_callback("bat", cb)
+		self.client.add_callback("pos", inline_cb, inline=True)
+		time.sleep(0.2)
+		for i in range(200):
+			self.publish("pos", i)
+			self.publish("bat", -i)
+			# préfixe de "pos" sans callback
+			self.publish("posx", i)
+		time.sleep(0.5)
+		self.assertEqual(received["pos"], [ ("robot", i) for i in range(200) ])
+		self.assertEqual(received["bat"], [ ("robot", -i) for i in range(200) ])
+		self.assertEqual(received["inline"], list(range(200)))
+		self.assertNotIn("posx", received)
+		self.assertLessEqual(len(threads), 2)
+
+	def test_coalesced(self):
+		received = collections.defaultdict(list)
+		def cb(key, id_from, obj):
+			received[key].append(obj)
+		def inline_cb(key, id_from, obj):
+			received["inline"].append(obj)
+		self.client.add_callback("pos", cb)
+		self.client.add_callback("pos", inline_cb, inline=True)
+		time.sleep(0.2)
+		# events de même clé regroupés par le serveur
+		self.publisher.send_multipart([b"pos", b"robot"] + [ json.dumps(i).encode() for i in range(5) ])
+		self.publish("pos", 5)
+		time.sleep(0.3)
+		self.assertEqual(received["pos"], list(range(6)))
+		self.assertEqual(received["inline"], list(range(6)))
+
+
+if __name__ == '__main__':
+    unittest.main()
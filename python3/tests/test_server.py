@@ -16,16 +16,23 @@ class BaseServerTestCase:
 	LOG_PORT		= PORT + 3
 	EV_PULLER		= PORT + 4
 	EV_PUBLISHER	= PORT + 5
+	SERVER_KWARGS	= {}
 	
 	class BasicClient(BaseClient):
 		def _process(self, fd, _ev):
-			self.msg = fd.recv_multipart()
+			# ne bloque pas l'ioloop, qui peut appeler le handler sans message
+			while True:
+				try:
+					self.msg = fd.recv_multipart(zmq.NOBLOCK)
+				except zmq.Again:
+					break
 
 
 	def setUp(self):
 		def f():
 			server = Server("tcp://*:%s"%self.FRONTEND_PORT,"tcp://*:%s"%self.BACKEND_PORT,
-				"tcp://*:%s"%self.LOG_PORT, "tcp://*:%s"%self.EV_PULLER, "tcp://*:%s"%self.EV_PUBLISHER)
+				"tcp://*:%s"%self.LOG_PORT, "tcp://*:%s"%self.EV_PULLER, "tcp://*:%s"%self.EV_PUBLISHER,
+				**self.SERVER_KWARGS)
 			server.start()
 		self.p = multiprocessing.Process(target=f)
 		self.p.daemon = True
@@ -97,6 +104,21 @@ class ServerAndClientsTestCase(BaseServerAndClientsTestCase, unittest.TestCase):
 		self.assertEqual([client2.identity.encode(), msg_content], client1.msg)
 
 
+	def test_route_envelope(self):
+		client1 = self.client1
+		client2 = self.client2
+		header = pack_header(get_codec('json'))
+
+		# header + plusieurs frames de corps, transmis tels quels
+		client1.send_multipart([client2.identity.encode(), header, b"corps", b"\x00"*100000])
+		time.sleep(0.05)
+		self.assertEqual([client1.identity.encode(), header, b"corps", b"\x00"*100000], client2.msg)
+
+		client2.send_multipart([client1.identity.encode(), header, b"reponse"])
+		time.sleep(0.05)
+		self.assertEqual([client2.identity.encode(), header, b"reponse"], client1.msg)
+
+
 class BaseServerEventsTestCase(BaseServerAndClientsTestCase):
 
 	def setUp(self):
@@ -148,5 +170,412 @@ class ServerEventsTestCase(BaseServerEventsTestCase, unittest.TestCase):
 		msg = logger.recv_multipart()
 		self.assertEqual([client2.identity.encode(), ev_key.encode(), json.dumps(ev_obj).encode()], msg)
 
+	def test_conflate(self):
+		client1 = self.client1
+		client2 = self.client2
+		received = []
+		lags = []
+		def slow_cb(key, id_from, obj):
+			received.append(obj["seq"])
+			lags.append(time.time()-obj["t"])
+			time.sleep(0.02)
+		client1.add_callback("pos", slow_cb, conflate=True)
+		time.sleep(0.2)
+
+		# publieur 50 fois plus rapide que le callback
+		n = 500
+		for i in range(n):
+			client2.send_event("pos", {"seq": i, "t": time.time()})
+			time.sleep(0.0004)
+		time.sleep(0.2)
+
+		# le callback a sauté des valeurs mais finit sur la plus récente
+		self.assertEqual(received[-1], n-1)
+		self.assertEqual(received, sorted(received))
+		self.assertLess(len(received), n/5)
+		self.assertEqual(client1.conflated_events["pos"] + len(received), n)
+		# le retard ne s'accumule pas : au plus un callback en cours et un event en attente
+		self.assertLess(max(lags), 0.1)
+		self.assertEqual(client1._latest_events, {})
+
+	def test_batch(self):
+		received = []
+		def cb(key, id_from, obj):
+			received.append((key, id_from, obj))
+		self.client1.add_callback("pos", cb)
+		self.client1.add_callback("bat", cb)
+		time.sleep(0.2)
+		client = self.BasicClient("Client-4", "tcp://localhost:%s"%self.BACKEND_PORT,
+			ev_push_addr="tcp://localhost:%s"%self.EV_PULLER, ev_batch=10, ev_batch_delay=0.01)
+		for i in range(25):
+			client.send_event("pos", i)
+			client.send_event("bat", -i)
+		client.close()
+		time.sleep(0.2)
+		# regroupés par le serveur, dégroupés de façon transparente par le client
+		self.assertEqual([ obj for key, _, obj in received if key == "pos" ], list(range(25)))
+		self.assertEqual([ obj for key, _, obj in received if key == "bat" ], [ -i for i in range(25) ])
+		self.assertEqual(set(id_from for _, id_from, _ in received), {"Client-4"})
+		self.assertEqual(client._ev_batcher.events, 50)
+
+class ServerEventCacheTestCase(BaseServerEventsTestCase, unittest.TestCase):
+	PORT = 9010
+	FRONTEND_PORT	= PORT + 1
+	BACKEND_PORT	= PORT + 2
+	LOG_PORT		= PORT + 3
+	EV_PULLER		= PORT + 4
+	EV_PUBLISHER	= PORT + 5
+	SERVER_KWARGS	= {'ev_cache': EventCache(max_keys=10)}
+
+	def test_late_joiner(self):
+		self.client2.send_event("match.state", "running")
+		self.client2.send_event("match.score", [1, 0])
+		self.client2.send_event("other", 1)
+		time.sleep(0.2)
+		# abonnement après la publication : les dernières valeurs arrivent sans nouvel event
+		received = []
+		def cb(key, id_from, obj):
+			received.append((key, id_from, obj))
+		self.client1.add_callback("match.state", cb)
+		self.client1.add_callback("match.score", cb)
+		time.sleep(0.2)
+		self.assertEqual(sorted(received), [("match.score", "Client-2", [1, 0]),
+			("match.state", "Client-2", "running")])
+
+
+class EventCacheTestCase(unittest.TestCase):
+
+	def test_limits(self):
+		cache = EventCache(max_keys=3, max_bytes=10)
+		for i in range(5):
+			cache.put(b"k%d" % i, b"a", b"x")
+		self.assertEqual([ e[0] for e in cache.snapshot() ], [b"k2", b"k3", b"k4"])
+		# une mise à jour remplace la valeur et rafraichit la clé
+		cache.put(b"k2", b"b", b"yy")
+		self.assertEqual(cache.snapshot(b"k2"), [[b"k2", b"b", b"yy"]])
+		self.assertEqual(cache.n_bytes, 4)
+		cache.put(b"big", b"a", b"z"*9)
+		self.assertEqual([ e[0] for e in cache.snapshot() ], [b"big"])
+		self.assertEqual(cache.stats()["bytes"], 9)
+
+	def test_ttl(self):
+		cache = EventCache(ttl=0.05)
+		cache.put(b"k", b"a", b"x")
+		self.assertEqual(len(cache.snapshot()), 1)
+		time.sleep(0.1)
+		self.assertEqual(cache.snapshot(), [])
+		self.assertEqual((len(cache), cache.n_bytes), (0, 0))
+
+	def test_stats(self):
+		cache = EventCache()
+		cache.put(b"k", b"a", b"xyz")
+		self.assertEqual(cache.stats(), {'keys': 1, 'bytes': 3, 'max_keys': 1000,
+			'max_bytes': 16*2**20, 'ttl': None, 'snapshots': 0})
+
+
+class EventPublisherTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.ctx = zmq.Context()
+		self.xpub = self.ctx.socket(zmq.XPUB)
+		self.xpub.bind("inproc://events")
+		self.subs = []
+
+	def tearDown(self):
+		for sub in self.subs:
+			sub.close()
+		self.xpub.close()
+		self.ctx.term()
+
+	def subscribe(self, *prefixes):
+		sub = self.ctx.socket(zmq.SUB)
+		sub.connect("inproc://events")
+		for prefix in prefixes:
+			sub.setsockopt(zmq.SUBSCRIBE, prefix)
+		self.subs.append(sub)
+		time.sleep(0.05)
+		return sub
+
+	def publish(self, events, key, msg):
+		events.publish(zmq.Frame(b"robot"), zmq.Frame(key), zmq.Frame(msg))
+
+	def test_subscriptions(self):
+		events = EventPublisher(self.xpub)
+		sub1 = self.subscribe(b"pos")
+		sub2 = self.subscribe(b"pos", b"bat")
+		events.process_subscriptions()
+		self.assertEqual((events.subscribers(b"pos.x"), events.subscribers(b"bat"),
+			events.subscribers(b"other")), (2, 1, 0))
+		# sans abonné l'event n'est pas envoyé
+		self.publish(events, b"other", b"1")
+		self.publish(events, b"pos.x", b"2")
+		self.assertEqual(sub1.recv_multipart(), [b"pos.x", b"robot", b"2"])
+		self.assertEqual(sub2.recv_multipart(), [b"pos.x", b"robot", b"2"])
+		# les désabonnements sont comptés, y compris à la fermeture d'un abonné
+		sub1.setsockopt(zmq.UNSUBSCRIBE, b"pos")
+		sub2.close()
+		self.subs.remove(sub2)
+		# comme la boucle du serveur, le poll traite la déconnexion
+		while self.xpub.poll(200):
+			events.process_subscriptions()
+		self.assertEqual((events.subscribers(b"pos.x"), events.subscribers(b"bat")), (0, 0))
+		self.publish(events, b"pos.x", b"3")
+		stats = events.stats()
+		self.assertEqual(stats["other"]["dropped"], 1)
+		self.assertEqual((stats["pos.x"]["events"], stats["pos.x"]["bytes"],
+			stats["pos.x"]["dropped"], stats["pos.x"]["subscribers"]), (2, 2, 1, 0))
+
+	def test_batch(self):
+		events = EventPublisher(self.xpub)
+		sub = self.subscribe(b"")
+		events.process_subscriptions()
+		frames = [ zmq.Frame(f) for f in [b"pos", b"1", b"bat", b"2", b"pos", b"3", b"pos", b"4"] ]
+		events.publish_batch(zmq.Frame(b"robot"), frames)
+		# regroupés par clé, dans l'ordre
+		self.assertEqual(sub.recv_multipart(), [b"pos", b"robot", b"1", b"3", b"4"])
+		self.assertEqual(sub.recv_multipart(), [b"bat", b"robot", b"2"])
+		events.publish_batch(zmq.Frame(b"robot"), frames[:2])
+		self.assertEqual(sub.recv_multipart(), [b"pos", b"robot", b"1"])
+		stats = events.stats()
+		self.assertEqual((stats["pos"]["events"], stats["pos"]["bytes"], stats["bat"]["events"]), (4, 4, 1))
+
+	def test_rate(self):
+		events = EventPublisher(self.xpub)
+		events.RATE_PERIOD = 0.1
+		for _ in range(20):
+			self.publish(events, b"odom", b"{}")
+			time.sleep(0.01)
+		rate = events.stats()["odom"]["rate"]
+		self.assertTrue(30 < rate < 110, rate)
+
+	def test_max_keys(self):
+		events = EventPublisher(self.xpub, max_keys=10)
+		self.publish(events, b"odom", b"{}")
+		for i in range(100):
+			self.publish(events, b"key-%d" % i, b"{}")
+			if i % 5 == 0:
+				self.publish(events, b"odom", b"{}")
+		stats = events.stats()
+		# les clés publiées récemment restent
+		self.assertEqual(len(stats), 10)
+		self.assertEqual(stats["odom"]["events"], 21)
+		self.assertIn("key-99", stats)
+		self.assertNotIn("key-0", stats)
+		self.assertLessEqual(len(events._subscribers), 10)
+
+	def test_welcome(self):
+		cache = EventCache()
+		events = EventPublisher(self.xpub, cache)
+		cache.put(b"pos", b"robot", b"[1, 2]")
+		cache.put(b"battery", b"robot", b"12.1")
+		sub = self.subscribe(b"po")
+		events.process_subscriptions()
+		self.assertTrue(sub.poll(100))
+		self.assertEqual(sub.recv_multipart(), [b"pos", b"robot", b"[1, 2]"])
+		self.assertFalse(sub.poll(50))
+		self.assertEqual(cache.stats()["snapshots"], 1)
+
+
+class MirrorTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.ctx = zmq.Context()
+		self.xpub = self.ctx.socket(zmq.XPUB)
+		self.xpub.bind("inproc://mirror")
+		self.mirror = Mirror(self.xpub)
+		self.sub = self.ctx.socket(zmq.SUB)
+		self.sub.connect("inproc://mirror")
+
+	def tearDown(self):
+		self.xpub.close()
+		self.sub.close()
+		self.ctx.term()
+
+	def send(self, id_from, id_to):
+		if self.mirror.active:
+			self.mirror.send([zmq.Frame(id_from), zmq.Frame(id_to), zmq.Frame(b"corps")])
+
+	def received(self):
+		msgs = []
+		while self.sub.poll(50):
+			msgs.append(self.sub.recv_multipart()[:2])
+		return msgs
+
+	def test_subscribers(self):
+		self.mirror.process_subscriptions()
+		self.assertFalse(self.mirror.active)
+		self.sub.setsockopt(zmq.SUBSCRIBE, b"")
+		time.sleep(0.05)
+		self.mirror.process_subscriptions()
+		self.assertTrue(self.mirror.active)
+		self.sub.setsockopt(zmq.UNSUBSCRIBE, b"")
+		time.sleep(0.05)
+		self.mirror.process_subscriptions()
+		self.assertFalse(self.mirror.active)
+
+	def test_modes(self):
+		self.sub.setsockopt(zmq.SUBSCRIBE, b"")
+		time.sleep(0.05)
+		self.mirror.process_subscriptions()
+		for _ in range(4): self.send(b"a", b"b")
+		self.assertEqual(len(self.received()), 4)
+
+		self.mirror.configure(sample=2)
+		for _ in range(4): self.send(b"a", b"b")
+		self.assertEqual(len(self.received()), 2)
+
+		self.mirror.configure(identities=["c"])
+		self.send(b"a", b"b")
+		self.send(b"a", b"c")
+		self.send(b"c", b"b")
+		self.assertEqual(self.received(), [[b"a", b"c"], [b"c", b"b"]])
+
+		self.mirror.configure(False)
+		self.assertFalse(self.mirror.active)
+		self.send(b"a", b"b")
+		self.assertEqual(self.received(), [])
+
+class ShardedServerTestCase(unittest.TestCase):
+	PORT = 9400
+	PROCESSES = False
+
+	def setUp(self):
+		addrs = [ "tcp://*:%s" % (self.PORT+i) for i in range(5) ]
+		self.server = ShardedServer(*addrs, n_shards=3, processes=self.PROCESSES)
+		self.server.start(False)
+		self.ctx = zmq.Context()
+		self.sockets = []
+		self.logger = self.socket(zmq.SUB, 2)
+		self.logger.setsockopt(zmq.SUBSCRIBE, b"")
+		self.ev_sub = self.socket(zmq.SUB, 4)
+		self.ev_sub.setsockopt(zmq.SUBSCRIBE, b"")
+		self.service = self.socket(zmq.DEALER, 1, b"service")
+		self.client = self.socket(zmq.DEALER, 0, b"client")
+		self.ev_push = self.socket(zmq.DEALER, 3, b"pusher")
+		time.sleep(1.5 if self.PROCESSES else 0.3)
+
+	def socket(self, t, port, identity=None):
+		socket = self.ctx.socket(t)
+		if identity:
+			socket.setsockopt(zmq.IDENTITY, identity)
+		socket.connect("tcp://localhost:%s" % (self.PORT+port))
+		self.sockets.append(socket)
+		return socket
+
+	def tearDown(self):
+		self.server.close()
+		for socket in self.sockets:
+			socket.close()
+		self.ctx.term()
+		time.sleep(0.1)
+
+	def test_route(self):
+		n = 100
+		header = pack_header(get_codec('json'))
+		for i in range(n):
+			self.client.send_multipart([b"service", header, str(i).encode()])
+		received = []
+		for i in range(n):
+			msg = self.service.recv_multipart()
+			self.assertEqual(msg[:2], [b"client", header])
+			received.append(msg[2])
+			self.service.send_multipart(msg)
+		self.assertEqual(sorted(received), sorted(str(i).encode() for i in range(n)))
+		for i in range(n):
+			msg = self.client.recv_multipart()
+			self.assertEqual(msg[:2], [b"service", header])
+		# chaque message est recopié à l'aller et au retour
+		n_mirrored = 0
+		while self.logger.poll(200):
+			self.logger.recv_multipart()
+			n_mirrored += 1
+		self.assertEqual(n_mirrored, 2*n)
+
+	def test_event(self):
+		self.ev_push.send_multipart([b"yo", b"[1, 2]"])
+		self.assertTrue(self.ev_sub.poll(1000))
+		self.assertEqual(self.ev_sub.recv_multipart(), [b"yo", b"pusher", b"[1, 2]"])
+
+class ShardedServerProcessesTestCase(ShardedServerTestCase):
+	PORT = 9410
+	PROCESSES = True
+
+class ControlTestCase(unittest.TestCase):
+	PORT = 9420
+
+	def create_server(self, addrs, ctrl_addr):
+		return Server(*addrs, ctrl_bind_addr=ctrl_addr)
+
+	def setUp(self):
+		addrs = [ "tcp://*:%s" % (self.PORT+i) for i in range(5) ]
+		self.server = self.create_server(addrs, "tcp://*:%s" % (self.PORT+5))
+		self.server.start(False)
+		self.ctx = zmq.Context()
+		self.service = self.ctx.socket(zmq.DEALER)
+		self.service.setsockopt(zmq.IDENTITY, b"service")
+		self.service.connect("tcp://localhost:%s" % (self.PORT+1))
+		self.client = self.ctx.socket(zmq.DEALER)
+		self.client.setsockopt(zmq.IDENTITY, b"client")
+		self.client.connect("tcp://localhost:%s" % (self.PORT))
+		self.control = self.ctx.socket(zmq.REQ)
+		self.control.connect("tcp://localhost:%s" % (self.PORT+5))
+		time.sleep(0.3)
+
+	def tearDown(self):
+		self.server.close()
+		for socket in (self.service, self.client, self.control):
+			socket.close()
+		self.ctx.term()
+		time.sleep(0.1)
+
+	def command(self, cmd):
+		self.control.send(cmd)
+		return self.control.recv()
+
+	def test_pause_resume(self):
+		self.client.send_multipart([b"service", b"1"])
+		self.assertTrue(self.service.poll(1000))
+		self.assertEqual(self.service.recv_multipart(), [b"client", b"1"])
+
+		self.assertEqual(self.command(b"PAUSE"), b"OK")
+		self.client.send_multipart([b"service", b"2"])
+		self.assertFalse(self.service.poll(300))
+
+		self.assertEqual(self.command(b"RESUME"), b"OK")
+		self.assertTrue(self.service.poll(1000))
+		self.assertEqual(self.service.recv_multipart(), [b"client", b"2"])
+
+		self.assertEqual(self.command(b"UNKNOWN"), b"ERROR")
+
+	def test_ev_stats(self):
+		sub = self.ctx.socket(zmq.SUB)
+		sub.connect("tcp://localhost:%s" % (self.PORT+4))
+		sub.setsockopt(zmq.SUBSCRIBE, b"pos")
+		pusher = self.ctx.socket(zmq.DEALER)
+		pusher.setsockopt(zmq.IDENTITY, b"pusher")
+		pusher.connect("tcp://localhost:%s" % (self.PORT+3))
+		time.sleep(0.3)
+		pusher.send_multipart([b"pos", b"[1, 2]"])
+		pusher.send_multipart([b"battery", b"12"])
+		self.assertTrue(sub.poll(1000))
+		time.sleep(0.1)
+		stats = json.loads(self.command(b"EV_STATS"))
+		self.assertEqual(stats["pos"]["subscribers"], 1)
+		self.assertEqual(stats["battery"]["dropped"], 1)
+		sub.close()
+		pusher.close()
+
+	def test_terminate(self):
+		self.assertEqual(self.command(b"TERMINATE"), b"OK")
+		time.sleep(0.6)
+		self.client.send_multipart([b"service", b"1"])
+		self.assertFalse(self.service.poll(300))
+
+class ShardedControlTestCase(ControlTestCase):
+	PORT = 9430
+
+	def create_server(self, addrs, ctrl_addr):
+		return ShardedServer(*addrs, n_shards=2, ctrl_bind_addr=ctrl_addr)
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,8 @@
 import unittest
 
 import time
+import random
+import collections
 
 from zerobot import *
 
@@ -23,6 +25,18 @@ class _ServiceTest:
 		def sleep(self, t):
 			time.sleep(t)
 			return t
+
+		def lines(self, n):
+			for i in range(n):
+				yield i
+
+		def upper(self, data):
+			return data.upper()
+
+		@cached(ttl=10, maxsize=2)
+		def lookup(self, key):
+			self.n_lookups = getattr(self, 'n_lookups', 0)+1
+			return [key, self.n_lookups]
 	
 	PORT	= 9050
 	client_id = b"client"
@@ -49,11 +63,11 @@ class _ServiceTest:
 		self.ctx.term()
 		time.sleep(0.1)
 
-	def send_request(self, request):
-		self.socket.send_multipart([self.classexposer_id, self.client_id, request.pack()])
+	def send_request(self, request, codec=None):
+		self.socket.send_multipart([self.classexposer_id, self.client_id] + pack_msg(request, codec))
 
-	def whole_response(self, response):
-		return [self.classexposer_id, self.client_id, response.pack()]
+	def whole_response(self, response, codec=None):
+		return [self.classexposer_id, self.client_id] + pack_msg(response, codec)
 	
 	def send_ping(self):
 		request = Request("42", "hard_one", [56], {'c': 42})
@@ -71,6 +85,67 @@ class _ServiceTest:
 		response = Response("43", [56,2,42])
 		return self.whole_response(response)
 
+	def send_batch(self):
+		requests = [Request(0, "ping", [1]), Request(1, "hard_one", [], {'b': 5}), Request(2, "_protected")]
+		self.send_request(BatchRequest("46", requests), get_codec('json'))
+
+	def check_batch_response(self, msg):
+		response, codec = unpack_msg(Response, msg[2:])
+		self.assertEqual(response.uid, "46")
+		results = batch_results(response.data)
+		self.assertEqual(results[:2], [43, [1,5,3]])
+		self.assertIsInstance(results[2], ZeroBotException)
+
+	def check_cached(self):
+		results = []
+		for uid, key in enumerate(["a", "b", "a", "c", "a", "b"]):
+			self.send_request(Request(uid, "lookup", [key]))
+			response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+			results.append(response.data)
+		# maxsize=2 : "b" est retiré par "c"
+		self.assertEqual(results, [["a", 1], ["b", 2], ["a", 1], ["c", 3], ["a", 1], ["b", 4]])
+		stats = self.abc.cache_stats()['lookup']
+		self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 4, 2))
+
+	def recv_chunks(self, n):
+		chunks = []
+		for _ in range(n):
+			chunk, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+			chunks.append((chunk.seq, chunk.data, chunk.more))
+		return chunks
+
+	def check_stream(self):
+		codec = get_codec('json')
+		# générateur appelé sans stream : une seule réponse
+		self.send_request(Request("60", "lines", [3]), codec)
+		response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+		self.assertEqual(response.data, [0, 1, 2])
+		# fenêtre de 2 paquets de 3 éléments
+		self.send_request(StreamRequest("61", "lines", [10], {}, 2, 3), codec)
+		self.assertEqual(self.recv_chunks(2), [(0, [0, 1, 2], True), (1, [3, 4, 5], True)])
+		self.assertFalse(self.socket.poll(200))
+		self.send_request(StreamCredit("61", 5), codec)
+		self.assertEqual(self.recv_chunks(2), [(2, [6, 7, 8], True), (3, [9], False)])
+
+	def check_stream_cancel(self):
+		codec = get_codec('json')
+		self.send_request(StreamRequest("62", "lines", [10**9], {}, 1, 1), codec)
+		self.assertEqual(self.recv_chunks(1), [(0, [0], True)])
+		self.send_request(StreamCredit("62", 0, True), codec)
+		chunk, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+		self.assertEqual((chunk.more, chunk.error['error']), (False, "cancelled"))
+		self.send_ping()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+
+	def check_attachments(self):
+		# avec json les bytes sont envoyés dans des frames séparés
+		codec = get_codec('json')
+		self.send_request(Request("70", "upper", [b"\x00abc"]), codec)
+		msg = self.socket.recv_multipart()
+		self.assertEqual(len(msg), 5)
+		response, _codec = unpack_msg(Response, msg[2:])
+		self.assertEqual(response.data, b"\x00ABC")
+
 	def send_sleep(self, t, uuid="44"):
 		request = Request(uuid, "sleep", [t])
 		self.send_request(request)
@@ -95,6 +170,115 @@ class ServiceTestCase(_ServiceTest, unittest.TestCase):
 		msg = self.socket.recv_multipart()
 		self.assertEqual(msg, self.response_hard_one())
 
+	def test_batch(self):
+		self.send_batch()
+		self.check_batch_response(self.socket.recv_multipart())
+
+	def test_codecs(self):
+		# le service répond avec le codec de la requête
+		for name in available_codecs():
+			codec = get_codec(name)
+			self.send_request(Request("45", "ping", [1]), codec)
+			msg = self.socket.recv_multipart()
+			self.assertEqual(msg, self.whole_response(Response("45", 43), codec))
+
+	def test_arity(self):
+		# requêtes rejetées avant l'appel
+		for uid, request in enumerate([Request(0, "ping"), Request(1, "ping", [1, 2]),
+				Request(2, "hard_one", [], {'d': 1}), Request(3, "_protected"), Request(4, "unknown")]):
+			self.send_request(request)
+			response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+			self.assertEqual(int(response.uid), uid)
+			self.assertIsNotNone(response.error)
+
+	def test_help(self):
+		self.send_request(Request("47", "help", ["hard_one"]))
+		response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+		self.assertEqual(response.data['signature'], "(a=1, b=2, c=3)")
+		self.assertEqual(response.data['args'], [
+			{'name': name, 'kind': 'POSITIONAL_OR_KEYWORD', 'default': repr(default)}
+			for name, default in zip("abc", (1, 2, 3)) ])
+
+	def test_stream(self):
+		self.check_stream()
+		self.check_stream_cancel()
+
+	def test_attachments(self):
+		self.check_attachments()
+
+	def test_cached(self):
+		self.check_cached()
+		self.send_request(Request("50", "help", ["lookup"]))
+		response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+		self.assertEqual(response.data['cached'], {'ttl': 10, 'maxsize': 2})
+
+	def test_refresh(self):
+		self.abc.exposed_obj.double = lambda x: 2*x
+		self.send_request(Request("48", "double", [2]))
+		response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+		self.assertIsNotNone(response.error)
+		self.abc.refresh()
+		self.send_request(Request("49", "double", [2]))
+		msg = self.socket.recv_multipart()
+		self.assertEqual(msg, self.whole_response(Response("49", 4)))
+
+
+class DispatchTableTestCase(unittest.TestCase):
+
+	class Abc:
+		def f(self, a, b=2, *args, c, d=4, **kwargs):
+			""" Doc de f """
+			return a, b, args, c, d, kwargs
+
+		def g(self, a, /, b):
+			return a, b
+
+		@property
+		def prop(self):
+			raise Exception("property evaluated")
+
+		def _protected(self):
+			pass
+
+	def setUp(self):
+		self.table = DispatchTable(self.Abc(), {'help': lambda f=None: None})
+
+	def test_lookup(self):
+		self.assertEqual(sorted(self.table.methods), ['f', 'g', 'help'])
+		self.assertRaises(Exception, self.table.__getitem__, '_protected')
+		self.assertRaises(Exception, self.table.__getitem__, 'prop')
+		self.assertRaises(Exception, self.table.__getitem__, 'unknown')
+
+	def test_check(self):
+		f, g = self.table['f'], self.table['g']
+		for args, kwargs in [([1], {'c': 3}), ([1, 2, 3, 4], {'c': 3, 'z': 0}), ([], {'a': 1, 'c': 3})]:
+			f.check(args, kwargs)
+			f.check(args, kwargs) # depuis le cache
+		for args, kwargs in [([1], {}), ([], {'c': 3}), ([1], {'a': 1, 'c': 3})]:
+			self.assertRaises(Exception, f.check, args, kwargs)
+		g.check([1, 2], {})
+		g.check([1], {'b': 2})
+		for args, kwargs in [([1], {}), ([1, 2, 3], {}), ([], {'a': 1, 'b': 2})]:
+			self.assertRaises(Exception, g.check, args, kwargs)
+
+	def test_help(self):
+		help = self.table.help()
+		self.assertEqual(help['f']['doc'], "Doc de f")
+		self.assertEqual(help['f']['signature'], "(a, b=2, *args, c, d=4, **kwargs)")
+		self.assertEqual([ arg['kind'] for arg in help['g']['args'] ], ['POSITIONAL_ONLY', 'POSITIONAL_OR_KEYWORD'])
+		self.assertEqual(self.table.help('f'), help['f'])
+		self.assertRaises(Exception, self.table.help, 'unknown')
+
+
+class FixedAutoscaler(Autoscaler):
+	""" Garde le nombre de workers, ou le met à *target* s'il est précisé. """
+	def __init__(self, target=None):
+		super(FixedAutoscaler, self).__init__(interval=0)
+		self.target = target
+
+	def _decide(self, now, n_workers, n_busy, n_queued, min_workers, max_workers):
+		return n_workers if self.target is None else self.target
+
 
 class AsyncServiceTestCase(_ServiceTest, unittest.TestCase):
 	KLASS = AsyncService
@@ -111,14 +295,266 @@ class AsyncServiceTestCase(_ServiceTest, unittest.TestCase):
 		msg = self.socket.recv_multipart()
 		self.assertEqual(msg, self.response_sleep(0.1))
 
+	def test_batch(self):
+		self.send_batch()
+		self.check_batch_response(self.socket.recv_multipart())
+
+	def test_attachments(self):
+		self.check_attachments()
+
+	def test_cached(self):
+		# les workers partagent le cache
+		self.check_cached()
+
+	def test_stream(self):
+		self.check_stream()
+		self.check_stream_cancel()
+		# les workers des streams sont libérés
+		self.assertEqual((len(self.abc._free_workers), self.abc._stream_workers), (5, {}))
+
 	def test_grow_workers(self):
 		self.abc.dynamic_workers = True
+		self.abc.autoscaler = DoublingAutoscaler()
 		current_n_workers = len(self.abc._workers)
 		# send pleins de sleeps
 		for i in range(current_n_workers*4): self.send_sleep(0.3, "sleep-%s"%i)
-		time.sleep(0.05)
-		# on voit si le nombre de workers à augmenté
+		# on voit si le nombre de workers à augmenté, avant la fin des sleeps
+		start = time.time()
+		while len(self.abc._workers) < current_n_workers*4 and time.time()-start < 0.25:
+			time.sleep(0.01)
 		self.assertGreaterEqual(len(self.abc._workers), current_n_workers*4)
+
+	def test_grow_on_tick(self):
+		autoscaler = FixedAutoscaler()
+		self.abc.autoscaler = autoscaler
+		self.abc.dynamic_workers = True
+		start = time.time()
+		for i in range(10): self.send_sleep(1, "sleep-%s"%i)
+		time.sleep(0.05)
+		# les workers ajoutés par l'échantillonnage prennent les requêtes en attente
+		autoscaler.target = 10
+		for _ in range(10): self.socket.recv_multipart()
+		self.assertLess(time.time()-start, 1.8)
+		self.assertEqual(len(self.abc._workers), 10)
+
+	def test_shrink_workers(self):
+		workers = dict(self.abc._workers)
+		self.abc.min_workers = 2
+		self.abc.autoscaler = FixedAutoscaler(2)
+		self.abc.dynamic_workers = True
+		self.send_ping()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+		time.sleep(0.3)
+		self.assertEqual(len(self.abc._workers), 2)
+		# les workers retirés sont fermés, hors de la boucle de routage
+		for t in self.abc._retiring: t.join(2)
+		retired = [ worker for worker_id, worker in workers.items() if worker_id not in self.abc._workers ]
+		self.assertEqual(len(retired), 3)
+		self.assertTrue(all(worker.socket.closed for worker in retired))
+
+	def test_grow_ungrow(self):
+		self.abc.max_workers = 8
+		self.abc.grow()
+		self.assertEqual(len(self.abc._workers), 8)
+		start = time.time()
+		self.abc.ungrow()
+		# la fermeture des workers ne bloque pas l'appelant
+		self.assertLess(time.time()-start, 0.05)
+		self.assertEqual(len(self.abc._workers), 5)
+		self.assertEqual(len(self.abc._free_workers), 5)
+		for t in self.abc._retiring: t.join(2)
+		self.send_ping()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+
+	def test_concurrency_limit(self):
+		self.abc.concurrency_limits = {'sleep': 1}
+		for i in range(3): self.send_sleep(0.1, "sleep-%s"%i)
+		self.send_ping()
+		# le ping n'attend pas derrière les sleeps
+		start = time.time()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+		# les sleeps sont exécutés un par un, dans l'ordre
+		for i in range(3):
+			self.assertEqual(self.socket.recv_multipart(), self.response_sleep(0.1, "sleep-%s"%i))
+		self.assertGreaterEqual(time.time()-start, 0.3)
+		self.assertEqual(self.abc._running['sleep'], 0)
+
+	def test_priorities(self):
+		self.abc.priorities = {'hard_one': 0}
+		self.abc.concurrency_limits = {'sleep': 1}
+		self.abc._running['sleep'] = 1
+		def enqueue(request):
+			self.abc._enqueue([ zmq.Frame(f) for f in [self.client_id] + pack_msg(request) ])
+		enqueue(Request("44", "sleep", [0.1]))
+		enqueue(Request("45", "ping", [1]))
+		enqueue(Request("42", "hard_one", [56]))
+		enqueue(Request("46", "ping", [2]))
+		# hard_one passe en premier, le sleep attend que sa limite le permette
+		fcts = []
+		item = self.abc._next_request()
+		while item is not None:
+			fcts.append(item[0])
+			item = self.abc._next_request()
+		self.assertEqual(fcts, ['hard_one', 'ping', 'ping'])
+		self.abc._running['sleep'] = 0
+		self.assertEqual(self.abc._next_request()[0], 'sleep')
+		self.assertEqual(self.abc._n_queued, 0)
+
+	def test_bookkeeping_bounded(self):
+		self.abc.priorities = {'hard_one': 0}
+		self.abc.concurrency_limits = {'sleep': 1}
+		# méthodes inconnues : une erreur chacune, rien n'est gardé ensuite
+		for i in range(100):
+			self.send_request(Request("unknown-%s"%i, "unknown_%s"%i, []))
+		for i in range(100):
+			response, _codec = unpack_msg(Response, self.socket.recv_multipart()[2:])
+			self.assertTrue(response.error)
+		self.send_ping()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+		self.assertEqual(self.abc._queues, {})
+		self.assertEqual(dict(self.abc._running), {})
+		self.assertEqual(self.abc._worker_fct, {})
+		self.assertEqual(len(self.abc._free_workers), 5)
+
+	def test_unexpected_worker_message(self):
+		worker_id = self.abc._free_workers[0]
+		msg = [ zmq.Frame(f) for f in [worker_id.encode(), self.client_id] + pack_msg(Response("42", 1)) ]
+		self.abc._backend_process_msg(msg)
+		# un worker libre n'est ni libéré deux fois ni décompté
+		self.assertEqual(len(self.abc._free_workers), 5)
+		self.assertEqual(dict(self.abc._running), {})
+
+class ProcessPoolServiceTestCase(_ServiceTest, unittest.TestCase):
+	KLASS = ProcessPoolService
+
+	def setUp(self):
+		super(ProcessPoolServiceTestCase, self).setUp()
+		self.wait_workers(5)
+
+	def wait_workers(self, n, timeout=20):
+		# les processus doivent démarrer et s'annoncer
+		start = time.time()
+		while len(self.abc._free_workers) < n and time.time()-start < timeout:
+			time.sleep(0.05)
+		self.assertEqual(len(self.abc._free_workers), n)
+
+	def test_basic(self):
+		self.send_sleep(0.1)
+		self.send_ping()
+		self.assertEqual(self.socket.recv_multipart(), self.response_ping())
+		self.assertEqual(self.socket.recv_multipart(), self.response_sleep(0.1))
+
+	def test_batch(self):
+		self.send_batch()
+		self.check_batch_response(self.socket.recv_multipart())
+
+	def test_stream(self):
+		self.check_stream()
+		self.check_stream_cancel()
+
+	def test_factory(self):
+		identity = b"factory"
+		abc = ProcessPoolService(identity.decode(), "tcp://localhost:%s"%self.PORT,
+			factory=self.Abc, init_workers=1)
+		abc.start(False)
+		try:
+			start = time.time()
+			while not abc._free_workers and time.time()-start < 20:
+				time.sleep(0.05)
+			self.socket.send_multipart([identity, self.client_id] + pack_msg(Request("45", "ping", [1])))
+			msg = self.socket.recv_multipart()
+			self.assertEqual(msg, [identity, self.client_id] + pack_msg(Response("45", 43)))
+		finally:
+			abc.close()
+
+	def test_grow_workers(self):
+		self.abc.dynamic_workers = True
+		self.abc.autoscaler = DoublingAutoscaler()
+		for i in range(8): self.send_sleep(0.3, "sleep-%s"%i)
+		uids = sorted( unpack_msg(Response, self.socket.recv_multipart()[2:])[0].uid for _ in range(8) )
+		self.assertEqual(uids, sorted("sleep-%s"%i for i in range(8)))
+		self.assertEqual(len(self.abc._workers), 10)
 		
+class AutoscalerTestCase(unittest.TestCase):
+	"""
+	Rejoue une charge en rafales sur un pool de workers simulé : des pics de
+	2 à 4s entre 100 et 300 req/s séparés de 5 à 20s à 10 req/s, chaque
+	requête dure 0.1s et un worker ajouté est prêt après STARTUP secondes.
+	"""
+	DT = 0.01
+	DURATION = 300
+	STARTUP = 0.2
+
+	def trace(self):
+		rnd = random.Random(42)
+		arrivals = []
+		t = 0
+		while t < self.DURATION:
+			end, rate = t+rnd.uniform(2, 4), rnd.uniform(100, 300)
+			while t < end:
+				t += rnd.expovariate(rate)
+				arrivals.append(t)
+			end = t+rnd.uniform(5, 20)
+			while t < end:
+				t += rnd.expovariate(10)
+				arrivals.append(t)
+		return arrivals
+
+	def replay(self, autoscaler, min_workers=5, max_workers=50):
+		pending = collections.deque(self.trace())
+		queue = collections.deque()
+		busy = []			# fin des requêtes en cours
+		starting = []		# démarrage des workers ajoutés
+		n_workers = min_workers
+		latencies = []
+		n_received = 0
+		now = 0
+		while pending or queue or busy:
+			now += self.DT
+			while pending and pending[0] <= now:
+				queue.append(pending.popleft())
+				n_received += 1
+			for end in [ end for end in busy if end <= now ]:
+				busy.remove(end)
+				autoscaler.request_done(0.1)
+			starting = [ ready for ready in starting if ready > now ]
+			while queue and len(busy)+len(starting) < n_workers:
+				arrival = queue.popleft()
+				busy.append(now+0.1)
+				latencies.append(now+0.1-arrival)
+			n_busy = len(busy)+len(starting)
+			target = autoscaler.update(now, n_workers, n_busy, len(queue),
+				n_received, min_workers, max_workers)
+			if target > n_workers:
+				starting += [now+self.STARTUP]*(target-n_workers)
+				n_workers = target
+			elif target < n_workers:
+				# seuls les workers libres peuvent être retirés
+				n_workers = max(target, n_busy)
+		latencies.sort()
+		return latencies[int(len(latencies)*0.99)], autoscaler.n_grows+autoscaler.n_shrinks
+
+	def test_replay(self):
+		p99_doubling, events_doubling = self.replay(DoublingAutoscaler())
+		p99, events = self.replay(Autoscaler())
+		self.assertLess(events, events_doubling)
+		self.assertLess(p99, p99_doubling)
+
+	def test_bounds(self):
+		autoscaler = Autoscaler(interval=0, down_cooldown=10)
+		# saturé : palier de up_step workers, puis attente de up_cooldown
+		self.assertEqual(autoscaler.update(0, 5, 5, 1000, 1000, 5, 50), 21)
+		self.assertEqual(autoscaler.update(0.05, 21, 21, 1000, 2000, 5, 50), 21)
+		self.assertEqual(autoscaler.update(1, 21, 21, 1000, 3000, 5, 50), 37)
+		self.assertEqual(autoscaler.update(2, 37, 37, 1000, 4000, 5, 50), 50)
+		# inactif : retrait de down_step workers après down_cooldown
+		for now in range(3, 12):
+			self.assertEqual(autoscaler.update(now, 50, 0, 0, 4000, 5, 50), 50)
+		self.assertEqual(autoscaler.update(40, 50, 0, 0, 4000, 5, 50), 48)
+		self.assertEqual(autoscaler.update(41, 48, 0, 0, 4000, 5, 50), 48)
+		metrics = autoscaler.metrics()
+		self.assertEqual((metrics['grows'], metrics['shrinks']), (3, 1))
+		self.assertEqual(metrics['decisions'][-1], (40, 50, 48))
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,7 @@
 import unittest
 
 import time
+import threading
 
 from zerobot import *
 
@@ -45,5 +46,301 @@ class ResponseTestCase(unittest.TestCase):
 		unpack = Response.unpack(pack)
 		self.assertEqual(self.r, unpack)
 
+class CodecTestCase(unittest.TestCase):
+	def setUp(self):
+		self.request = Request(42, 'fct_test', [1,2,3], {'a': [1.5, 'b', None]})
+		self.response = Response(42, {'a': 1, 'b': [1,2,'hey']}, None)
+
+	def test_pack_unpack(self):
+		for name in available_codecs():
+			codec = get_codec(name)
+			self.assertEqual(self.request, Request.unpack(self.request.pack(codec), codec))
+			self.assertEqual(self.response, Response.unpack(self.response.pack(codec), codec))
+
+	def test_header(self):
+		for name in available_codecs():
+			codec = get_codec(name)
+			self.assertEqual(unpack_header(pack_header(codec)), (codec, 0))
+		self.assertRaises(ZeroBotProtocolError, unpack_header, b'{"uid"')
+
+	def test_msg(self):
+		request = Request("c6b82091", 'fct_test', [1,2,3])
+		frames = pack_msg(request)
+		self.assertEqual(frames, [request.pack()])
+		self.assertEqual(unpack_msg(Request, frames), (request, None))
+		for name in available_codecs():
+			codec = get_codec(name)
+			frames = pack_msg(self.request, codec)
+			self.assertEqual(len(frames), 2)
+			self.assertEqual(unpack_msg(Request, frames), (self.request, codec))
+			frames = pack_msg(request, codec)
+			self.assertEqual(unpack_msg(Request, frames), (request, codec))
+
+class UidTestCase(unittest.TestCase):
+	def test_generator(self):
+		uids = UidGenerator()
+		self.assertEqual([uids.next() for _ in range(3)], [1,2,3])
+		uids = UidGenerator(0xabcd)
+		uid = uids.next()
+		self.assertEqual(uid >> UidGenerator.COUNTER_BITS, 0xabcd)
+		self.assertTrue(is_binary_uid(uid))
+		self.assertRaises(ValueError, UidGenerator, 2**16)
+
+	def test_binary_uid(self):
+		codec = get_codec('json')
+		response = Response(2**63+5, [1,2], None)
+		header, body = pack_msg(response, codec)
+		self.assertEqual(len(header), 13)
+		self.assertNotIn(b'uid', body)
+		self.assertEqual(unpack_header(header), (codec, FLAG_UID))
+		self.assertEqual(unpack_msg(Response, [header, body]), (response, codec))
+
+	def test_legacy_uid(self):
+		# ancien format : l'uid entier est envoyé en chaîne et renvoyé tel quel
+		frames = pack_msg(Request(42, 'ping', [1]))
+		self.assertEqual(json.loads(frames[0])['uid'], LEGACY_UID_PREFIX+"42")
+		request, _codec = unpack_msg(Request, frames)
+		self.assertEqual(request.uid, 42)
+		response, _codec = unpack_msg(Response, pack_msg(Response(request.uid, 43)))
+		self.assertEqual(response.uid, 42)
+		# les uids chaînes de l'appelant ne sont pas confondus avec les uids générés
+		for uid in ("42", "c6b82091-0000", "#abc"):
+			request, _codec = unpack_msg(Request, pack_msg(Request(uid, 'ping', [1])))
+			self.assertEqual(request.uid, uid)
+
+class BatchRequestTestCase(unittest.TestCase):
+	def test_pack_unpack(self):
+		batch = BatchRequest(42, [Request(0, 'ping', [1]), Request(1, 'test', [], {'a': 1})])
+		codec = get_codec('json')
+		self.assertRaises(ValueError, pack_msg, batch)
+		unpack, _codec = unpack_msg(Request, pack_msg(batch, codec))
+		self.assertIsInstance(unpack, BatchRequest)
+		self.assertEqual(batch, unpack)
+
+	def test_results(self):
+		results = batch_results([[43, None], [None, {'error': 'oups', 'tb': ''}]])
+		self.assertEqual(results[0], 43)
+		self.assertIsInstance(results[1], ZeroBotException)
+
+
+class StreamTestCase(unittest.TestCase):
+	def test_pack_unpack(self):
+		codec = get_codec('json')
+		request, _codec = unpack_msg(Request, pack_msg(StreamRequest(1, "lines", [2], {}, 8, 50), codec))
+		self.assertIsInstance(request, StreamRequest)
+		self.assertEqual((request.uid, request.fct, request.window, request.chunk_size), (1, "lines", 8, 50))
+		credit, _codec = unpack_msg(Request, pack_msg(StreamCredit("a", 3), codec))
+		self.assertEqual((credit.uid, credit.credit, credit.cancel), ("a", 3, False))
+		for more in (True, False):
+			chunk, _codec = unpack_msg(Response, pack_msg(StreamChunk(2, [1, 2], None, 5, more), codec))
+			self.assertIsInstance(chunk, StreamChunk)
+			self.assertEqual((chunk.uid, chunk.data, chunk.seq, chunk.more), (2, [1, 2], 5, more))
+		# les streams ont besoin du header
+		self.assertRaises(ValueError, pack_msg, StreamCredit(1), None)
+
+
+class AttachmentsTestCase(unittest.TestCase):
+	def test_bytes(self):
+		request = Request(1, "f", [b"\x00\x01", memoryview(b"ab")], {"x": bytearray(b"c")})
+		# json ne sait pas encoder les bytes : un frame par pièce jointe
+		frames = pack_msg(request, get_codec('json'))
+		self.assertEqual(len(frames), 5)
+		self.assertTrue(unpack_header(frames[0])[1] & FLAG_FRAMES)
+		request, _codec = unpack_msg(Request, [ bytes(frame) for frame in frames ])
+		self.assertEqual(request.args[0], b"\x00\x01")
+		self.assertIsInstance(request.args[1], memoryview)
+		self.assertEqual(bytes(request.args[1]), b"ab")
+		self.assertEqual(request.kwargs, {"x": b"c"})
+		# msgpack les garde dans le corps
+		if msgpack is not None:
+			self.assertEqual(len(pack_msg(request, get_codec('msgpack'))), 2)
+		# l'ancien format n'a pas de header
+		self.assertRaises(TypeError, pack_msg, Request(1, "f", [b"a"]))
+
+	@unittest.skipIf(numpy is None, "numpy is not installed")
+	def test_numpy(self):
+		a = numpy.arange(12, dtype='<f4').reshape(3, 4)
+		for name in available_codecs():
+			codec = get_codec(name)
+			# tableau non contigu
+			frames = pack_msg(Response(2, {"a": a, "col": a[:, 1]}), codec)
+			self.assertEqual(len(frames), 4)
+			response, _codec = unpack_msg(Response, [ bytes(frame) for frame in frames ])
+			self.assertEqual(response.data["a"].shape, (3, 4))
+			self.assertEqual(response.data["a"].dtype, a.dtype)
+			self.assertTrue((response.data["a"] == a).all())
+			self.assertEqual(response.data["col"].tolist(), [1., 5., 9.])
+			self.assertFalse(response.data["a"].flags.writeable)
+
+	def test_recv_msg(self):
+		ctx = zmq.Context()
+		a, b = ctx.socket(zmq.PAIR), ctx.socket(zmq.PAIR)
+		a.bind("inproc://attachments")
+		b.connect("inproc://attachments")
+		a.send_multipart([b"h", b"b", b"x", b"y"])
+		msg = recv_msg(b, n_copied=2)
+		self.assertEqual(msg[:2], [b"h", b"b"])
+		self.assertIsInstance(msg[2], zmq.Frame)
+		self.assertEqual(msg[3].bytes, b"y")
+		a.close()
+		b.close()
+		ctx.term()
+
+
+class TimerWheelTestCase(unittest.TestCase):
+	def test_expire(self):
+		wheel = TimerWheel(tick=0.1, n_slots=8)
+		now = time.time()
+		wheel.add("a", 0.5, 1, now=now)
+		wheel.add("b", 2, 2, now=now)
+		wheel.add("c", 0.5, 3, now=now)
+		wheel.remove("c")
+		self.assertEqual(len(wheel), 2)
+		self.assertEqual(wheel.expire(now+0.3), [])
+		self.assertEqual(wheel.expire(now+0.7), [("a", 1)])
+		# "b" est à plus d'un tour de roue, il ne doit pas expirer trop tôt
+		self.assertEqual(wheel.expire(now+1.5), [])
+		self.assertEqual(wheel.expire(now+5), [("b", 2)])
+		self.assertEqual(len(wheel), 0)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+	def test_lru(self):
+		cache = ResultCache(maxsize=2)
+		keys = [ cache.key([i], {'b': 1, 'a': 2}) for i in range(3) ]
+		self.assertEqual(keys[0], cache.key([0], {'a': 2, 'b': 1}))
+		self.assertIsNone(cache.key([object()], {}))
+		cache.put(keys[0], 0)
+		cache.put(keys[1], 1)
+		self.assertEqual(cache.get(keys[0]), 0)
+		# keys[1] est le moins récemment utilisé
+		cache.put(keys[2], 2)
+		self.assertIs(cache.get(keys[1]), ResultCache.MISSING)
+		self.assertEqual((cache.get(keys[0]), cache.get(keys[2])), (0, 2))
+		self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 1, 2))
+
+	def test_ttl(self):
+		cache = ResultCache(ttl=0.05)
+		cache.put("a", 1)
+		self.assertEqual(cache.get("a"), 1)
+		time.sleep(0.1)
+		self.assertIs(cache.get("a"), ResultCache.MISSING)
+		self.assertEqual(len(cache), 0)
+
+
+class CallbackExecutorTestCase(unittest.TestCase):
+	def test_bounded_threads(self):
+		executor = CallbackExecutor(max_workers=3, max_queue=100)
+		n_threads = threading.active_count()
+		results = []
+		for i in range(100):
+			executor.submit(results.append, i)
+		executor.shutdown()
+		time.sleep(0.1)
+		self.assertEqual(sorted(results), list(range(100)))
+		self.assertEqual(threading.active_count(), n_threads)
+
+	def test_response_event(self):
+		executor = CallbackExecutor(max_workers=1)
+		# sans callback la réponse est disponible immédiatement
+		resp_ev = ResponseEvent(executor=executor)
+		resp_ev.set(Response(1, 42))
+		self.assertTrue(resp_ev.is_set())
+		# avec callback, l'event est levé après l'appel du callback
+		results = []
+		resp_ev = ResponseEvent(results.append, executor)
+		resp_ev.set(Response(2, 43))
+		resp_ev.wait(1)
+		self.assertEqual(results, [resp_ev.response])
+		executor.shutdown()
+
+	def test_ordered(self):
+		executor = CallbackExecutor(max_workers=4, max_queue=50)
+		results = {"a": [], "b": []}
+		def f(key, i):
+			time.sleep(0.001)
+			results[key].append(i)
+		for i in range(50):
+			executor.submit_ordered("a", f, "a", i)
+			executor.submit_ordered("b", f, "b", i)
+		executor.shutdown()
+		time.sleep(0.2)
+		self.assertEqual(results, {"a": list(range(50)), "b": list(range(50))})
+		self.assertEqual(executor._ordered, {})
+
+	def test_full(self):
+		executor = CallbackExecutor(max_workers=1, max_queue=2)
+		gate = threading.Event()
+		results = []
+		def f(i):
+			gate.wait(1)
+			results.append(i)
+		# file pleine : submit ne bloque pas (il est appelé par l'ioloop), l'appel est abandonné
+		start = time.time()
+		self.assertTrue(executor.submit(f, 0))
+		time.sleep(0.05)
+		# 2 appels en attente au plus derrière celui en cours pour une clé
+		self.assertEqual([ executor.submit_ordered("a", f, i) for i in range(1, 5) ], [True, True, True, False])
+		self.assertEqual([ executor.submit(f, i) for i in range(5, 7) ], [True, False])
+		self.assertEqual(executor.submit_ordered("b", f, 7), False)
+		self.assertLess(time.time()-start, 0.5)
+		self.assertEqual(executor.dropped, 3)
+		self.assertNotIn("b", executor._ordered)
+		# sans callback exécuté, la réponse reste disponible pour un appel bloquant
+		resp_ev = ResponseEvent(results.append, executor)
+		resp_ev.set(Response(1, 42))
+		self.assertTrue(resp_ev.is_set())
+		self.assertEqual(executor.dropped, 4)
+		gate.set()
+		executor.shutdown()
+		time.sleep(0.1)
+		self.assertEqual(results, [0, 1, 2, 3, 5])
+
+
+class EventTestCase(unittest.TestCase):
+	def test_lazy_obj(self):
+		event = Event("pos", "robot", b'{"x": 1}')
+		self.assertIs(event._obj, Event._NOT_DECODED)
+		self.assertEqual(event.obj, {"x": 1})
+		self.assertIs(event.obj, event.obj)
+
+
+class EventBatcherTestCase(unittest.TestCase):
+	def setUp(self):
+		self.ctx = zmq.Context()
+		self.pull = self.ctx.socket(zmq.PULL)
+		self.pull.bind("inproc://batch")
+		self.push = self.ctx.socket(zmq.PUSH)
+		self.push.connect("inproc://batch")
+
+	def tearDown(self):
+		self.push.close()
+		self.pull.close()
+		self.ctx.term()
+
+	def test_max_events(self):
+		batcher = EventBatcher(self.push, max_events=3, max_delay=10)
+		for i in range(7):
+			batcher.add(b"pos", str(i).encode())
+		self.assertTrue(self.pull.poll(1000))
+		self.assertEqual(self.pull.recv_multipart(), [b"pos", b"0", b"pos", b"1", b"pos", b"2"])
+		self.assertTrue(self.pull.poll(1000))
+		self.assertEqual(len(self.pull.recv_multipart()), 6)
+		# close envoie le reste
+		batcher.close()
+		self.assertEqual(self.pull.recv_multipart(), [b"pos", b"6"])
+		self.assertEqual((batcher.batches, batcher.events), (3, 7))
+		self.assertRaises(Exception, batcher.add, b"pos", b"7")
+
+	def test_max_delay(self):
+		batcher = EventBatcher(self.push, max_events=100, max_delay=0.05)
+		start = time.time()
+		batcher.add(b"pos", b"0")
+		batcher.add(b"bat", b"1")
+		self.assertTrue(self.pull.poll(1000))
+		self.assertEqual(self.pull.recv_multipart(), [b"pos", b"0", b"bat", b"1"])
+		self.assertGreaterEqual(time.time()-start, 0.04)
+		batcher.close()
+
 if __name__ == '__main__':
     unittest.main()
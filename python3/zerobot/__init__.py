@@ -4,6 +4,7 @@ from .core import *
 from .server import *
 from .service import *
 from .client import *
+from .channel import *
 from .proxy import *
 from .ioadapter import *
 from .ioadapters import *
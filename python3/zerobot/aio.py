@@ -0,0 +1,538 @@
+"""
+Clients et services utilisant asyncio (via :mod:`zmq.asyncio`) à la place
+de l'ioloop et des threads. Ce module n'est pas importé par :mod:`zerobot`,
+il faut l'importer explicitement (``from zerobot.aio import AsyncioClient``).
+"""
+
+import types
+import asyncio
+import functools
+import itertools
+import traceback
+import collections
+import collections.abc
+import concurrent.futures
+import zmq
+import zmq.asyncio
+
+from .core import *
+from .service import DispatchTable, _stream_items
+from .client import Stream
+
+
+async def _recv_msg(socket, n_copied=3):
+	""" Équivalent asyncio de :func:`zerobot.recv_msg`. """
+	msg = await socket.recv_multipart(copy=False)
+	return [ frame.bytes for frame in msg[:n_copied] ] + msg[n_copied:]
+
+
+class AsyncioStream(Stream):
+	"""
+	Itérateur asynchrone sur les éléments renvoyés par une méthode appelée
+	avec ``stream=True`` par un :class:`AsyncioClient`, voir
+	:class:`zerobot.client.Stream`::
+
+		async with client.logs(since, stream=True) as lines:
+			async for line in lines:
+				print(line)
+
+	La requête est envoyée à la première itération.
+	"""
+	def __init__(self, client, request, timeout=None):
+		self.client = client
+		self.request = request
+		self.timeout = timeout
+		self._key = request.uid
+		self._chunks = None
+		self._items = collections.deque()
+		self._done = False
+		self._consumed = 0
+		self._init_seq()
+
+	def _put(self, chunk):
+		self._chunks.put_nowait(chunk)
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		if self._chunks is None:
+			self._chunks = asyncio.Queue()
+			self.client.start()
+			self.client._streams[self._key] = self
+			await self.client.socket.send_multipart([self.client._remote_id] + pack_msg(self.request, self.client.codec), copy=False)
+		while not self._items:
+			if self._done:
+				raise StopAsyncIteration
+			try:
+				chunk = await asyncio.wait_for(self._chunks.get(), self.timeout)
+			except asyncio.TimeoutError:
+				self.close()
+				raise ZeroBotTimeout("Timeout")
+			self._accept(chunk)
+		return self._items.popleft()
+
+	def close(self):
+		if self._chunks is None:
+			self._done = True
+		Stream.close(self)
+
+	async def aclose(self):
+		self.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, tb):
+		self.close()
+
+
+class AsyncioClient:
+	"""
+	Permet d'appeler un service depuis une boucle asyncio, chaque appel
+	distant renvoie une coroutine::
+
+		client = AsyncioClient('monClient', 'tcp://localhost:5000', 'monService')
+		r = await client.ping(42)
+		r = await client.sleep(3, timeout=1)
+		# raise ZeroBotTimeout
+
+	Les réponses sont reçues par une seule tâche qui résout directement les
+	futures des appels en attente, les timeouts utilisent les timers de la
+	boucle : un appel en cours ne coûte aucun thread.
+
+	*identity* identité du client
+
+	*conn_addr* adresse du frontend du serveur
+
+	*remote_id* identité du service distant
+
+	*ctx* zmq context (:class:`zmq.asyncio.Context` ou context classique)
+
+	*codec* codec des requêtes, voir :class:`zerobot.core.BaseClient`
+
+	*uid_nonce* préfixe de session des uids, voir :class:`zerobot.core.UidGenerator`
+
+	*stream_window*, *stream_chunk_size* paramètres des appels avec
+	``stream=True`` qui renvoient un :class:`AsyncioStream`
+	"""
+	def __init__(self, identity, conn_addr, remote_id, *, ctx=None, codec='json', uid_nonce=None,
+			stream_window=4, stream_chunk_size=100):
+		if ctx is None:
+			ctx = zmq.asyncio.Context()
+			self._ctx_is_mine = True
+		else:
+			if not isinstance(ctx, zmq.asyncio.Context):
+				ctx = zmq.asyncio.Context.shadow(ctx)
+			self._ctx_is_mine = False
+		self.ctx = ctx
+		self.identity = identity
+		self.conn_addr = conn_addr
+		self.remote_id = remote_id
+		self.codec = get_codec(codec) if codec is not None else None
+		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
+		self.socket = self.ctx.socket(zmq.DEALER)
+		self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
+		self.socket.connect(conn_addr)
+		self._remote_id = remote_id.encode()
+		self._uids = UidGenerator(uid_nonce)
+		self.stream_window = stream_window
+		self.stream_chunk_size = stream_chunk_size
+		self._pending = {}
+		self._streams = {}
+		self._recv_task = None
+
+	def start(self):
+		"""
+		Lance la tâche de réception des réponses, doit être appelée depuis
+		la boucle asyncio. Elle est appelée automatiquement au premier appel.
+		"""
+		if self._recv_task is None:
+			self._recv_task = asyncio.ensure_future(self._recv_loop())
+
+	def close(self):
+		if self._recv_task is not None:
+			self._recv_task.cancel()
+			self._recv_task = None
+		for fut in self._pending.values():
+			if not fut.done():
+				fut.cancel()
+		self._pending.clear()
+		self.socket.close()
+		if self._ctx_is_mine:
+			self.ctx.term()
+
+	async def _recv_loop(self):
+		while True:
+			msg = await _recv_msg(self.socket)
+			try:
+				response, _codec = unpack_msg(Response, msg[1:])
+			except Exception as ex:
+				self.logger.error("invalid response %s : %s", msg, ex)
+				continue
+			self._process_response(response)
+
+	def _process_response(self, response):
+		if type(response) is StreamChunk:
+			key = response.uid
+			stream = self._streams.get(key)
+			if stream is not None and stream._feed(response):
+				self._streams.pop(key, None)
+			return
+		fut = self._pending.pop(response.uid, None)
+		if fut is not None and not fut.done():
+			fut.set_result(response)
+
+	def _uid(self):
+		return self._uids.next()
+
+	async def _remote_call(self, fct, args=[], kwargs={}, uid=None, timeout=None):
+		self.start()
+		if uid is None: uid = self._uid()
+		key = uid
+		fut = asyncio.get_running_loop().create_future()
+		self._pending[key] = fut
+		request = Request(uid, fct, args, kwargs)
+		await self.socket.send_multipart([self._remote_id] + pack_msg(request, self.codec), copy=False)
+		try:
+			if timeout is None:
+				response = await fut
+			else:
+				response = await asyncio.wait_for(fut, timeout)
+		except asyncio.TimeoutError:
+			raise ZeroBotTimeout("Timeout")
+		finally:
+			self._pending.pop(key, None)
+		if response.error:
+			raise ZeroBotException(response.error)
+		return response.data
+
+	def _send_stream_msg(self, obj):
+		# un envoi sur une socket zmq.asyncio ne bloque pas la boucle
+		self.socket.send_multipart([self._remote_id] + pack_msg(obj, self.codec), copy=False)
+
+	def __getattr__(self, name):
+		def auto_generated_remote_call(*args, timeout=None, uid=None, stream=False, **kwargs):
+			if stream:
+				request = StreamRequest(uid if uid is not None else self._uid(), name, args, kwargs,
+					self.stream_window, self.stream_chunk_size)
+				return AsyncioStream(self, request, timeout)
+			return self._remote_call(name, args, kwargs, uid, timeout)
+		return auto_generated_remote_call
+
+	def __repr__(self):
+		return "%s(%s,%s,..)" % (self.__class__.__name__, self.identity, self.conn_addr)
+
+
+class _StreamCredit:
+	""" Crédit d'un stream envoyé par un :class:`AsyncioService`. """
+	def __init__(self, credit):
+		self.credit = credit
+		self.error = None
+		self.event = asyncio.Event()
+
+
+class AsyncioService:
+	"""
+	Expose les méthodes d'un objet depuis une boucle asyncio. Les méthodes
+	``async def`` sont exécutées comme des tâches de la boucle, des milliers
+	d'appels peuvent donc être en cours sans utiliser de thread. Les méthodes
+	classiques sont exécutées dans un :class:`concurrent.futures.ThreadPoolExecutor`::
+
+		class Cool:
+			async def sleep(self, t):
+				await asyncio.sleep(t)
+				return t
+
+			def ping(self, num):
+				return num+42
+
+		service = AsyncioService('cool', 'tcp://localhost:5001', Cool())
+		await service.run()
+
+	Les appels d'une :class:`zerobot.core.BatchRequest` sont exécutés
+	simultanément, la réponse est envoyée quand ils sont tous terminés.
+
+	*identity* identité du service
+
+	*conn_addr* adresse du backend du serveur
+
+	*exposed_obj* une instance de l'objet à exposer
+
+	*ctx* zmq context (:class:`zmq.asyncio.Context` ou context classique)
+
+	*ev_push_addr* adresse sur laquelle envoyer les events, voir
+	:meth:`zerobot.core.BaseClient.send_event`
+
+	*executor_workers* nombre de threads pour les méthodes classiques
+
+	*max_tasks* nombre maximum de requêtes en cours, au delà les requêtes
+	attendent dans les files de zmq
+
+	*stream_timeout* durée en secondes après laquelle un stream dont le client
+	n'a plus demandé de paquet est abandonné
+
+	Les streams (voir :class:`zerobot.service.Service`) sont envoyés par une
+	tâche chacun, les générateurs asynchrones (``async def`` avec ``yield``)
+	sont parcourus dans la boucle, les autres itérateurs dans l'executor.
+	"""
+	def __init__(self, identity, conn_addr, exposed_obj, *, ctx=None, ev_push_addr=None,
+			executor_workers=10, max_tasks=10000, stream_timeout=60):
+		if ctx is None:
+			ctx = zmq.asyncio.Context()
+			self._ctx_is_mine = True
+		else:
+			if not isinstance(ctx, zmq.asyncio.Context):
+				ctx = zmq.asyncio.Context.shadow(ctx)
+			self._ctx_is_mine = False
+		self.ctx = ctx
+		self.identity = identity
+		self.conn_addr = conn_addr
+		self.exposed_obj = exposed_obj
+		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
+		self.socket = self.ctx.socket(zmq.DEALER)
+		self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
+		self.socket.connect(conn_addr)
+		if ev_push_addr:
+			self.ev_push_socket = self.ctx.socket(zmq.DEALER)
+			self.ev_push_socket.setsockopt(zmq.IDENTITY, self.identity.encode())
+			self.ev_push_socket.connect(ev_push_addr)
+		else:
+			self.ev_push_socket = None
+		self.executor = concurrent.futures.ThreadPoolExecutor(executor_workers)
+		self.max_tasks = max_tasks
+		self.stream_timeout = stream_timeout
+		self._streams = {}			# (remote_id, uid) => _StreamCredit
+		self._tasks = set()
+		self._slots = None
+		self._recv_task = None
+		self._loop = None
+		#on ajoute une méthode send_event à l'object exposé
+		exposed_obj.send_event = types.MethodType(lambda s, k, o : self.send_event(k, o), exposed_obj)
+		self.dispatch = DispatchTable(exposed_obj)
+
+	def start(self):
+		""" Lance la tâche de réception des requêtes, doit être appelée depuis la boucle asyncio. """
+		if self._recv_task is None:
+			self._loop = asyncio.get_running_loop()
+			self._slots = asyncio.Semaphore(self.max_tasks)
+			self._recv_task = asyncio.ensure_future(self._recv_loop())
+			self.logger.info("%s started", self)
+
+	async def run(self):
+		""" Lance le service et attend qu'il soit arrêté par :meth:`stop`. """
+		self.start()
+		try:
+			await self._recv_task
+		except asyncio.CancelledError:
+			pass
+
+	def stop(self):
+		""" Arrête la réception des requêtes, les requêtes en cours continuent. """
+		if self._recv_task is not None:
+			self._recv_task.cancel()
+			self._recv_task = None
+
+	def close(self):
+		""" Arrête le service, les requêtes en cours sont annulées. """
+		self.stop()
+		for task in list(self._tasks):
+			task.cancel()
+		self._tasks.clear()
+		self.executor.shutdown(False)
+		self.socket.close()
+		if self.ev_push_socket is not None:
+			self.ev_push_socket.close()
+		if self._ctx_is_mine:
+			self.ctx.term()
+
+	async def _recv_loop(self):
+		while True:
+			await self._slots.acquire()
+			msg = await _recv_msg(self.socket)
+			self.logger.debug("recv %s", msg)
+			task = asyncio.ensure_future(self._process(msg))
+			self._tasks.add(task)
+			task.add_done_callback(self._task_done)
+
+	def _task_done(self, task):
+		self._tasks.discard(task)
+		self._slots.release()
+
+	async def _process(self, msg):
+		"""
+		Même format de message que :meth:`zerobot.service.Service._process`,
+		la réponse est renvoyée avec le codec de la requête.
+		"""
+		remote_id = msg[0]
+		try:
+			request, codec = unpack_msg(Request, msg[1:])
+		except Exception as ex:
+			self.logger.error("invalid request %s : %s", msg, ex)
+			return
+		if type(request) is Request:
+			response = await self._call(request)
+		elif isinstance(request, BatchRequest):
+			responses = await asyncio.gather(*[ self._call(r) for r in request.requests ])
+			response = Response(request.uid, [ [r.data, r.error] for r in responses ])
+		elif isinstance(request, StreamCredit):
+			self._credit_stream(remote_id, request)
+			return
+		else:
+			await self._stream(remote_id, request, codec)
+			return
+		await self.socket.send_multipart([remote_id] + pack_msg(response, codec), copy=False)
+
+	async def _stream(self, remote_id, request, codec):
+		""" Envoie par paquets le résultat de la :class:`zerobot.core.StreamRequest`. """
+		try:
+			method = self.dispatch.methods.get(request.fct) or self.dispatch[request.fct]
+			method.check(request.args, request.kwargs)
+			if method.is_async_gen:
+				items = method.f(*request.args, **request.kwargs)
+			elif method.is_coroutine:
+				items = _stream_items(await method.f(*request.args, **request.kwargs))
+			else:
+				call = functools.partial(method.f, *request.args, **request.kwargs)
+				items = _stream_items(await asyncio.get_running_loop().run_in_executor(self.executor, call))
+		except Exception as ex:
+			err = {'tb': traceback.format_exc(), 'error': str(ex)}
+			await self.socket.send_multipart([remote_id] + pack_msg(StreamChunk(request.uid, [], err), codec), copy=False)
+			return
+		key = (remote_id, request.uid)
+		credit = self._streams[key] = _StreamCredit(request.window)
+		chunk_size = max(1, request.chunk_size)
+		seq = 0
+		try:
+			while True:
+				while credit.credit <= 0 and credit.error is None:
+					credit.event.clear()
+					try:
+						await self._wait_credit(credit)
+					except asyncio.TimeoutError:
+						self.logger.warning("stream %s of %s expired", request.uid, remote_id)
+						credit.error = "stream timeout"
+				if credit.error is not None:
+					chunk = StreamChunk(request.uid, [], {'tb': '', 'error': credit.error}, seq)
+				else:
+					try:
+						data = await self._next_items(items, chunk_size)
+						chunk = StreamChunk(request.uid, data, None, seq, len(data) == chunk_size)
+					except Exception as ex:
+						chunk = StreamChunk(request.uid, [], {'tb': traceback.format_exc(), 'error': str(ex)}, seq)
+				seq += 1
+				credit.credit -= 1
+				await self.socket.send_multipart([remote_id] + pack_msg(chunk, codec), copy=False)
+				if not chunk.more:
+					break
+		finally:
+			self._streams.pop(key, None)
+			if isinstance(items, collections.abc.AsyncGenerator):
+				await items.aclose()
+			elif hasattr(items, 'close'):
+				try:
+					items.close()
+				except ValueError:
+					# tâche annulée pendant que l'executor parcourt le générateur
+					pass
+
+	async def _wait_credit(self, credit):
+		"""
+		Attend le crédit du client sans garder la place du stream parmi les
+		*max_tasks* : les :class:`zerobot.core.StreamCredit` passent par la
+		même tâche de réception que les requêtes.
+		"""
+		self._slots.release()
+		try:
+			await asyncio.wait_for(credit.event.wait(), self.stream_timeout)
+		finally:
+			# même annulée, la tâche reprend sa place, rendue par _task_done
+			await asyncio.shield(self._slots.acquire())
+
+	async def _next_items(self, items, n):
+		if isinstance(items, collections.abc.AsyncIterator):
+			data = []
+			while len(data) < n:
+				try:
+					data.append(await items.__anext__())
+				except StopAsyncIteration:
+					break
+			return data
+		# l'itérateur peut bloquer, il est parcouru dans l'executor
+		return await asyncio.get_running_loop().run_in_executor(self.executor, list, itertools.islice(items, n))
+
+	def _credit_stream(self, remote_id, request):
+		credit = self._streams.get((remote_id, request.uid))
+		if credit is None:
+			self.logger.debug("drop credit %s, no stream", request)
+			return
+		if request.cancel:
+			credit.error = "cancelled"
+		else:
+			credit.credit += request.credit
+		credit.event.set()
+
+	async def _call(self, request):
+		""" Exécute la :class:`zerobot.core.Request` et renvoie la :class:`zerobot.core.Response`. """
+		err = None
+		r = None
+		try:
+			# help et stop sont exécutées dans la boucle
+			if request.fct=='help':
+				return Response(request.uid, self.help(*request.args, **request.kwargs))
+			elif request.fct=='stop':
+				return Response(request.uid, self.stop())
+			method = self.dispatch.methods.get(request.fct) or self.dispatch[request.fct]
+			method.check(request.args, request.kwargs)
+			key = method.cache.key(request.args, request.kwargs) if method.cache else None
+			r = method.cache.get(key) if key is not None else ResultCache.MISSING
+			if r is ResultCache.MISSING:
+				if method.is_coroutine:
+					r = await method.f(*request.args, **request.kwargs)
+				elif method.is_async_gen:
+					r = [ item async for item in method.f(*request.args, **request.kwargs) ]
+				else:
+					call = functools.partial(method.invoke, request.args, request.kwargs)
+					r = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+				if key is not None:
+					method.cache.put(key, r)
+		except Exception as ex:
+			err = {}
+			err['tb'] = traceback.format_exc()
+			err['error'] = str(ex)
+		return Response(request.uid, r, err)
+
+	def help(self, f=None):
+		"""
+		Renvoie l'help pour le client ou pour la fonction *f* si précisée,
+		voir :meth:`zerobot.service.DispatchTable.help`.
+		"""
+		return self.dispatch.help(f)
+
+	def refresh(self):
+		""" Met à jour la table des méthodes exposées. """
+		self.dispatch.refresh()
+
+	def cache_stats(self):
+		""" Compteurs hits/misses des méthodes décorées par :func:`zerobot.service.cached`. """
+		return self.dispatch.cache_stats()
+
+	def send_event(self, key, obj):
+		"""
+		Envoie un event, peut être appelée par les méthodes classiques
+		exécutées dans l'executor : la socket n'est utilisée que depuis la boucle.
+		"""
+		if self.ev_push_socket is None:
+			raise Exception("This service does not have event push address")
+		msg = [key.encode(), json.dumps(obj).encode()]
+		try:
+			in_loop = asyncio.get_running_loop() is self._loop
+		except RuntimeError:
+			in_loop = False
+		if in_loop or self._loop is None:
+			self.ev_push_socket.send_multipart(msg)
+		else:
+			self._loop.call_soon_threadsafe(self.ev_push_socket.send_multipart, msg)
+
+	def __repr__(self):
+		return "%s(%s,%s,%s,..)" % (self.__class__.__name__, self.identity, self.conn_addr, self.exposed_obj)
@@ -0,0 +1,123 @@
+
+from .core import *
+from .client import Batch, _RemoteCalls, _AsyncTimeouts
+
+
+class Channel(_AsyncTimeouts, BaseClient):
+	"""
+	Une connexion au frontend d'un serveur partagée par tous les clients du
+	processus : une seule socket, une seule ioloop et un seul thread, quel
+	que soit le nombre de services appelés::
+
+		channel = Channel.get('tcp://localhost:5000')
+		cool = channel.proxy('cool')
+		cool.ping(42)
+		cool.sleep(1, block=False, cb_fct=cb)
+
+	Les proxies (:class:`ChannelProxy`) s'utilisent comme un
+	:class:`zerobot.client.AsyncClient`, chacun a sa propre table d'appels et
+	de streams en attente. Les callbacks et les timeouts sont gérés par le
+	channel (voir :class:`zerobot.client.AsyncClient`).
+
+	*conn_addr* adresse du frontend du serveur
+
+	*identity* identité du channel, générée si non précisée
+
+	*callback_workers*, *callback_queue*, *pending_ttl*, *timer_tick*,
+	*stream_window*, *stream_chunk_size* voir :class:`zerobot.client.AsyncClient`
+	"""
+	_channels = {}
+	_channels_lock = threading.Lock()
+
+	def __init__(self, conn_addr, identity=None, *args,
+			callback_workers=4, callback_queue=1000, pending_ttl=600, timer_tick=0.05,
+			stream_window=4, stream_chunk_size=100, **kwargs):
+		if identity is None:
+			identity = "Channel-%s" % uuid.uuid1()
+		super(Channel, self).__init__(identity, conn_addr, *args, **kwargs)
+		self._proxies = {}
+		self._proxies_lock = threading.Lock()
+		self.stream_window = stream_window
+		self.stream_chunk_size = stream_chunk_size
+		self._executor = CallbackExecutor(callback_workers, callback_queue,
+			name="Callbacks-%s" % self.identity)
+		self._init_timeouts(timer_tick, pending_ttl)
+
+	@classmethod
+	def get(cls, conn_addr, **kwargs):
+		"""
+		Renvoie le channel partagé connecté à *conn_addr*, il est créé et
+		démarré au premier appel. *kwargs* sont passés au constructeur.
+		"""
+		with cls._channels_lock:
+			channel = cls._channels.get(conn_addr)
+			if channel is None:
+				channel = cls(conn_addr, **kwargs)
+				channel.start(False)
+				cls._channels[conn_addr] = channel
+			return channel
+
+	def proxy(self, remote_id):
+		""" Renvoie le :class:`ChannelProxy` du service *remote_id*. """
+		with self._proxies_lock:
+			key = remote_id.encode()
+			proxy = self._proxies.get(key)
+			if proxy is None:
+				proxy = ChannelProxy(self, remote_id)
+				self._proxies[key] = proxy
+			return proxy
+
+	def close(self, all_fds=False):
+		with self._channels_lock:
+			if self._channels.get(self.conn_addr) is self:
+				del self._channels[self.conn_addr]
+		self._stop_timeouts()
+		super(Channel, self).close(all_fds)
+		self._executor.shutdown()
+
+	def _process(self, fd, _ev):
+		# traite toutes les réponses déjà arrivées avant de rendre la main à l'ioloop
+		while True:
+			try:
+				msg = recv_msg(fd, zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			proxy = self._proxies.get(msg[0])
+			if proxy is None:
+				self.logger.warning("drop response from unknown service %s", msg[0])
+				continue
+			response, _codec = unpack_msg(Response, msg[1:])
+			proxy._process_response(response)
+
+
+class ChannelProxy(_RemoteCalls):
+	"""
+	Appels vers le service *remote_id* à travers un :class:`Channel`, mêmes
+	keyword arguments que :class:`zerobot.client.AsyncClient` (uid, block,
+	timeout, cb_fct, stream). Un proxy ne possède ni socket ni thread.
+	"""
+	def __init__(self, channel, remote_id):
+		self.channel = channel
+		self._init_calls(remote_id)
+
+	@property
+	def _transport(self):
+		return self.channel
+
+	@property
+	def stream_window(self):
+		return self.channel.stream_window
+
+	@property
+	def stream_chunk_size(self):
+		return self.channel.stream_chunk_size
+
+	def _uid(self):
+		return self.channel._uid()
+
+	def batch(self, block=True, timeout=None, cb_fct=None):
+		""" Renvoie un :class:`zerobot.client.Batch` pour regrouper plusieurs appels. """
+		return Batch(self, block, timeout, cb_fct)
+
+	def __repr__(self):
+		return "%s(%s,%s)" % (self.__class__.__name__, self.channel.identity, self.remote_id)
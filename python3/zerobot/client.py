@@ -1,8 +1,325 @@
 
 from .core import *
 
+import queue
+import collections
 
-class Client(BaseClient):
+
+class Batch:
+	"""
+	Regroupe plusieurs appels distants en un seul message, le service les
+	exécute et renvoie tous les résultats dans une seule réponse::
+
+		with client.batch() as batch:
+			batch.ping(1)
+			batch.ping(2)
+		print(batch.results)
+		# [43, 44]
+
+	Les appels en erreur sont remplacés dans *results* par une
+	:class:`zerobot.core.ZeroBotException`. *block*, *timeout* et *cb_fct*
+	ont le même sens que pour un appel simple, *cb_fct* reçoit la liste des
+	résultats. Un batch ne peut pas être envoyé avec l'ancien format
+	(client créé avec codec=None).
+	"""
+	def __init__(self, client, block=True, timeout=None, cb_fct=None):
+		self.client = client
+		self.block = block
+		self.timeout = timeout
+		self.cb_fct = cb_fct
+		self.requests = []
+		self.results = None
+
+	def add(self, fct, *args, **kwargs):
+		""" Ajoute un appel, renvoie son index dans *results*. """
+		self.requests.append(Request(len(self.requests), fct, args, kwargs))
+		return len(self.requests)-1
+
+	def send(self):
+		""" Envoie les appels, renvoie *results* si le batch est bloquant. """
+		request = BatchRequest(self.client._uid(), self.requests)
+		if self.block:
+			data = self.client._send_request(request, None, True, self.timeout)
+			self.results = batch_results(data)
+			return self.results
+		return self.client._send_request(request, self._on_response, False, self.timeout)
+
+	def _on_response(self, response):
+		if response.error:
+			self.results = [ ZeroBotException(response.error) for _ in self.requests ]
+		else:
+			self.results = batch_results(response.data)
+		if self.cb_fct:
+			self.cb_fct(self.results)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if exc_type is None:
+			self.send()
+
+	def __getattr__(self, name):
+		def auto_generated_add(*args, **kwargs):
+			return self.add(name, *args, **kwargs)
+		return auto_generated_add
+
+	def __len__(self):
+		return len(self.requests)
+
+
+class Stream:
+	"""
+	Itérateur sur les éléments renvoyés par une méthode appelée avec
+	``stream=True``, le premier élément est disponible dès que le service a
+	envoyé le premier paquet::
+
+		with client.logs(since, stream=True) as lines:
+			for line in lines:
+				print(line)
+
+	Le service envoie les éléments par paquets de *chunk_size* (voir
+	:class:`zerobot.core.StreamRequest`) et au plus *window* paquets d'avance
+	sur ceux lus par l'itérateur : la mémoire utilisée des deux côtés est
+	bornée. Un paquet est attendu au plus *timeout* secondes, une erreur du
+	service est levée par l'itérateur. Une itération abandonnée doit être
+	fermée avec :meth:`close` (ou un bloc ``with``) pour arrêter le service.
+
+	Les paquets peuvent arriver dans le désordre (plusieurs paquets en vol à
+	travers un :class:`zerobot.server.ShardedServer`) : ils sont remis dans
+	l'ordre de leur *seq*, le stream n'est terminé qu'une fois tous les
+	paquets jusqu'au dernier reçus.
+	"""
+	def __init__(self, client, request, timeout=None):
+		self.client = client
+		self.request = request
+		self.timeout = timeout
+		self._key = request.uid
+		self._chunks = queue.Queue()
+		self._items = collections.deque()
+		self._done = False
+		self._consumed = 0
+		self._init_seq()
+		client._streams[self._key] = self
+		client._send_stream_msg(request)
+
+	def _init_seq(self):
+		# côté client : paquets reçus et seq du dernier paquet
+		self._n_fed = 0
+		self._last_seq = None
+		# côté itérateur : paquets arrivés avant leur tour, seq attendu
+		self._early = {}
+		self._next_seq = 0
+
+	def _feed(self, chunk):
+		"""
+		Appelée par le client à la réception d'un paquet, renvoie True une
+		fois tous les paquets reçus : le client peut oublier le stream.
+		"""
+		self._put(chunk)
+		self._n_fed += 1
+		if not chunk.more:
+			self._last_seq = chunk.seq
+		return self._last_seq is not None and self._n_fed > self._last_seq
+
+	def _put(self, chunk):
+		self._chunks.put(chunk)
+
+	def _accept(self, chunk):
+		self._early[chunk.seq] = chunk
+		while self._next_seq in self._early and not self._done:
+			self._accept_next(self._early.pop(self._next_seq))
+			self._next_seq += 1
+
+	def _accept_next(self, chunk):
+		if not chunk.more:
+			self._done = True
+			self.client._streams.pop(self._key, None)
+		if chunk.error:
+			self._done = True
+			raise ZeroBotException(chunk.error)
+		self._items.extend(chunk.data)
+		if chunk.more:
+			# crédits regroupés par demi fenêtre
+			self._consumed += 1
+			if self._consumed >= max(1, self.request.window//2):
+				self.client._send_stream_msg(StreamCredit(self.request.uid, self._consumed))
+				self._consumed = 0
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		while not self._items:
+			if self._done:
+				raise StopIteration
+			try:
+				chunk = self._chunks.get(timeout=self.timeout)
+			except queue.Empty:
+				self.close()
+				raise ZeroBotTimeout("Timeout")
+			self._accept(chunk)
+		return self._items.popleft()
+
+	def close(self):
+		""" Arrête le stream s'il n'est pas terminé. """
+		if not self._done:
+			self._done = True
+			self.client._streams.pop(self._key, None)
+			self.client._send_stream_msg(StreamCredit(self.request.uid, 0, True))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+
+class _RemoteCalls:
+	"""
+	Appels vers le service *remote_id*, communs à :class:`Client`,
+	:class:`AsyncClient` et :class:`zerobot.channel.ChannelProxy` : tables
+	des appels et des streams en attente, envoi des requêtes et traitement
+	des réponses.
+
+	*_transport* est le :class:`zerobot.core.BaseClient` qui possède la
+	socket, l'ioloop et le codec : le client lui-même ou le channel.
+	"""
+	def _init_calls(self, remote_id):
+		self.remote_id = remote_id
+		self._remote_frame = remote_id.encode()
+		self._resp_events = {}
+		self._streams = {}
+
+	@property
+	def _transport(self):
+		return self
+
+	def _remote_call(self, fct, args=[], kwargs={}, cb_fct=None, uid=None, block=True, timeout=None, stream=False):
+		if uid is None: uid = self._uid()
+		if stream:
+			request = StreamRequest(uid, fct, args, kwargs, self.stream_window, self.stream_chunk_size)
+			return Stream(self, request, timeout)
+		request = Request(uid, fct, args, kwargs)
+		return self._send_request(request, cb_fct, block, timeout)
+
+	def _send_request(self, request, cb_fct=None, block=True, timeout=None):
+		transport = self._transport
+		uid = request.uid
+		frames = [self._remote_frame] + pack_msg(request, transport.codec)
+		# le callback d'un appel bloquant est appelé par le thread appelant
+		resp_ev = ResponseEvent(None if block else cb_fct, transport._executor)
+		self._resp_events[uid] = resp_ev
+		if not block:
+			# le timer est armé avant l'envoi pour ne pas survivre à la réponse
+			transport._set_async_timeout(self, uid, timeout)
+		transport.send_multipart(frames)
+		if not block:
+			return resp_ev
+		resp_ev.wait(timeout)
+		if not resp_ev.is_set():
+			# une réponse arrivant plus tard sera ignorée
+			self._resp_events.pop(uid, None)
+			raise ZeroBotTimeout("Timeout")
+		if cb_fct:
+			cb_fct(resp_ev.response)
+		if resp_ev.response.error:
+			raise ZeroBotException(resp_ev.response.error)
+		return resp_ev.response.data
+
+	def _process_response(self, response):
+		""" Appelée par l'ioloop du transport à la réception d'une réponse. """
+		if type(response) is StreamChunk:
+			self._feed_stream(response)
+			return
+		uid = response.uid
+		resp_ev = self._resp_events.pop(uid, None)
+		if resp_ev is None:
+			self._transport.logger.debug("drop response %s, no pending call", response.uid)
+			return
+		self._transport._cancel_timeout(uid)
+		resp_ev.set(response)
+
+	def _send_stream_msg(self, obj):
+		transport = self._transport
+		transport.send_multipart([self._remote_frame] + pack_msg(obj, transport.codec))
+
+	def _feed_stream(self, chunk):
+		key = chunk.uid
+		stream = self._streams.get(key)
+		if stream is None:
+			self._transport.logger.debug("drop chunk %s, no stream", chunk.uid)
+		elif stream._feed(chunk):
+			# le stream est retiré dès son dernier paquet, même s'il n'est pas lu
+			self._streams.pop(key, None)
+
+	def __getattr__(self, name):
+		def auto_generated_remote_call(*args, block=True, timeout=None, cb_fct=None, uid=None, stream=False, **kwargs):
+			return self._remote_call(name, args, kwargs, cb_fct, uid, block, timeout, stream)
+		return auto_generated_remote_call
+
+
+class _AsyncTimeouts:
+	"""
+	Timeouts des appels non bloquants d'un :class:`AsyncClient` ou d'un
+	:class:`zerobot.channel.Channel` : une seule
+	:class:`zerobot.core.TimerWheel` avancée par l'ioloop, seulement tant
+	qu'elle contient des timers. Les appels sans timeout sont oubliés au
+	bout de *pending_ttl* secondes.
+	"""
+	def _init_timeouts(self, timer_tick, pending_ttl):
+		self.pending_ttl = pending_ttl
+		self._timeouts = TimerWheel(timer_tick)
+		# _ticking : un _process_timeouts est programmé sur l'ioloop
+		self._ticking = False
+		self._ticking_lock = threading.Lock()
+		self._tick_handle = None
+
+	def _set_async_timeout(self, caller, uid, timeout):
+		if timeout:
+			self._timeouts.add(uid, timeout, (caller, timeout))
+		elif self.pending_ttl:
+			self._timeouts.add(uid, self.pending_ttl, (caller, None))
+		else:
+			return
+		with self._ticking_lock:
+			if self._ticking:
+				return
+			self._ticking = True
+		self.ioloop.add_callback(self._process_timeouts)
+
+	def _cancel_timeout(self, uid):
+		self._timeouts.remove(uid)
+
+	def _process_timeouts(self):
+		""" Appelée par l'ioloop toutes les *timer_tick* secondes tant qu'il reste des timers. """
+		self._tick_handle = None
+		for uid, (caller, timeout) in self._timeouts.expire():
+			if timeout:
+				caller._process_response(Response(uid, {}, {'error': 'timeout', 'tb':''}))
+			elif caller._resp_events.pop(uid, None) is not None:
+				self.logger.debug("forget request %s, no response after %ss", uid, self.pending_ttl)
+		with self._ticking_lock:
+			if not len(self._timeouts):
+				self._ticking = False
+				return
+		self._tick_handle = self.ioloop.add_timeout(datetime.timedelta(seconds=self._timeouts.tick),
+			self._process_timeouts)
+
+	def _stop_timeouts(self):
+		""" Retire le prochain tick de l'ioloop, à appeler avant de la fermer. """
+		with self._ticking_lock:
+			# plus aucun tick ne sera programmé
+			self._ticking = True
+		self.ioloop.add_callback(self._remove_tick)
+
+	def _remove_tick(self):
+		if self._tick_handle is not None:
+			self.ioloop.remove_timeout(self._tick_handle)
+			self._tick_handle = None
+
+
+class Client(_RemoteCalls, BaseClient):
 	"""
 	Permet d'appeler un service::
 
@@ -12,65 +329,74 @@ class Client(BaseClient):
 		client.saymeHello()
 		#etc...
 
-	.. warning::
-	
-		Attention c'est classe n'est pas faite pour les appels asynchrones,
-		elle n'est pas non plus threadsafe. Pour cela voir :class:`zerobot.client.AsyncClient`.
+	Les appels sont bloquants, pour des appels asynchrones voir
+	:class:`zerobot.client.AsyncClient`. Plusieurs threads peuvent appeler
+	en même temps le même client : chaque réponse est associée à son appel
+	par son uid, et les réponses arrivées après le timeout de leur appel
+	sont ignorées.
 
 	Il est possible de passe plusieurs keyword arguments lors de l'appel d'une fonction distance:
 	
 	* uid : preciser l'id de la request
-	* timeout : si le service ne repond pas, une exception sera levée
-	"""
-	def __init__(self, identity, conn_addr, remote_id, *args, **kwargs):
-		super(Client, self).__init__(identity, conn_addr, *args, **kwargs)
-		self.remote_id = remote_id
+	* timeout : si le service ne repond pas, une :class:`zerobot.core.ZeroBotTimeout` sera levée
+	* cb_fct : callback appelé avec la :class:`zerobot.core.Response` avant de rendre la main
 
-		self.cb_fct = None
-		self.response = None
-		self.ev_response = threading.Event()
+	* stream : renvoie un :class:`Stream` sur les éléments du résultat, reçus
+	  par paquets de *stream_chunk_size*, au plus *stream_window* paquets d'avance
 
-	def reset_response(self, cb_fct=None):
-		self.cb_fct = cb_fct
-		self.response = None
-		self.ev_response.clear()
+	Plusieurs appels peuvent être regroupés en un seul message avec
+	:meth:`batch` (voir :class:`Batch`).
+
+	Le keyword argument *codec* du constructeur permet de choisir le codec
+	des requêtes (voir :mod:`zerobot.codec`), ``None`` pour parler à un
+	service qui ne connait pas le header (services C++).
+	"""
+	def __init__(self, identity, conn_addr, remote_id, *args, stream_window=4, stream_chunk_size=100, **kwargs):
+		super(Client, self).__init__(identity, conn_addr, *args, **kwargs)
+		self._init_calls(remote_id)
+		self.stream_window = stream_window
+		self.stream_chunk_size = stream_chunk_size
+		self._executor = None
 
 	def _process(self, fd, ev):
-		msg = fd.recv_multipart()
-		self.response = Response.unpack(msg[1])
-		self.ev_response.set()
+		# traite toutes les réponses déjà arrivées avant de rendre la main à l'ioloop
+		while True:
+			try:
+				msg = recv_msg(fd, zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			response, _codec = unpack_msg(Response, msg[1:])
+			self._process_response(response)
 
 	def start(self, block=False):
 		super(Client, self).start(block)
 
 	def close(self):
 		self.stop()
-		self.socket.close()
+		self._wait_stopped()
+		if self._ev_batcher is not None:
+			self._ev_batcher.close()
+		for sock in self._to_close:
+			sock.close()
+		if self._ev_executor is not None:
+			self._ev_executor.shutdown()
 		if self._ctx_is_mine:
 			self.ctx.term()
 
-	def _uid(self):
-		i = uuid.uuid1()
-		return str(i)
-	
-	def _remote_call(self, fct, args=[], kwargs={}, cb_fct=None, uid=None, block=True, timeout=None):
-		if uid is None: uid = self._uid()
-		request = Request(uid, fct, args, kwargs)
-		self.reset_response(cb_fct)
-		self.send_multipart([self.remote_id.encode(), request.pack()])
-		self.ev_response.wait(timeout)
-		if not self.ev_response.is_set():
-			raise Exception("timeout")
-		if self.response.error:
-			raise ZeroBotException(self.response.error)
-		return self.response.data
-	
-	def __getattr__(self, name):
-		def auto_generated_remote_call(*args, block=True, timeout=None, cb_fct=None, uid=None, **kwargs):
-			return self._remote_call(name, args, kwargs, cb_fct, uid, block, timeout)
-		return auto_generated_remote_call
-	
-class AsyncClient(BaseClient):
+	def batch(self, timeout=None):
+		""" Renvoie un :class:`Batch` pour regrouper plusieurs appels. """
+		return Batch(self, True, timeout)
+
+	def _send_request(self, request, cb_fct=None, block=True, timeout=None):
+		# les appels d'un Client sont toujours bloquants
+		return super(Client, self)._send_request(request, cb_fct, True, timeout)
+
+	def _cancel_timeout(self, uid):
+		# pas d'appel non bloquant, donc pas de timer
+		pass
+
+
+class AsyncClient(_RemoteCalls, _AsyncTimeouts, BaseClient):
 	"""
 	Permet de faire des appels à une classe distante.
 
@@ -80,8 +406,27 @@ class AsyncClient(BaseClient):
 	
 	* uid : id de la request
 	* block : rendre l'appel bloquand ou non
-	* timeout : (fonctionne seulement si block=True) si le service ne repond pas, une exception sera levée
+	* timeout : si le service ne repond pas, une exception sera levée (block=True)
+	  ou une :class:`zerobot.core.Response` d'erreur sera passée au callback (block=False)
 	* cb_fct : preciser un callback qui prend en parametre un :class:`zerobot.core.Response`
+	* stream : renvoie un :class:`Stream`, voir :class:`Client`
+
+	Les timeouts des appels non bloquants sont gérés par une seule
+	:class:`zerobot.core.TimerWheel` avancée par l'ioloop du client. Les appels
+	non bloquants sans timeout sont oubliés au bout de *pending_ttl* secondes
+	s'ils n'ont pas reçu de réponse.
+
+	Les réponses sont traitées directement dans l'ioloop du client et les
+	callbacks exécutés par un :class:`zerobot.core.CallbackExecutor`
+	(*dispatch* = ``'inline'``, par défaut). Avec *dispatch* = ``'ipc'``
+	l'ancien mécanisme est utilisé : les réponses repassent par une socket ipc
+	et chaque callback est lancé dans un nouveau thread.
+
+	Avec *cache* = True le client demande au service (via help, au premier
+	appel) quelles méthodes sont décorées par :func:`zerobot.service.cached`
+	et garde leurs résultats avec le même ttl et la même taille, les appels
+	suivants avec les mêmes arguments ne font plus d'aller-retour. Voir
+	:meth:`load_cache_policy` et :meth:`cache_stats`.
 
 	Par exemple::
 	
@@ -101,75 +446,147 @@ class AsyncClient(BaseClient):
 		client.sleep(3, timeout=1, block=True)
 		# raise Exception
 	"""
-	def __init__(self, identity, conn_addr, remote_id, *args, **kwargs):
+	CACHE_POLICY_TIMEOUT = 5
+
+	def __init__(self, identity, conn_addr, remote_id, *args,
+			dispatch='inline', callback_workers=4, callback_queue=1000,
+			pending_ttl=600, timer_tick=0.05, cache=False, stream_window=4, stream_chunk_size=100, **kwargs):
 		"""
 		@param {str} identity
 		@param {str} bind_addr adresse du frontend du serveur
 		@param {str} remote_id identity du client distant
 		@param {zmq.Context} zmq ctx
+		@param {str} dispatch 'inline' ou 'ipc'
+		@param {int} callback_workers nombre de threads exécutant les callbacks
+		@param {int} callback_queue nombre maximum de callbacks en attente, au-delà
+			ils sont abandonnés (la réponse reste disponible), voir :class:`CallbackExecutor`
+		@param {float} pending_ttl durée de vie d'un appel non bloquant sans timeout
+		@param {float} timer_tick résolution des timeouts en secondes
+		@param {bool} cache garder les résultats des méthodes cacheables du service
+		@param {int} stream_window nombre de paquets d'avance d'un :class:`Stream`
+		@param {int} stream_chunk_size nombre d'éléments par paquet d'un :class:`Stream`
 		"""
 		super(AsyncClient, self).__init__(identity, conn_addr, *args, **kwargs)
-		self.remote_id = remote_id
-		self._resp_events = {}
-		self._cb_push = self.ctx.socket(zmq.PUSH)
-		self._cb_push.bind("ipc://%s-worker"%self.identity)
-		self._cb_pull = self.ctx.socket(zmq.PULL)
-		self._cb_pull.connect("ipc://%s-worker"%self.identity)
-		self.add_handler(self._cb_pull, self._process_cb, ioloop.IOLoop.READ)
-		self._to_close.append(self._cb_pull)
-		self._to_close.append(self._cb_push)
+		if dispatch not in ('inline', 'ipc'):
+			raise ValueError("dispatch must be inline or ipc")
+		self._init_calls(remote_id)
+		self.dispatch = dispatch
+		self.stream_window = stream_window
+		self.stream_chunk_size = stream_chunk_size
+		self.caches = {}			# méthode => ResultCache
+		self._cache_enabled = cache
+		self._cache_policy = None	# None : pas encore demandée, False : demande en cours
+		self._init_timeouts(timer_tick, pending_ttl)
+		if dispatch == 'ipc':
+			self._executor = None
+			self._cb_push = self.ctx.socket(zmq.PUSH)
+			self._cb_push.bind("ipc://%s-worker"%self.identity)
+			self._cb_pull = self.ctx.socket(zmq.PULL)
+			self._cb_pull.connect("ipc://%s-worker"%self.identity)
+			self.add_handler(self._cb_pull, self._process_cb, ioloop.IOLoop.READ)
+			self._to_close.append(self._cb_pull)
+			self._to_close.append(self._cb_push)
+		else:
+			self._executor = CallbackExecutor(callback_workers, callback_queue,
+				name="Callbacks-%s" % self.identity)
+
+	def close(self, all_fds=False):
+		self._stop_timeouts()
+		super(AsyncClient, self).close(all_fds)
+		if self._executor is not None:
+			self._executor.shutdown()
 
 	def _process_cb(self, fd, _ev):
-		packed_response = fd.recv()
-		response = Response.unpack(packed_response)
+		frames = recv_msg(fd, n_copied=2)
+		response, _codec = unpack_msg(Response, frames)
 		self._process_response(response)
 	
-	def _uid(self):
-		i = uuid.uuid1()
-		return str(i)
-
 	def _process(self, fd, _ev):
-		msg = fd.recv_multipart()
-		#print('AsyncClient %s received: %s' % (self.identity, msg))
-		self._cb_push.send(msg[1])
+		# traite toutes les réponses déjà arrivées avant de rendre la main à l'ioloop
+		while True:
+			try:
+				msg = recv_msg(fd, zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			#print('AsyncClient %s received: %s' % (self.identity, msg))
+			if self._executor is None:
+				self._cb_push.send_multipart(msg[1:])
+			else:
+				response, _codec = unpack_msg(Response, msg[1:])
+				self._process_response(response)
 
-	def _process_response(self, response):
-		if response.uid in self._resp_events:
-			self._resp_events[response.uid].set(response)
-			self._resp_events.pop(response.uid)
-	
-	def _remote_call(self, fct, args=[], kwargs={}, cb_fct=None, uid=None, block=True, timeout=None):
-		if uid is None: uid = self._uid()
-		resp_ev = ResponseEvent()
-		if cb_fct:
-			resp_ev.cb_fct = cb_fct
-		self._resp_events[uid] = resp_ev
+	def batch(self, block=True, timeout=None, cb_fct=None):
+		""" Renvoie un :class:`Batch` pour regrouper plusieurs appels. """
+		return Batch(self, block, timeout, cb_fct)
+
+	def _remote_call(self, fct, args=[], kwargs={}, cb_fct=None, uid=None, block=True, timeout=None, stream=False):
+		if self._cache_enabled and not stream:
+			if self._cache_policy is None:
+				self.load_cache_policy(block=False, timeout=self.CACHE_POLICY_TIMEOUT)
+			cache = self.caches.get(fct)
+			if cache is not None:
+				if uid is None: uid = self._uid()
+				return self._cached_call(cache, uid, fct, args, kwargs, cb_fct, block, timeout)
+		return super(AsyncClient, self)._remote_call(fct, args, kwargs, cb_fct, uid, block, timeout, stream)
+
+	def _cached_call(self, cache, uid, fct, args, kwargs, cb_fct, block, timeout):
+		key = cache.key(args, kwargs)
+		if key is not None:
+			data = cache.get(key)
+			if data is not ResultCache.MISSING:
+				if block:
+					if cb_fct:
+						cb_fct(Response(uid, data))
+					return data
+				resp_ev = ResponseEvent(cb_fct, executor=self._executor)
+				resp_ev.set(Response(uid, data))
+				return resp_ev
 		request = Request(uid, fct, args, kwargs)
-		self.send_multipart([self.remote_id.encode(), request.pack()])
+		if key is None:
+			return self._send_request(request, cb_fct, block, timeout)
 		if block:
-			resp_ev.wait(timeout)
-			if not resp_ev.is_set():
-				raise ZeroBotTimeout("Timeout")
-			if resp_ev.response.error:
-				#print(resp_ev.response.error['tb'])
-				raise ZeroBotException(resp_ev.response.error)
-			return resp_ev.response.data
+			data = self._send_request(request, cb_fct, True, timeout)
+			cache.put(key, data)
+			return data
+		def on_response(response):
+			if not response.error:
+				cache.put(key, response.data)
+			if cb_fct:
+				cb_fct(response)
+		return self._send_request(request, on_response, False, timeout)
+
+	def load_cache_policy(self, block=True, timeout=None):
+		"""
+		Demande au service la liste des méthodes cacheables et crée leurs
+		caches. Avec cache=True elle est appelée sans bloquer au premier appel,
+		les appels partent sans cache jusqu'à la réponse.
+		"""
+		self._cache_policy = False
+		if block:
+			self._set_cache_policy(self._remote_call('help', block=True, timeout=timeout))
 		else:
-			if timeout:
-				self._set_async_timeout(uid, timeout)
-			return resp_ev
+			self._remote_call('help', cb_fct=self._on_cache_policy, block=False, timeout=timeout)
 
-	def _set_async_timeout(self, uuid, timeout):
-		t = threading.Timer(timeout, self._async_timeout, args=(uuid, timeout))
-		t.setDaemon(True)
-		t.start()
-	
-	def _async_timeout(self, uuid, timeout):
-		response = Response(uuid, {}, {'error': 'timeout', 'tb':''})
-		self._process_response(response)
-	
-	def __getattr__(self, name):
-		def auto_generated_remote_call(*args, block=True, timeout=None, cb_fct=None, uid=None, **kwargs):
-			return self._remote_call(name, args, kwargs, cb_fct, uid, block, timeout)
-		return auto_generated_remote_call
+	def _on_cache_policy(self, response):
+		if response.error:
+			self.logger.warning("cannot load cache policy of %s : %s", self.remote_id, response.error)
+			# nouvelle tentative au prochain appel
+			self._cache_policy = None
+		else:
+			self._set_cache_policy(response.data)
+
+	def _set_cache_policy(self, methods):
+		caches = {}
+		# les anciens services renvoient la liste des attributs
+		if isinstance(methods, dict):
+			for name, description in methods.items():
+				config = description.get('cached') if isinstance(description, dict) else None
+				if config:
+					caches[name] = self.caches.get(name) or ResultCache(config['maxsize'], config['ttl'])
+		self.caches = caches
+		self._cache_policy = True
+		self.logger.debug("cacheable methods of %s : %s", self.remote_id, sorted(caches))
 
+	def cache_stats(self):
+		""" Compteurs (voir :meth:`zerobot.core.ResultCache.stats`) des caches, par méthode. """
+		return { name: cache.stats() for name, cache in self.caches.items() }
@@ -0,0 +1,106 @@
+"""
+Codecs utilisés pour sérialiser les :class:`zerobot.core.Request` et les
+:class:`zerobot.core.Response`.
+
+Le codec utilisé par un client est annoncé dans le header envoyé avec
+chaque requête, le service répond avec le même codec. Json reste le codec
+par défaut, msgpack est disponible si le module est installé.
+"""
+
+import abc
+import json
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+
+class Codec(abc.ABC):
+	"""
+	Interface de base d'un codec, les sous-classes implémentent
+	:meth:`dumps` et :meth:`loads`.
+
+	*name* nom du codec, utilisé pour le choisir côté client
+
+	*cid* identifiant du codec (1 octet), envoyé dans le header
+	"""
+	name = None
+	cid = None
+
+	@abc.abstractmethod
+	def dumps(self, obj, default=None):
+		"""
+		Sérialise *obj* en bytes, *default* est appelée avec les objets que
+		le codec ne sait pas sérialiser et renvoie un objet sérialisable.
+		"""
+
+	@abc.abstractmethod
+	def loads(self, buff, object_hook=None):
+		"""
+		Désérialise *buff* (bytes ou buffer), *object_hook* est appelée avec
+		chaque dictionnaire décodé et renvoie l'objet qui le remplace.
+		"""
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__, self.name)
+
+
+class JsonCodec(Codec):
+	name = 'json'
+	cid = 1
+
+	def dumps(self, obj, default=None):
+		return json.dumps(obj, default=default).encode()
+
+	def loads(self, buff, object_hook=None):
+		return json.loads(bytes(buff).decode(), object_hook=object_hook)
+
+
+class MsgpackCodec(Codec):
+	name = 'msgpack'
+	cid = 2
+
+	def dumps(self, obj, default=None):
+		return msgpack.packb(obj, use_bin_type=True, default=default)
+
+	def loads(self, buff, object_hook=None):
+		return msgpack.unpackb(buff, raw=False, object_hook=object_hook)
+
+
+_codecs_by_name = {}
+_codecs_by_id = {}
+
+def register_codec(codec):
+	"""
+	Enregistre un codec, il pourra ensuite être utilisé par les clients
+	et reconnu par les services.
+	"""
+	if codec.cid in _codecs_by_id and _codecs_by_id[codec.cid].name != codec.name:
+		raise ValueError("codec id %s already used by %s" % (codec.cid, _codecs_by_id[codec.cid]))
+	_codecs_by_name[codec.name] = codec
+	_codecs_by_id[codec.cid] = codec
+
+def get_codec(key):
+	"""
+	Renvoie le codec correspondant à *key* qui peut être un nom, un
+	identifiant ou directement un :class:`Codec`.
+	"""
+	if isinstance(key, Codec):
+		return key
+	try:
+		if isinstance(key, int):
+			return _codecs_by_id[key]
+		return _codecs_by_name[key]
+	except KeyError:
+		raise ValueError("unknown codec %r" % (key,))
+
+def available_codecs():
+	""" Liste des noms des codecs enregistrés. """
+	return list(_codecs_by_name)
+
+
+JSON_CODEC = JsonCodec()
+register_codec(JSON_CODEC)
+if msgpack is not None:
+	register_codec(MsgpackCodec())
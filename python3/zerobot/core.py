@@ -4,9 +4,22 @@ import uuid
 import threading
 import time
 import logging
+import struct
+import queue
+import datetime
+import itertools
+import random
+import collections
 from zmq.eventloop import ioloop
 from collections import defaultdict
 
+from .codec import *
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 logger = logging.getLogger(__name__)
 
 class ZeroBotException(Exception):
@@ -17,28 +30,288 @@ class ZeroBotException(Exception):
 class ZeroBotTimeout(Exception):
 	pass
 
+class ZeroBotProtocolError(Exception):
+	pass
+
+
+HEADER_MAGIC = b'ZB'
+HEADER_VERSION = 1
+_header_struct = struct.Struct('!2sBBB')
+_uid_struct = struct.Struct('!Q')
+_header_uid_struct = struct.Struct('!2sBBBQ')
+
+# flags du header
+FLAG_BATCH = 0x01
+FLAG_UID = 0x02
+FLAG_STREAM = 0x04		# StreamRequest ou StreamChunk
+FLAG_MORE = 0x08		# StreamChunk suivi d'autres paquets
+FLAG_CREDIT = 0x10		# StreamCredit
+FLAG_FRAMES = 0x20		# pièces jointes binaires après le corps
+
+UID_MAX = 2**64-1
+
+def pack_header(codec, flags=0, uid=None):
+	"""
+	Construit le header envoyé avant le corps d'une requête/réponse.
+
+	============ ========== =============================
+	 champ        taille     description
+	============ ========== =============================
+	 magic        2 octets   b'ZB'
+	 version      1 octet    version du header
+	 codec        1 octet    id du codec du corps
+	 flags        1 octet    FLAG_*
+	 uid          8 octets   si FLAG_UID, uid entier (le corps ne le contient pas)
+	============ ========== =============================
+	"""
+	if uid is None:
+		return _header_struct.pack(HEADER_MAGIC, HEADER_VERSION, codec.cid, flags)
+	return _header_uid_struct.pack(HEADER_MAGIC, HEADER_VERSION, codec.cid, flags | FLAG_UID, uid)
+
+# il n'existe que quelques headers différents, on garde ceux déjà décodés
+_unpacked_headers = {}
+
+def unpack_header(buff):
+	"""
+	Renvoie le tuple (codec, flags) décrit par le header *buff*, l'uid
+	éventuel est lu par :func:`unpack_header_uid`.
+	"""
+	buff = bytes(buff[:_header_struct.size])
+	try:
+		return _unpacked_headers[buff]
+	except KeyError:
+		pass
+	try:
+		magic, version, cid, flags = _header_struct.unpack(buff)
+	except struct.error:
+		raise ZeroBotProtocolError("invalid header %r" % (buff,))
+	if magic != HEADER_MAGIC or version != HEADER_VERSION:
+		raise ZeroBotProtocolError("unsupported header %r" % (buff,))
+	try:
+		codec = get_codec(cid)
+	except ValueError as ex:
+		raise ZeroBotProtocolError(str(ex))
+	_unpacked_headers[buff] = (codec, flags)
+	return codec, flags
+
+def unpack_header_uid(buff):
+	""" Renvoie l'uid porté par un header marqué FLAG_UID. """
+	try:
+		return _uid_struct.unpack_from(buff, _header_struct.size)[0]
+	except struct.error:
+		raise ZeroBotProtocolError("invalid header %r" % (bytes(buff),))
+
+def is_binary_uid(uid):
+	""" True si *uid* peut être transporté dans le header. """
+	return type(uid) is int and 0 <= uid <= UID_MAX
+
+# préfixe des uids entiers envoyés en chaîne à l'ancien format, distingue
+# les uids générés des uids chaînes choisis par l'appelant
+LEGACY_UID_PREFIX = '#'
+
+def _legacy_uid(uid):
+	""" Uid tel qu'envoyé à l'ancien format. """
+	if type(uid) is int:
+		return LEGACY_UID_PREFIX + str(uid)
+	return uid
+
+def _unpack_legacy_uid(uid):
+	"""
+	Opération inverse de :func:`_legacy_uid` : les uids entiers renvoyés
+	tels quels par les services C++ ou node redeviennent des entiers, les
+	autres uids ne sont pas modifiés.
+	"""
+	if type(uid) is str and uid.startswith(LEGACY_UID_PREFIX) and uid[1:].isdigit():
+		return int(uid[1:])
+	return uid
+
+
+class UidGenerator:
+	"""
+	Génère les uids des requêtes d'un client : un compteur sur 64 bits,
+	bien moins coûteux qu'un uuid et transporté en binaire dans le header.
+
+	*nonce* préfixe de session (16 bits de poids fort) pour ne pas confondre
+	les réponses destinées à une instance précédente du même client, True
+	pour en tirer un au hasard, None pour aucun.
+	"""
+	NONCE_BITS = 16
+	COUNTER_BITS = 64 - NONCE_BITS
+
+	def __init__(self, nonce=None):
+		if nonce is True:
+			nonce = random.getrandbits(self.NONCE_BITS)
+		if nonce is not None and not 0 <= nonce < 2**self.NONCE_BITS:
+			raise ValueError("nonce must fit in %s bits" % self.NONCE_BITS)
+		self.nonce = nonce
+		self._prefix = (nonce or 0) << self.COUNTER_BITS
+		self._mask = 2**self.COUNTER_BITS-1
+		# next() sur un itertools.count est atomique
+		self._counter = itertools.count(1)
+
+	def next(self):
+		return self._prefix | (next(self._counter) & self._mask)
+
+def pack_msg(obj, codec=None):
+	"""
+	Transforme *obj* (:class:`Request` ou :class:`Response`) en liste de frames.
+	Si *codec* vaut None l'ancien format est utilisé : un seul frame json sans
+	header (compatible avec les services C++ et node).
+
+	Enveloppe complète d'un message, telle que vue par le serveur::
+
+		[id_from, id_to, header, corps, frames supplémentaires...]
+
+	Les frames de routage sont ajoutés/retirés par les sockets ROUTER/DEALER,
+	le serveur échange seulement *id_from* et *id_to*. Le header est versionné
+	(voir :func:`pack_header`), le corps et les frames suivants ne sont lus que
+	par le client et le service.
+
+	Un uid entier est placé dans le header, les autres uids restent dans le
+	corps. À l'ancien format un uid entier est envoyé sous forme de chaîne,
+	préfixée par *LEGACY_UID_PREFIX*.
+
+	Les données binaires que le codec ne sait pas sérialiser (``bytes``,
+	``bytearray``, ``memoryview`` et tableaux numpy avec json, tableaux numpy
+	seulement avec msgpack) sont envoyées telles quelles dans les frames
+	supplémentaires, sans copie : elles ne doivent pas être modifiées avant
+	l'envoi. Le corps contient à leur place un dictionnaire
+	``{FRAME_KEY: index, ...}`` (avec dtype et shape pour un tableau numpy)
+	et le header est marqué FLAG_FRAMES.
+	"""
+	if codec is None:
+		if obj.FLAGS:
+			raise ValueError("%s needs a codec" % obj.__class__.__name__)
+		return [obj.pack(uid=_legacy_uid(obj.uid))]
+	binary_uid = is_binary_uid(obj.uid)
+	try:
+		body = obj.pack(codec, not binary_uid)
+	except TypeError:
+		# sérialisation plus lente, seulement pour les messages avec pièces jointes
+		encoder = _FramesEncoder(codec)
+		body = obj.pack(encoder, not binary_uid)
+		header = pack_header(codec, obj.FLAGS | FLAG_FRAMES, obj.uid if binary_uid else None)
+		return [header, body] + encoder.frames
+	return [pack_header(codec, obj.FLAGS, obj.uid if binary_uid else None), body]
+
+def unpack_msg(klass, frames):
+	"""
+	Opération inverse de :func:`pack_msg`, renvoie le tuple (obj, codec),
+	codec valant None si le message est à l'ancien format. Une requête
+	marquée FLAG_BATCH est renvoyée sous forme de :class:`BatchRequest`, les
+	messages des streams sous forme de :class:`StreamRequest`,
+	:class:`StreamChunk` ou :class:`StreamCredit`.
+	"""
+	if len(frames) == 1:
+		obj = klass.unpack(frames[0])
+		obj.uid = _unpack_legacy_uid(obj.uid)
+		return obj, None
+	codec, flags = unpack_header(frames[0])
+	if flags & FLAG_BATCH:
+		klass = BatchRequest
+	elif flags & FLAG_CREDIT:
+		klass = StreamCredit
+	elif flags & FLAG_STREAM:
+		klass = StreamRequest if klass is Request else StreamChunk
+	body_codec = _FramesDecoder(codec, frames[2:]) if flags & FLAG_FRAMES else codec
+	if flags & FLAG_UID:
+		obj = klass.unpack(frames[1], body_codec, unpack_header_uid(frames[0]))
+	else:
+		obj = klass.unpack(frames[1], body_codec)
+	if flags & FLAG_MORE:
+		obj.more = True
+	return obj, codec
+
+
+FRAME_KEY = '__zerobot_frame__'
+
+class _FramesEncoder:
+	""" Codec qui sort les données binaires du corps, voir :func:`pack_msg`. """
+	def __init__(self, codec):
+		self.codec = codec
+		self.frames = []
+
+	def dumps(self, obj):
+		return self.codec.dumps(obj, default=self._default)
+
+	def _default(self, o):
+		if numpy is not None and isinstance(o, numpy.ndarray):
+			o = numpy.ascontiguousarray(o)
+			self.frames.append(o)
+			return {FRAME_KEY: len(self.frames)-1, 'dtype': o.dtype.str, 'shape': list(o.shape)}
+		if isinstance(o, (bytes, bytearray, memoryview)):
+			self.frames.append(o)
+			return {FRAME_KEY: len(self.frames)-1, 'view': isinstance(o, memoryview)}
+		raise TypeError("Object of type %s is not serializable" % o.__class__.__name__)
+
+class _FramesDecoder:
+	"""
+	Codec qui remplace les références aux pièces jointes par leur contenu,
+	sans copie pour les tableaux numpy (en lecture seule) et les memoryview.
+	"""
+	def __init__(self, codec, frames):
+		self.codec = codec
+		self.frames = frames
+
+	def loads(self, buff):
+		return self.codec.loads(buff, object_hook=self._object_hook)
+
+	def _object_hook(self, d):
+		if FRAME_KEY not in d:
+			return d
+		frame = self.frames[d[FRAME_KEY]]
+		buff = frame.buffer if isinstance(frame, zmq.Frame) else memoryview(frame)
+		if 'dtype' in d:
+			if numpy is None:
+				raise ZeroBotProtocolError("numpy is needed to decode an array")
+			return numpy.frombuffer(buff, dtype=d['dtype']).reshape(d['shape'])
+		if d.get('view'):
+			return buff
+		return bytes(buff)
+
+def recv_msg(socket, flags=0, n_copied=3):
+	"""
+	Comme ``socket.recv_multipart(flags)`` mais seuls les *n_copied* premiers
+	frames sont copiés, les suivants (pièces jointes, voir :func:`pack_msg`)
+	sont reçus sous forme de :class:`zmq.Frame`.
+	"""
+	parts = [socket.recv(flags)]
+	while socket.getsockopt(zmq.RCVMORE):
+		parts.append(socket.recv(flags, copy=len(parts) < n_copied))
+	return parts
+
 
 class Request:
+	FLAGS = 0
+
 	def __init__(self, uid, fct, args=[], kwargs={}):
 		self.uid = uid
 		self.fct = fct
 		self.args = args
 		self.kwargs = kwargs
 
-	def pack(self):
+	def pack(self, codec=None, uid=True):
+		"""
+		@param {Codec} codec codec du corps (json par défaut)
+		@param uid True pour mettre self.uid dans le corps, False pour l'omettre
+			(il est alors dans le header), sinon la valeur à y mettre
+		"""
 		#print('Request.pack')
 		msg = {}
-		msg['uid'] = self.uid
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
 		msg['fct'] = self.fct
 		msg['args'] = self.args
 		msg['kwargs'] = self.kwargs
 		#print(msg)
-		return json.dumps(msg).encode()
+		return (codec or JSON_CODEC).dumps(msg)
 
 	@staticmethod
-	def unpack(msg):
+	def unpack(msg, codec=None, uid=None):
 		#print('Request.unpack', msg)
-		d = json.loads(msg.decode())
+		d = (codec or JSON_CODEC).loads(msg)
+		if uid is not None:
+			d['uid'] = uid
 		return Request(**d)
 
 	def __eq__(self, o):
@@ -47,28 +320,135 @@ class Request:
 	def __repr__(self):
 		return "%s(%s,%s,%s,%s)" % (self.__class__.__name__, self.uid, self.fct, self.args, self.kwargs)
 
+class BatchRequest:
+	"""
+	Plusieurs :class:`Request` envoyées en un seul message. Le service répond
+	par une seule :class:`Response` dont les données sont la liste des
+	couples [data, error] de chaque appel, voir :func:`batch_results`.
+	"""
+	FLAGS = FLAG_BATCH
+
+	def __init__(self, uid, requests):
+		self.uid = uid
+		self.requests = requests
+
+	def pack(self, codec=None, uid=True):
+		msg = {}
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
+		msg['calls'] = [ [r.fct, r.args, r.kwargs] for r in self.requests ]
+		return (codec or JSON_CODEC).dumps(msg)
+
+	@staticmethod
+	def unpack(msg, codec=None, uid=None):
+		d = (codec or JSON_CODEC).loads(msg)
+		requests = [ Request(i, fct, args, kwargs) for i,(fct, args, kwargs) in enumerate(d['calls']) ]
+		return BatchRequest(d['uid'] if uid is None else uid, requests)
+
+	def __eq__(self, o):
+		return self.uid == o.uid and [ (r.fct, r.args, r.kwargs) for r in self.requests ] \
+			== [ (r.fct, r.args, r.kwargs) for r in o.requests ]
+
+	def __repr__(self):
+		return "%s(%s,%s)" % (self.__class__.__name__, self.uid, self.requests)
+
+class StreamRequest(Request):
+	"""
+	Appel dont le résultat est renvoyé en plusieurs :class:`StreamChunk` :
+	les éléments de l'itérateur (ou de la liste) renvoyé par la méthode sont
+	envoyés par paquets de *chunk_size*. Le service envoie au plus *window*
+	paquets d'avance, le client en autorise de nouveaux au fur et à mesure
+	qu'il les consomme (voir :class:`StreamCredit`).
+	"""
+	FLAGS = FLAG_STREAM
+
+	def __init__(self, uid, fct, args=[], kwargs={}, window=4, chunk_size=100):
+		Request.__init__(self, uid, fct, args, kwargs)
+		self.window = window
+		self.chunk_size = chunk_size
+
+	def pack(self, codec=None, uid=True):
+		msg = {}
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
+		msg['fct'] = self.fct
+		msg['args'] = self.args
+		msg['kwargs'] = self.kwargs
+		msg['window'] = self.window
+		msg['chunk_size'] = self.chunk_size
+		return (codec or JSON_CODEC).dumps(msg)
+
+	@staticmethod
+	def unpack(msg, codec=None, uid=None):
+		d = (codec or JSON_CODEC).loads(msg)
+		if uid is not None:
+			d['uid'] = uid
+		return StreamRequest(**d)
+
+class StreamCredit:
+	"""
+	Envoyé par le client au service : *credit* paquets supplémentaires
+	peuvent être envoyés pour le stream *uid*, *cancel* arrête le stream.
+	"""
+	FLAGS = FLAG_CREDIT
+
+	def __init__(self, uid, credit=1, cancel=False):
+		self.uid = uid
+		self.credit = credit
+		self.cancel = cancel
+
+	def pack(self, codec=None, uid=True):
+		msg = {}
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
+		msg['credit'] = self.credit
+		msg['cancel'] = self.cancel
+		return (codec or JSON_CODEC).dumps(msg)
+
+	@staticmethod
+	def unpack(msg, codec=None, uid=None):
+		d = (codec or JSON_CODEC).loads(msg)
+		if uid is not None:
+			d['uid'] = uid
+		return StreamCredit(**d)
+
+	def __repr__(self):
+		return "%s(%s,%s,%s)" % (self.__class__.__name__, self.uid, self.credit, self.cancel)
+
+def batch_results(data):
+	"""
+	Transforme les données de la réponse à une :class:`BatchRequest` en liste
+	de résultats, les appels en erreur sont remplacés par une :class:`ZeroBotException`.
+	"""
+	return [ ZeroBotException(error) if error else data for data, error in data ]
+
 class Response:
+	FLAGS = 0
+
 	def __init__(self, uid, data, error=None):
 		self.uid = uid
 		self.data = data
 		self.error = error
 
-	def pack(self):
+	def pack(self, codec=None, uid=True):
 		#print('Response.pack')
 		msg = {}
-		msg['uid'] = self.uid
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
 		msg['data'] = self.data
 		msg['error'] = self.error
 		#print(msg)
-		return json.dumps(msg).encode()
+		return (codec or JSON_CODEC).dumps(msg)
 
 	def error_is_set(self):
 		return bool(self.error)
 
 	@staticmethod
-	def unpack(msg):
+	def unpack(msg, codec=None, uid=None):
 		#print('Response.unpack', msg)
-		d = json.loads(msg.decode())
+		d = (codec or JSON_CODEC).loads(msg)
+		if uid is not None:
+			d['uid'] = uid
 		return Response(**d)
 
 	def __eq__(self, o):
@@ -77,19 +457,315 @@ class Response:
 	def __repr__(self):
 		return "%s(%s,%s,%s)" % (self.__class__.__name__, self.uid, self.data, self.error)
 
+class StreamChunk(Response):
+	"""
+	Paquet numéro *seq* de la réponse à une :class:`StreamRequest`, *data* est
+	la liste de ses éléments. *more* (transporté dans le header pour que les
+	proxies n'aient pas à décoder le paquet) est faux pour le dernier paquet,
+	qui porte aussi l'erreur éventuelle.
+	"""
+	def __init__(self, uid, data, error=None, seq=0, more=False):
+		Response.__init__(self, uid, data, error)
+		self.seq = seq
+		self.more = more
+
+	@property
+	def FLAGS(self):
+		return FLAG_STREAM | FLAG_MORE if self.more else FLAG_STREAM
+
+	def pack(self, codec=None, uid=True):
+		msg = {}
+		if uid is not False:
+			msg['uid'] = self.uid if uid is True else uid
+		msg['data'] = self.data
+		msg['error'] = self.error
+		msg['seq'] = self.seq
+		return (codec or JSON_CODEC).dumps(msg)
+
+	@staticmethod
+	def unpack(msg, codec=None, uid=None):
+		d = (codec or JSON_CODEC).loads(msg)
+		if uid is not None:
+			d['uid'] = uid
+		return StreamChunk(**d)
+
+	def __repr__(self):
+		return "%s(%s,%s,%s,%s,%s)" % (self.__class__.__name__, self.uid, self.seq, self.more, self.data, self.error)
+
+class CallbackExecutor:
+	"""
+	Exécute des callbacks dans un nombre borné de threads, à la place
+	d'un thread par callback.
+
+	*max_workers* nombre maximum de threads, ils sont créés à la demande
+
+	*max_queue* taille maximum de la file d'attente (0 pour une file non
+	bornée). :meth:`submit` ne bloque jamais, il est appelé depuis l'ioloop
+	qu'un callback peut attendre (appel bloquant au même client) : lorsque la
+	file est pleine l'appel est abandonné, loggé en erreur et compté dans
+	*dropped*.
+
+	*name* préfixe du nom des threads
+	"""
+	def __init__(self, max_workers=4, max_queue=1000, name="CallbackExecutor"):
+		self.max_workers = max_workers
+		self.name = name
+		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
+		self._queue = queue.Queue(max_queue)
+		self._threads = []
+		self._n_idle = 0
+		self._lock = threading.Lock()
+		self._shutdown = False
+		self.dropped = 0
+		# appels en attente derrière celui en cours, par clé
+		self._ordered = {}
+
+	def submit(self, fct, *args):
+		"""
+		Ajoute l'appel ``fct(*args)`` à la file.
+
+		@return {bool} False si la file est pleine et l'appel abandonné
+		"""
+		if self._shutdown:
+			raise Exception("This executor has been shut down !")
+		with self._lock:
+			if self._n_idle == 0 and len(self._threads) < self.max_workers:
+				t = threading.Thread(target=self._work, name="%s-%s" % (self.name, len(self._threads)))
+				t.daemon = True
+				self._threads.append(t)
+				t.start()
+		try:
+			self._queue.put_nowait((fct, args))
+		except queue.Full:
+			self._drop(fct)
+			return False
+		return True
+
+	def submit_ordered(self, key, fct, *args):
+		"""
+		Comme :meth:`submit` mais les appels de même *key* sont exécutés
+		l'un après l'autre, dans l'ordre de soumission. Les appels de clés
+		différentes restent exécutés en parallèle. L'appel est abandonné
+		lorsque *max_queue* appels de la même clé sont déjà en attente.
+
+		@return {bool} False si l'appel est abandonné
+		"""
+		with self._lock:
+			pending = self._ordered.get(key)
+			if pending is None:
+				self._ordered[key] = collections.deque()
+			elif not self._queue.maxsize or len(pending) < self._queue.maxsize:
+				pending.append((fct, args))
+				return True
+		if pending is not None:
+			self._drop(fct)
+			return False
+		if not self.submit(self._run_ordered, key, fct, args):
+			# les appels ajoutés entre temps derrière celui-ci sont perdus aussi
+			with self._lock:
+				self.dropped += len(self._ordered.pop(key))
+			return False
+		return True
+
+	def _drop(self, fct):
+		with self._lock:
+			self.dropped += 1
+		self.logger.error("Callback queue of %s full, dropped %s", self.name, fct)
+
+	def _run_ordered(self, key, fct, args):
+		while True:
+			try:
+				fct(*args)
+			except Exception as ex:
+				self.logger.error("Error in callback %s : %s", fct, ex, exc_info=1)
+			with self._lock:
+				pending = self._ordered[key]
+				if not pending:
+					del self._ordered[key]
+					return
+				fct, args = pending.popleft()
+
+	def _work(self):
+		while True:
+			with self._lock:
+				self._n_idle += 1
+			item = self._queue.get()
+			with self._lock:
+				self._n_idle -= 1
+			if item is None:
+				break
+			fct, args = item
+			try:
+				fct(*args)
+			except Exception as ex:
+				self.logger.error("Error in callback %s : %s", fct, ex, exc_info=1)
+
+	def shutdown(self):
+		""" Arrête les threads une fois les callbacks en attente exécutés. """
+		self._shutdown = True
+		for _ in self._threads:
+			self._queue.put(None)
+		self._threads = []
+
+
+class TimerWheel:
+	"""
+	Roue de timers hachée : chaque timer est rangé dans la case correspondant
+	à son échéance, :meth:`expire` ne parcourt que les cases écoulées depuis
+	le dernier appel. L'ajout et la suppression sont en O(1).
+
+	*tick* résolution en secondes
+
+	*n_slots* nombre de cases de la roue
+	"""
+	def __init__(self, tick=0.05, n_slots=512):
+		self.tick = tick
+		self.n_slots = n_slots
+		self._slots = [ {} for _ in range(n_slots) ]
+		self._slot_of_key = {}
+		self._current = self._tick_of(time.time())
+		self._lock = threading.Lock()
+
+	def _tick_of(self, t):
+		return int(t / self.tick)
+
+	def add(self, key, delay, value=None, now=None):
+		"""
+		Ajoute (ou remplace) le timer *key* qui expirera dans *delay* secondes,
+		*value* sera renvoyée avec la clé par :meth:`expire`.
+		"""
+		if now is None: now = time.time()
+		deadline = self._tick_of(now + delay) + 1
+		i = deadline % self.n_slots
+		with self._lock:
+			old = self._slot_of_key.pop(key, None)
+			if old is not None:
+				del self._slots[old][key]
+			self._slots[i][key] = (deadline, value)
+			self._slot_of_key[key] = i
+
+	def remove(self, key):
+		""" Supprime le timer *key* s'il existe. """
+		with self._lock:
+			i = self._slot_of_key.pop(key, None)
+			if i is not None:
+				del self._slots[i][key]
+
+	def expire(self, now=None):
+		""" Retire et renvoie la liste des (key, value) arrivés à échéance. """
+		if now is None: now = time.time()
+		now_tick = self._tick_of(now)
+		expired = []
+		with self._lock:
+			# au plus un tour de roue, les timers plus lointains restent en place
+			for t in range(self._current+1, min(now_tick, self._current+self.n_slots)+1):
+				slot = self._slots[t % self.n_slots]
+				for key, (deadline, value) in list(slot.items()):
+					if deadline <= now_tick:
+						del slot[key]
+						del self._slot_of_key[key]
+						expired.append((key, value))
+			self._current = max(self._current, now_tick)
+		return expired
+
+	def __len__(self):
+		return len(self._slot_of_key)
+
+	def __contains__(self, key):
+		return key in self._slot_of_key
+
+
+class ResultCache:
+	"""
+	Cache LRU des résultats d'une fonction, indexés par ses arguments
+	sérialisés (voir :meth:`key`).
+
+	*maxsize* nombre maximum de résultats gardés, les moins récemment
+	utilisés sont retirés en premier
+
+	*ttl* durée de vie d'un résultat en secondes, None pour ne pas expirer
+
+	*hits* et *misses* comptent les lectures trouvées ou non dans le cache.
+	Les résultats sont partagés, ils ne doivent pas être modifiés.
+	"""
+	MISSING = object()
+
+	def __init__(self, maxsize=128, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def key(args, kwargs):
+		""" Clé de l'appel ``(*args, **kwargs)``, None si les arguments ne sont pas sérialisables. """
+		try:
+			return json.dumps([args, kwargs], sort_keys=True, separators=(',', ':'))
+		except (TypeError, ValueError):
+			return None
+
+	def get(self, key):
+		""" Renvoie le résultat associé à *key* ou :attr:`MISSING`. """
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				expires, value = entry
+				if expires is None or expires > time.monotonic():
+					self._entries.move_to_end(key)
+					self.hits += 1
+					return value
+				del self._entries[key]
+			self.misses += 1
+			return self.MISSING
+
+	def put(self, key, value):
+		expires = time.monotonic()+self.ttl if self.ttl is not None else None
+		with self._lock:
+			self._entries[key] = (expires, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+			'maxsize': self.maxsize, 'ttl': self.ttl}
+
+	def __len__(self):
+		return len(self._entries)
+
+
 class ResponseEvent:
-	def __init__(self, cb_fct=None):
+	def __init__(self, cb_fct=None, executor=None):
+		"""
+		@param {callable} cb_fct callback appelé avec la :class:`Response`
+		@param {CallbackExecutor} executor si précisé, le callback est exécuté
+			par l'executor plutôt que dans un nouveau thread
+		"""
 		self._ev = threading.Event()
 		self.response = None
 		self.cb_fct = cb_fct
+		self.executor = executor
 
 	def _nonblocking_set(self, response):
-		t = threading.Thread(target=self.set, args=(response,True))
-		t.setDaemon(True)
-		t.start()
+		if self.executor is not None:
+			if not self.executor.submit(self.set, response, True):
+				# callback abandonné, le résultat reste disponible
+				self.response = response
+				self._ev.set()
+		else:
+			t = threading.Thread(target=self.set, args=(response,True))
+			t.setDaemon(True)
+			t.start()
 	
 	def set(self, response, block=False):
-		if block:
+		if block or self.cb_fct is None:
+			# sans callback il n'y a rien de bloquant à exécuter
 			self.response = response
 			if self.cb_fct:
 				self.cb_fct(response)
@@ -104,6 +780,96 @@ class ResponseEvent:
 		return self._ev.is_set()
 
 
+class EventBatcher:
+	"""
+	Regroupe les events envoyés sur *socket* : ils partent en un seul message
+	``[key1, msg1, key2, msg2, ...]`` dès que *max_events* sont en attente ou
+	*max_delay* secondes après le premier. Le serveur les redistribue
+	regroupés par clé, voir :meth:`zerobot.server.EventPublisher.publish_batch`.
+
+	Les envois sont faits par un thread dédié, seul à utiliser la socket.
+	"""
+	def __init__(self, socket, max_events=100, max_delay=0.001):
+		self.socket = socket
+		self.max_events = max_events
+		self.max_delay = max_delay
+		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
+		self.batches = 0
+		self.events = 0
+		self._frames = []
+		self._cond = threading.Condition()
+		self._closed = False
+		self._thread = None
+
+	def add(self, key, msg):
+		""" Ajoute l'event (*key* et *msg* en bytes) au prochain envoi. """
+		with self._cond:
+			if self._closed:
+				raise Exception("This batcher has been closed !")
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name="EventBatcher-%s" % id(self))
+				self._thread.daemon = True
+				self._thread.start()
+			self._frames.append(key)
+			self._frames.append(msg)
+			if len(self._frames) == 2 or len(self._frames) >= 2*self.max_events:
+				self._cond.notify()
+
+	def _run(self):
+		max_frames = 2*self.max_events
+		while True:
+			with self._cond:
+				while not self._frames and not self._closed:
+					self._cond.wait()
+				if not self._frames:
+					return
+				deadline = time.monotonic()+self.max_delay
+				while len(self._frames) < max_frames and not self._closed:
+					remaining = deadline-time.monotonic()
+					if remaining <= 0:
+						break
+					self._cond.wait(remaining)
+				frames, self._frames = self._frames[:max_frames], self._frames[max_frames:]
+			try:
+				self.socket.send_multipart(frames)
+			except zmq.ZMQError as ex:
+				self.logger.error("events lost : %s", ex)
+			self.batches += 1
+			self.events += len(frames)//2
+
+	def close(self):
+		""" Envoie les events en attente et arrête le thread. """
+		with self._cond:
+			self._closed = True
+			self._cond.notify()
+		if self._thread is not None:
+			self._thread.join(1)
+
+
+class Event:
+	"""
+	Event reçu par un :class:`BaseClient`, le corps n'est décodé qu'au
+	premier accès à :attr:`obj`, une seule fois pour tous les callbacks.
+	"""
+	__slots__ = ('key', 'id_from', 'msg', '_obj')
+	_NOT_DECODED = object()
+
+	def __init__(self, key, id_from, msg):
+		self.key = key
+		self.id_from = id_from
+		self.msg = msg
+		self._obj = self._NOT_DECODED
+
+	@property
+	def obj(self):
+		if self._obj is self._NOT_DECODED:
+			self._obj = json.loads(self.msg)
+		return self._obj
+
+	def __repr__(self):
+		return "%s(%s,%s,%s)" % (self.__class__.__name__, self.key, self.id_from, self.msg)
+
+
 class Base:
 	def __init__(self, ctx=None):
 		self.ioloop = ioloop.IOLoop()
@@ -112,6 +878,10 @@ class Base:
 		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
 		self._to_close = []
 		self.__is_closed = False
+		# thread qui fait tourner l'ioloop, None tant qu'elle n'est pas démarrée
+		self._loop_thread = None
+		# thread lancé par start(False)
+		self._thread = None
 
 	def add_handler(self, fd, cb, t):
 		"""
@@ -134,20 +904,37 @@ class Base:
 			raise Exception("This instance has been closed !")
 		self.logger.info("%s started", self)
 		if block:
-			self.ioloop.start()
+			self._run()
 		else:
-			t = threading.Thread(target=self.ioloop.start, name="Thread-%s"%self)
+			t = self._thread = threading.Thread(target=self._run, name="Thread-%s"%self)
 			t.setDaemon(True)
 			t.start()
 
+	def _run(self):
+		self._loop_thread = threading.get_ident()
+		self.ioloop.start()
+
+	def in_ioloop(self):
+		""" True si appelée depuis le thread de l'ioloop. """
+		return threading.get_ident() == self._loop_thread
+
 	def stop(self):
 		self.logger.info("stop event received")
-		self.ioloop.stop()
+		# depuis un autre thread ioloop.stop ne réveille pas la boucle
+		self.ioloop.add_callback(self.ioloop.stop)
+
+	def _wait_stopped(self):
+		""" Attend que la boucle arrêtée par :meth:`stop` ait rendu la main, avant de fermer les sockets. """
+		if self._thread is not None and self._thread is not threading.current_thread():
+			# la boucle peut être occupée par un callback
+			self._thread.join(1)
+		else:
+			time.sleep(0.05)
 
 	def close(self, all_fds=False):
 		self.stop()
 		self.logger.info("close event received")
-		time.sleep(0.05)
+		self._wait_stopped()
 		self.ioloop.close(all_fds)
 		time.sleep(0.05)
 		if not all_fds:
@@ -162,17 +949,30 @@ class Base:
 		return "%s(..)" % (self.__class__.__name__, )
 
 class BaseClient(Base):
-	def __init__(self, identity, conn_addr, ev_sub_addr=None, ev_push_addr=None, *, ctx=None):
+	def __init__(self, identity, conn_addr, ev_sub_addr=None, ev_push_addr=None, *, ctx=None, codec='json',
+			uid_nonce=None, ev_workers=4, ev_queue=1000, ev_batch=0, ev_batch_delay=0.001):
 		"""
 		@param {str} identity identité du client
 		@param {str} conn_addr adresse sur laquelle se connecter
 		@param {str} ev_sub_addr adresse sur laquelle se connecter pour ecouter les events
 		@param {str} ev_push_addr adresse sur laquelle se connecter pour lancer les events
 		@param {zmq.Context} zmq context
+		@param {str|None} codec codec des requêtes, None pour l'ancien format sans header
+		@param {int|bool|None} uid_nonce préfixe de session des uids, voir :class:`UidGenerator`
+		@param {int} ev_workers nombre maximum de threads exécutant les callbacks d'events
+		@param {int} ev_queue taille de la file des callbacks d'events, les
+			events qui arrivent lorsqu'elle est pleine sont abandonnés
+		@param {int} ev_batch si > 1, les events envoyés sont regroupés par
+			paquets de *ev_batch* au plus, voir :class:`EventBatcher`. Les abonnés
+			doivent savoir lire les events regroupés (zerobot >= cette version).
+		@param {float} ev_batch_delay attente maximum d'un event avant l'envoi
+			de son paquet, en secondes
 		"""
 		super(BaseClient, self).__init__(ctx)
 		self.identity = identity
 		self.conn_addr = conn_addr
+		self.codec = get_codec(codec) if codec is not None else None
+		self._uids = UidGenerator(uid_nonce)
 		self.socket = self.ctx.socket(zmq.DEALER)
 		self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
 		self.socket.connect(conn_addr)
@@ -180,12 +980,20 @@ class BaseClient(Base):
 		self._to_close.append(self.socket)
 		
 		self.callbacks = defaultdict(list)
+		self.inline_callbacks = defaultdict(list)
+		self.conflated_callbacks = defaultdict(list)
+		self._ev_executor = None
+		# dernier event pas encore livré des clés conflatées, None pendant la livraison
+		self._latest_events = {}
+		self._latest_lock = threading.Lock()
+		self.conflated_events = defaultdict(int)
 		if ev_sub_addr:
 			self.ev_sub_addr = ev_sub_addr
 			self.ev_sub_socket = self.ctx.socket(zmq.SUB)
 			self.ev_sub_socket.connect(ev_sub_addr)
 			self.add_handler(self.ev_sub_socket, self._process_ev, ioloop.IOLoop.READ)
 			self._to_close.append(self.ev_sub_socket)
+			self._ev_executor = CallbackExecutor(ev_workers, ev_queue, name="Events-%s" % self.identity)
 		else:
 			self.ev_sub_addr = None
 			self.ev_sub_socket = None
@@ -199,42 +1007,156 @@ class BaseClient(Base):
 		else:
 			self.ev_push_addr = None
 			self.ev_push_socket = None
+		if ev_push_addr and ev_batch > 1:
+			self._ev_batcher = EventBatcher(self.ev_push_socket, ev_batch, ev_batch_delay)
+		else:
+			self._ev_batcher = None
 			
 
-	def add_callback(self, ev_key, cb):
+	def close(self, all_fds=False):
+		if self._ev_batcher is not None:
+			self._ev_batcher.close()
+		super(BaseClient, self).close(all_fds)
+		if self._ev_executor is not None:
+			self._ev_executor.shutdown()
+
+	def add_callback(self, ev_key, cb, inline=False, conflate=False):
+		"""
+		Appelle ``cb(ev_key, id_from, obj)`` à chaque event *ev_key*.
+
+		Par défaut les callbacks sont exécutés par un nombre borné de threads
+		(voir *ev_workers*), ceux d'une même clé l'un après l'autre et dans
+		l'ordre d'arrivée des events. Avec *inline* le callback est appelé
+		directement par l'ioloop, il doit donc être rapide et ne jamais
+		bloquer (pas d'appel synchrone à un service).
+
+		Avec *conflate* seule la dernière valeur compte (position, batterie,
+		...) : les events arrivés pendant l'exécution des callbacks sont
+		remplacés par le plus récent, un callback lent voit toujours la
+		valeur la plus fraîche et au plus un event par clé est en attente.
+		Le nombre d'events sautés est dans :attr:`conflated_events`.
+		"""
 		if not self.ev_sub_addr:
 			raise Exception("This client does not have event subscribing address")
-		self.callbacks[ev_key].append(cb)
+		if inline and conflate:
+			raise ValueError("inline callbacks can't be conflated")
+		if inline:
+			self.inline_callbacks[ev_key].append(cb)
+		elif conflate:
+			self.conflated_callbacks[ev_key].append(cb)
+		else:
+			self.callbacks[ev_key].append(cb)
+		self.ioloop.add_callback(self._subscribe, ev_key)
+
+	def _subscribe(self, ev_key):
+		# depuis l'ioloop : une opération sur la socket faite par un autre
+		# thread peut consommer la notification d'events déjà arrivés
 		self.ev_sub_socket.setsockopt(zmq.SUBSCRIBE, ev_key.encode())
+		self._process_ev(self.ev_sub_socket, None)
 	
 	def _process(self, fd, ev):
 		raise Exception("BaseClient._process must be override")
 
+	def _uid(self):
+		return self._uids.next()
+
 	def _process_ev(self, fd, _ev):
-		mmsg = fd.recv_multipart()
-		#print("recv event : %s" % mmsg)
-		ev_key, id_from, msg = map(lambda x: x.decode(), mmsg)
-		obj = json.loads(msg)
-		for cb in self.callbacks[ev_key]:
-			t = threading.Thread(target=cb, args=(ev_key, id_from, obj))
-			t.daemon = True
-			t.start()
+		# l'ioloop ne prévient qu'une fois pour plusieurs events
+		while True:
+			try:
+				frames = fd.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			ev_key = frames[0].decode()
+			# les abonnements zmq sont des préfixes, l'event peut n'avoir aucun callback
+			inline = self.inline_callbacks.get(ev_key)
+			callbacks = self.callbacks.get(ev_key)
+			conflated = self.conflated_callbacks.get(ev_key)
+			if not inline and not callbacks and not conflated:
+				continue
+			# [key, id_from, msg, msg, ...] : events de même clé regroupés par le serveur
+			id_from = frames[1].decode()
+			events = [ Event(ev_key, id_from, msg) for msg in frames[2:] ]
+			if inline:
+				for event in events:
+					self._run_ev_callbacks(event, inline)
+			if callbacks:
+				self._ev_executor.submit_ordered(ev_key, self._run_ev_batch, events, list(callbacks))
+			if conflated:
+				self.conflated_events[ev_key] += len(events)-1
+				self._conflate_event(events[-1], conflated)
+
+	def _conflate_event(self, event, callbacks):
+		with self._latest_lock:
+			if event.key in self._latest_events:
+				# une livraison est en cours ou prévue, elle prendra cet event
+				if self._latest_events[event.key] is not None:
+					self.conflated_events[event.key] += 1
+				self._latest_events[event.key] = event
+				return
+			self._latest_events[event.key] = event
+		if not self._ev_executor.submit(self._run_conflated, event.key, list(callbacks)):
+			with self._latest_lock:
+				del self._latest_events[event.key]
+
+	def _run_conflated(self, key, callbacks):
+		while True:
+			with self._latest_lock:
+				event = self._latest_events[key]
+				if event is None:
+					del self._latest_events[key]
+					return
+				self._latest_events[key] = None
+			self._run_ev_callbacks(event, callbacks)
+
+	def _run_ev_batch(self, events, callbacks):
+		for event in events:
+			self._run_ev_callbacks(event, callbacks)
+
+	def _run_ev_callbacks(self, event, callbacks):
+		for cb in callbacks:
+			try:
+				cb(event.key, event.id_from, event.obj)
+			except Exception as ex:
+				self.logger.error("Error in event callback %s : %s", cb, ex, exc_info=1)
 	
 	def send_multipart(self, msg):
-		""" Envoyer un message en plusieurs parties via la socket. zmq style."""
-		if self.socket.closed:
+		"""
+		Envoyer un message en plusieurs parties via la socket. zmq style.
+		Hors du thread de l'ioloop l'envoi est confié à l'ioloop, seule à
+		utiliser la socket.
+		"""
+		if not self.in_ioloop():
+			try:
+				self.ioloop.add_callback(self._send_and_process, msg)
+			except RuntimeError:
+				logger.warning("ioloop closed, drop msg '%s'" % msg)
+		elif self.socket.closed:
 			logger.warning("socket closed, drop msg '%s'" % msg)
 		else:
-			self.socket.send_multipart(msg)
+			# les petits frames sont copiés quand même (zmq.COPY_THRESHOLD)
+			self.socket.send_multipart(msg, copy=False)
+
+	def _send_and_process(self, frames):
+		"""
+		Envoie depuis l'ioloop puis relit la socket : la notification de
+		lecture de la socket zmq ne se répète pas, une réponse arrivée
+		pendant l'envoi serait sinon oubliée.
+		"""
+		self.send_multipart(frames)
+		self._process(self.socket, None)
 
 	def send(self, msg):
 		""" Envoyer un message via la socket. zmq style."""
-		self.socket.send(msg)
+		self.send_multipart([msg])
 
 	def _send_event(self, key, msg):
 		if not self.ev_push_addr:
 			raise Exception("This client does not have event push address")
-		self.ev_push_socket.send_multipart([key.encode(), msg.encode()])
+		if self._ev_batcher is not None:
+			self._ev_batcher.add(key.encode(), msg.encode())
+		else:
+			self.ev_push_socket.send_multipart([key.encode(), msg.encode()])
 
 	def send_event(self, key, obj):
 		self._send_event(key, json.dumps(obj))
@@ -49,10 +49,15 @@ class IOAdapter(BaseClient):
 					self.send(msg)
 
 	def _process(self, fd, _ev):
-		msg = fd.recv_multipart()
-		msg = self.process_sock_to_io(msg)
-		if msg:
-			self.write(msg)
+		# l'ioloop ne prévient qu'une fois pour plusieurs messages
+		while True:
+			try:
+				msg = fd.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			msg = self.process_sock_to_io(msg)
+			if msg:
+				self.write(msg)
 
 class SubProcessAdapter(IOAdapter):
 	def __init__(self, identity, conn_addr, popen_args, ctx=None):
@@ -190,7 +190,7 @@ class ArduinoAdapter(IOAdapter):
 			if req is None:
 				logger.warning('unknown reponse id %s' % uid)
 			else:
-				id_to, uuid = req
+				id_to, uuid, codec = req
 				if (t & 0x02) == 0:
 					rep = Response(uuid, args)
 				else:  # Il y a une erreur
@@ -204,23 +204,23 @@ class ArduinoAdapter(IOAdapter):
 				del self.requests[uid]
 				self.free_ids.append(uid)
 				logger.info("reponse to %s : %s", id_to, rep)
-				return [id_to, rep.pack()]
+				return [id_to] + pack_msg(rep, codec)
 	
 	def process_sock_to_io(self, msg):
-		remote_id, packed_request = msg
-		request = Request.unpack(packed_request)
+		remote_id = msg[0]
+		request, codec = unpack_msg(Request, msg[1:])
 		
 		try:
 			# si c'est une demande d'affichage de l'aide
 			if request.fct == 'help':
 				help_msg = self.help(request)
 				response = Response(request.uid, help_msg, None)
-				self.send_multipart([remote_id, response.pack()])
+				self.send_multipart([remote_id] + pack_msg(response, codec))
 			# sinon c'est un appel a une fonction
 			else:
 				uid = request.uid
 				i = self.free_ids.pop()
-				self.requests[i] = (remote_id, uid)
+				self.requests[i] = (remote_id, uid, codec)
 				args = request.args
 				kwargs = request.kwargs
 				f = self.functions[request.fct]
@@ -233,7 +233,7 @@ class ArduinoAdapter(IOAdapter):
 			err['tb'] = traceback.format_exc()
 			err['error'] = str(ex)
 			response = Response(request.uid, None, err)
-			self.send_multipart([remote_id, response.pack()])
+			self.send_multipart([remote_id] + pack_msg(response, codec))
 	
 	def kill(self, request):
 		resp = Response(request.uid, 'goobye', None)
@@ -96,7 +96,7 @@ class Proxy(Base):
 class Proxy(Base):
 	def __init__(self, identity, *, ctx=None,
 			ft_conn_addr=None, ft_bind_addr=None, ft_type=zmq.DEALER,
-			bc_bind_addr=None, bc_conn_addr=None, bc_type=zmq.DEALER):
+			bc_bind_addr=None, bc_conn_addr=None, bc_type=zmq.DEALER, copy=True):
 		"""
 		Interface de base pour les device avec entrée/sortie.
 		Il est possible de choisir le type des sockets ainsi que le type de connection (connect/bind).
@@ -108,7 +108,10 @@ class Proxy(Base):
 		@param {str|None} bc_conn_addr connect backend
 		@param {str|None} ft_bind_addr bind backend
 		@param {zmq.*|zmq.DEALER} bc_type type du socket backend
+		@param {bool} copy si False les messages sont reçus et transmis sous forme
+			de :class:`zmq.Frame` sans copie des données
 		"""
+		self.copy = copy
 		self.ctx = ctx or zmq.Context()
 		self._ctx_is_mine = ctx is None
 		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
@@ -167,7 +170,7 @@ class Proxy(Base):
 			t.start()
 		else:
 			backend,frontend = self.backend,self.frontend
-			poller = self.create_poller()
+			poller = self._poller = self.create_poller()
 			while not self._e_stop.is_set():
 				try:
 					items = dict(poller.poll(500))
@@ -206,11 +209,11 @@ class Proxy(Base):
 		"""
 		Fonction pouvant être surchargée pour changer le comportement du proxy.
 		"""
-		msg = fd.recv_multipart()
+		msg = fd.recv_multipart(copy=self.copy)
 		new_msg = self._frontend_process_msg(msg)
 		if new_msg:
 			#print("ft send", new_msg)
-			self.backend.send_multipart(new_msg)
+			self.backend.send_multipart(new_msg, copy=self.copy)
 
 	def _backend_process_msg(self, msg):
 		"""
@@ -224,9 +227,9 @@ class Proxy(Base):
 		"""
 		Fonction pouvant être surchargée pur changer le comportement du proxy.
 		"""
-		msg = fd.recv_multipart()
+		msg = fd.recv_multipart(copy=self.copy)
 		new_msg = self._backend_process_msg(msg)
 		if new_msg:
 			#print("bc send", new_msg)
-			self.frontend.send_multipart(new_msg)
+			self.frontend.send_multipart(new_msg, copy=self.copy)
 
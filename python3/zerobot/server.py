@@ -1,35 +1,488 @@
 
 from .proxy import Proxy
+from .core import Base
 import zmq
 
+import os
+import time
+import json
 import logging
+import collections
+import tempfile
+import threading
+import multiprocessing
 from zmq.eventloop import ioloop
 
 
-class Server(Proxy):
+class Mirror:
+	"""
+	Recopie des messages routés sur la socket de monitoring (XPUB) du
+	serveur, utilisée par ``scripts/log.py``.
+
+	La socket XPUB permet de savoir si quelqu'un est abonné : sans abonné
+	les messages ne sont pas recopiés du tout. :meth:`configure` permet de
+	désactiver la recopie, de ne recopier qu'un message sur *sample* ou que
+	les messages venant de ou allant vers une des *identities*.
+	"""
+	def __init__(self, socket):
+		self.socket = socket
+		self.enabled = True
+		self.sample = 1
+		self.identities = None
+		self.active = False
+		self._topics = set()
+		self._count = 0
+
+	def configure(self, enabled=True, sample=1, identities=None):
+		"""
+		@param {bool} enabled recopier les messages
+		@param {int} sample ne recopier qu'un message sur *sample*
+		@param {list|None} identities ne recopier que les messages dont
+			l'expéditeur ou le destinataire est dans la liste
+		"""
+		if sample < 1:
+			raise ValueError("sample must be >= 1")
+		self.sample = sample
+		self.identities = set(i.encode() if isinstance(i, str) else i for i in identities) \
+			if identities else None
+		self.enabled = enabled
+		self._update()
+
+	def _update(self):
+		self.active = self.enabled and bool(self._topics)
+
+	def process_subscriptions(self):
+		""" Lit les (dés)abonnements reçus par la socket XPUB. """
+		while True:
+			try:
+				sub = self.socket.recv(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			if sub[:1] == b'\x01':
+				self._topics.add(sub[1:])
+			elif sub[:1] == b'\x00':
+				self._topics.discard(sub[1:])
+		self._update()
+
+	def send(self, msg):
+		""" Recopie *msg*, à n'appeler que si *active* est vrai. """
+		if self.sample > 1:
+			self._count += 1
+			if self._count % self.sample:
+				return
+		if self.identities is not None and msg[0].bytes not in self.identities \
+				and msg[1].bytes not in self.identities:
+			return
+		self.socket.send_multipart(msg, copy=False)
+
+
+class EventCache:
+	"""
+	Dernière valeur de chaque event transmis par le serveur, envoyée aux
+	nouveaux abonnés par :class:`EventPublisher` pour qu'ils n'attendent pas
+	le prochain event d'une clé qui change rarement.
+
+	Chaque abonnement remonte jusqu'au serveur (XPUB_VERBOSER), qui répond en
+	publiant les events en cache dont la clé commence par le préfixe demandé.
+	Ces events sont reçus aussi par les abonnés déjà présents sur ce préfixe,
+	ce qui est sans conséquence pour des valeurs « dernier état connu ».
+
+	*max_keys* nombre maximum de clés gardées
+
+	*max_bytes* taille maximum des corps gardés, en octets
+
+	*ttl* durée de vie d'une valeur en secondes, None pour aucune limite
+
+	Les clés les moins récemment mises à jour sont supprimées en premier.
+	"""
+	def __init__(self, max_keys=1000, max_bytes=16*2**20, ttl=None):
+		self.max_keys = max_keys
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.n_bytes = 0
+		self.snapshots = 0
+		# clé -> (id_from, corps, échéance), frames zmq gardés sans copie
+		self._events = collections.OrderedDict()
+
+	def put(self, key, id_from, msg):
+		old = self._events.pop(key, None)
+		if old is not None:
+			self.n_bytes -= len(old[1])
+		expires = time.monotonic()+self.ttl if self.ttl is not None else None
+		self._events[key] = (id_from, msg, expires)
+		self.n_bytes += len(msg)
+		while self._events and (len(self._events) > self.max_keys or self.n_bytes > self.max_bytes):
+			_key, (_id_from, old_msg, _expires) = self._events.popitem(last=False)
+			self.n_bytes -= len(old_msg)
+
+	def snapshot(self, prefix=b""):
+		""" Events en cache dont la clé commence par *prefix*, prêts à être publiés. """
+		now = time.monotonic()
+		events = []
+		for key, (id_from, msg, expires) in list(self._events.items()):
+			if expires is not None and expires <= now:
+				del self._events[key]
+				self.n_bytes -= len(msg)
+			elif key.startswith(prefix):
+				events.append([key, id_from, msg])
+		return events
+
+	def stats(self):
+		return {'keys': len(self._events), 'bytes': self.n_bytes, 'max_keys': self.max_keys,
+			'max_bytes': self.max_bytes, 'ttl': self.ttl, 'snapshots': self.snapshots}
+
+	def __len__(self):
+		return len(self._events)
+
+
+class _KeyStats:
+	__slots__ = ('events', 'bytes', 'dropped', 'subscribers', 'window_start', 'window_events', 'last_rate')
+
+	def __init__(self, now):
+		self.events = 0
+		self.bytes = 0
+		self.dropped = 0
+		self.subscribers = 0
+		self.window_start = now
+		self.window_events = 0
+		self.last_rate = 0.
+
+	def rate(self, now, period):
+		ellapsed = now - self.window_start
+		if ellapsed >= period:
+			return self.window_events / ellapsed
+		return self.last_rate
+
+
+class EventPublisher:
+	"""
+	Publication des events reçus par le serveur sur la socket XPUB *socket*.
+
+	La socket est en mode XPUB_VERBOSER : chaque abonnement et chaque
+	désabonnement (y compris à la déconnexion d'un abonné) remonte, ce qui
+	permet de compter les abonnements par préfixe. Un event dont la clé ne
+	correspond à aucun abonnement n'est pas envoyé du tout.
+
+	*cache* :class:`EventCache` optionnel, sa dernière valeur est publiée à
+	chaque nouvel abonnement
+
+	:meth:`stats` donne pour chaque clé le nombre d'events reçus, d'octets
+	(corps), d'events jetés faute d'abonné, d'abonnements correspondants et le
+	débit mesuré sur *RATE_PERIOD* secondes. Un abonné dont plusieurs
+	préfixes correspondent à une clé compte plusieurs fois.
+
+	*max_keys* nombre maximum de clés suivies par :meth:`stats`, les clés
+	les moins récemment publiées sont oubliées en premier
+	"""
+	RATE_PERIOD = 1.
+
+	def __init__(self, socket, cache=None, max_keys=1000):
+		self.socket = socket
+		self.socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+		self.cache = cache
+		self.max_keys = max_keys
+		# préfixe -> nombre d'abonnements
+		self._prefixes = {}
+		# clé -> nombre d'abonnements correspondants, vidé à chaque changement
+		# ou quand il dépasse *max_keys*
+		self._subscribers = {}
+		# clé -> _KeyStats, de la moins récemment publiée à la plus récente
+		self._stats = collections.OrderedDict()
+
+	def subscribers(self, key):
+		""" Nombre d'abonnements dont le préfixe correspond à *key* (bytes). """
+		n = self._subscribers.get(key)
+		if n is None:
+			n = sum(count for prefix, count in self._prefixes.items() if key.startswith(prefix))
+			if len(self._subscribers) >= self.max_keys:
+				self._subscribers.clear()
+			self._subscribers[key] = n
+		return n
+
+	def process_subscriptions(self):
+		""" Lit les (dés)abonnements reçus par la socket. """
+		changed = False
+		while True:
+			try:
+				sub = self.socket.recv(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			prefix = sub[1:]
+			if sub[:1] == b'\x01':
+				self._prefixes[prefix] = self._prefixes.get(prefix, 0) + 1
+				if self.cache is not None:
+					self.cache.snapshots += 1
+					for event in self.cache.snapshot(prefix):
+						self.socket.send_multipart(event, copy=False)
+			elif sub[:1] == b'\x00':
+				count = self._prefixes.pop(prefix, 0) - 1
+				if count > 0:
+					self._prefixes[prefix] = count
+			else:
+				continue
+			changed = True
+		if changed:
+			self._subscribers.clear()
+
+	def publish(self, id_from, key_event, *msgs):
+		"""
+		Publie le ou les events (frames zmq) de clé *key_event* s'ils ont au
+		moins un abonné. Plusieurs *msgs* partent en un seul message
+		``[key, id_from, msg1, msg2, ...]``.
+		"""
+		key = key_event.bytes
+		if self.cache is not None:
+			self.cache.put(key, id_from, msgs[-1])
+		now = time.monotonic()
+		stats = self._stats.get(key)
+		if stats is None:
+			stats = self._stats[key] = _KeyStats(now)
+			if len(self._stats) > self.max_keys:
+				self._stats.popitem(last=False)
+		else:
+			self._stats.move_to_end(key)
+		stats.events += len(msgs)
+		stats.bytes += sum(len(msg) for msg in msgs)
+		if now - stats.window_start >= self.RATE_PERIOD:
+			stats.last_rate = stats.window_events / (now - stats.window_start)
+			stats.window_start = now
+			stats.window_events = 0
+		stats.window_events += len(msgs)
+		stats.subscribers = self.subscribers(key)
+		if not stats.subscribers:
+			stats.dropped += len(msgs)
+			return
+		self.socket.send_multipart([key_event, id_from] + list(msgs), copy=False)
+
+	def publish_batch(self, id_from, frames):
+		"""
+		Publie les events ``[key1, msg1, key2, msg2, ...]`` envoyés par un
+		:class:`zerobot.core.EventBatcher` : les events de même clé sont
+		regroupés dans un seul message, dans leur ordre d'arrivée.
+		"""
+		if len(frames) == 2:
+			self.publish(id_from, frames[0], frames[1])
+			return
+		groups = collections.OrderedDict()
+		for key_event, msg in zip(frames[::2], frames[1::2]):
+			group = groups.get(key_event.bytes)
+			if group is None:
+				groups[key_event.bytes] = [key_event, msg]
+			else:
+				group.append(msg)
+		for group in groups.values():
+			self.publish(id_from, *group)
+
+	def stats(self):
+		now = time.monotonic()
+		return { key.decode(errors='replace'): {'events': s.events, 'bytes': s.bytes,
+				'dropped': s.dropped, 'subscribers': self.subscribers(key),
+				'rate': s.rate(now, self.RATE_PERIOD)}
+			for key, s in self._stats.items() }
+
+
+class Router(Proxy):
+	"""
+	Partie sans état du serveur : échange les deux frames de routage des
+	messages reçus sur frontend et backend et les recopie sur le publisher.
+
+	Les messages reçus suivent l'enveloppe décrite dans :func:`zerobot.core.pack_msg` :
+	le routeur se contente d'échanger les deux frames de routage, les autres frames
+	(header et corps) sont transmis sans être copiés ni décodés.
+
+	*pb_bind_addr* / *pb_conn_addr* adresse du publisher (bind ou connect),
+	voir :class:`Mirror` et :meth:`set_mirror`
+
+	*ctrl_bind_addr* adresse d'une socket REP de contrôle, voir :meth:`_control_handler`
+
+	Les autres arguments sont ceux de :class:`zerobot.proxy.Proxy`.
+	"""
+	MAX_BURST = 100
+
+	def __init__(self, identity, *, pb_bind_addr=None, pb_conn_addr=None, ctrl_bind_addr=None, **kwargs):
+		super(Router, self).__init__(identity, copy=False, **kwargs)
+		self.publisher = self.ctx.socket(zmq.XPUB)
+		self._pb_addr = pb_bind_addr or pb_conn_addr
+		if pb_bind_addr:
+			self.publisher.bind(pb_bind_addr)
+		else:
+			self.publisher.connect(pb_conn_addr)
+		self._to_close.append(self.publisher)
+		self.mirror = Mirror(self.publisher)
+		self._ctrl_addr = ctrl_bind_addr
+		if ctrl_bind_addr:
+			self.control = self.ctx.socket(zmq.REP)
+			self.control.bind(ctrl_bind_addr)
+			self._to_close.append(self.control)
+		else:
+			self.control = None
+		self.paused = False
+
+	def set_mirror(self, enabled=True, sample=1, identities=None):
+		""" Configure la recopie des messages, voir :meth:`Mirror.configure`. """
+		self.mirror.configure(enabled, sample, identities)
+
+	def create_poller(self):
+		poller = super(Router, self).create_poller()
+		poller.register(self.publisher, zmq.POLLIN)
+		if self.control is not None:
+			poller.register(self.control, zmq.POLLIN)
+		return poller
+
+	def _process_poll_items(self, items):
+		if self.publisher in items:
+			self.mirror.process_subscriptions()
+		if self.control is not None and self.control in items:
+			self._control_handler(self.control, items[self.control])
+
+	def _control_handler(self, fd, _ev):
+		"""
+		Commandes reçues sur la socket de contrôle, les mêmes que celles de
+		:func:`zmq.proxy_steerable` :
+
+		* PAUSE : arrête de lire frontend et backend, les messages restent
+		  dans les files de zmq
+		* RESUME : reprend le routage
+		* TERMINATE : arrête le routeur
+
+		Répond b"OK" ou b"ERROR" pour une commande inconnue. Les autres
+		commandes sont passées à :meth:`_control_command`.
+		"""
+		cmd = fd.recv()
+		self.logger.info("control command %s", cmd)
+		if cmd == b"PAUSE":
+			self._pause()
+		elif cmd == b"RESUME":
+			self._resume()
+		elif cmd == b"TERMINATE":
+			fd.send(b"OK")
+			self.stop()
+			return
+		else:
+			fd.send(self._control_command(cmd) or b"ERROR")
+			return
+		fd.send(b"OK")
+
+	def _control_command(self, cmd):
+		""" Réponse à une commande de contrôle spécifique, None si elle est inconnue. """
+		return None
+
+	def _pause(self):
+		# appelée depuis la boucle du routeur, le poller lui appartient
+		if not self.paused:
+			self.paused = True
+			self._poller.unregister(self.frontend)
+			self._poller.unregister(self.backend)
+
+	def _resume(self):
+		if self.paused:
+			self.paused = False
+			self._poller.register(self.frontend, zmq.POLLIN)
+			self._poller.register(self.backend, zmq.POLLIN)
+
+	def close(self):
+		self.publisher.close()
+		if self.control is not None:
+			self.control.close()
+		super(Router, self).close()
+
+	def _frontend_handler(self, fd, _ev):
+		self._route_burst(fd, self.backend, self._frontend_process_msg)
+
+	def _backend_handler(self, fd, _ev):
+		self._route_burst(fd, self.frontend, self._backend_process_msg)
+
+	def _route_burst(self, fd, out, process_msg):
+		"""
+		Transmet tous les messages déjà arrivés sur *fd* (au plus *MAX_BURST*)
+		avant de revenir au poll, ce qui évite un appel à poll par message.
+		"""
+		for _ in range(self.MAX_BURST):
+			try:
+				msg = fd.recv_multipart(zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				break
+			new_msg = process_msg(msg)
+			if new_msg:
+				out.send_multipart(new_msg, copy=False)
+
+	def _frontend_process_msg(self, msg):
+		#print("frontend")
+		if self.mirror.active:
+			self.mirror.send(msg)
+
+		# [id_from, id_to, header, corps...] -> [id_to, id_from, header, corps...]
+		if len(msg) == 2:
+			return self._legacy_route(msg)
+		id_to = msg[1]
+		if not len(id_to):
+			# socket REQ : [id_from, '', id_to, ...]
+			del msg[1]
+			id_to = msg[1]
+		msg[1] = msg[0]
+		msg[0] = id_to
+		return msg
+
+	def _legacy_route(self, msg):
+		"""
+		Ancien format en 2 parties : l'identité du destinataire est
+		à la fin de l'identité de l'expéditeur (xxx-destinataire).
+		"""
+		id_from = msg[0]
+		id_to = id_from.bytes.split(b'-')[-1]
+		return [id_to, id_from, msg[1]]
+
+	def _backend_process_msg(self, msg):
+		#print("backend")
+		if self.mirror.active:
+			self.mirror.send(msg)
+		msg[0], msg[1] = msg[1], msg[0]
+		return msg
+
+
+class Server(Router):
+	"""
+	Routeur central entre les clients (frontend) et les services (backend),
+	voir :class:`Router`. Transmet aussi les events reçus sur *ev_pl_bind_addr*
+	aux abonnés de *ev_pb_bind_addr*.
+
+	Tout le routage est fait par une seule boucle python, pour utiliser
+	plusieurs coeurs voir :class:`ShardedServer`.
+
+	*ctrl_bind_addr* adresse de la socket de contrôle (PAUSE/RESUME/TERMINATE),
+	voir :meth:`Router._control_handler`
+
+	*ev_cache* :class:`EventCache` pour envoyer la dernière valeur des events
+	aux nouveaux abonnés, None pour ne rien garder
+
+	Les events sont publiés par un :class:`EventPublisher` (:attr:`events`)
+	qui ne les envoie que s'ils ont un abonné. La commande de contrôle
+	EV_STATS renvoie ses statistiques par clé en json, pour les
+	*EventPublisher.max_keys* clés publiées le plus récemment.
+	"""
 	def __init__(self, ft_bind_addr="tcp://*:5000", bc_bind_addr="tcp://*:5001",
 			pb_bind_addr="tcp://*:5002", ev_pl_bind_addr="tcp://*:5003", ev_pb_bind_addr="tcp://*:5004",
-			ctx=None, identity="Server"):
-		super(Server, self).__init__(identity, ft_bind_addr=ft_bind_addr, ft_type=zmq.ROUTER, bc_bind_addr=bc_bind_addr, bc_type=zmq.ROUTER, ctx=ctx)
+			ctx=None, identity="Server", *, ctrl_bind_addr=None, ev_cache=None):
+		super(Server, self).__init__(identity, ft_bind_addr=ft_bind_addr, ft_type=zmq.ROUTER,
+			bc_bind_addr=bc_bind_addr, bc_type=zmq.ROUTER, pb_bind_addr=pb_bind_addr, ctx=ctx,
+			ctrl_bind_addr=ctrl_bind_addr)
 		# création ds sockets
-		self.publisher = self.ctx.socket(zmq.PUB)
 		self.ev_puller = self.ctx.socket(zmq.ROUTER)
-		self.ev_publisher = self.ctx.socket(zmq.PUB)
+		self.ev_publisher = self.ctx.socket(zmq.XPUB)
+		self.events = EventPublisher(self.ev_publisher, ev_cache)
 		# sauvegarde des adresses
-		self._pb_addr = pb_bind_addr
 		self._ev_pl_addr = ev_pl_bind_addr
 		self._ev_pb_addr = ev_pb_bind_addr
 		# binds
-		self.publisher.bind(self._pb_addr)
 		self.ev_puller.bind(self._ev_pl_addr)
 		self.ev_publisher.bind(self._ev_pb_addr)
-		self._to_close.append(self.publisher)
 		self._to_close.append(self.ev_puller)
 		self._to_close.append(self.ev_publisher)
 
 	def create_poller(self):
 		poller = super(Server, self).create_poller()
 		poller.register(self.ev_puller, zmq.POLLIN)
+		poller.register(self.ev_publisher, zmq.POLLIN)
 		return poller
 	
 	def start(self, block=True):
@@ -39,54 +492,37 @@ class Server(Proxy):
 		self.logger.info("Publishing\t%s", self._pb_addr)
 		self.logger.info("Event puller\t%s", self._ev_pl_addr)
 		self.logger.info("Event publisher\t%s", self._ev_pb_addr)
+		if self._ctrl_addr:
+			self.logger.info("Control\t%s", self._ctrl_addr)
 		super(Server,self).start(block)
 
 	def close(self):
-		self.publisher.close()
 		self.ev_puller.close()
 		self.ev_publisher.close()
 		super(Server,self).close()
-	
-	def _frontend_process_msg(self, msg):
-		#print("frontend")
-		self.publisher.send_multipart(msg)
-
-		nb = len(msg)
-		if nb ==2:
-			id_from = msg[0]
-			id_to = id_from.decode().split('-')[-1].encode()
-			msg = msg[1]
-		elif nb==3:
-			id_from = msg[0]
-			id_to = msg[1]
-			msg = msg[2]
-		elif nb==4:
-			id_from = msg[0]
-			id_to = msg[2]
-			msg = msg[3]
-		#print('Frontend received %s' % ((id_from, id_to, msg),))
-		return [id_to,id_from,msg]
-
-	def _backend_process_msg(self, msg):
-		#print("backend")
-		self.publisher.send_multipart(msg)
-		id_from, id_to, msg = msg
-		#print('Backend received %s' % ((id_from, id_to, msg),))
-		return [id_to,id_from,msg]
 
 	def _ev_puller_handler(self, fd, _ev):
-		msg = fd.recv_multipart()
+		msg = fd.recv_multipart(copy=False)
 		#print("ev_puller")
 		#print('Event puller received %s' % (msg,))
-		self.publisher.send_multipart(msg)
-		id_from, key_event, msg = msg
-		self.ev_publisher.send_multipart([key_event, id_from, msg])
+		if self.mirror.active:
+			self.mirror.send(msg)
+		self.events.publish_batch(msg[0], msg[1:])
+
+	def _control_command(self, cmd):
+		if cmd == b"EV_STATS":
+			return json.dumps(self.events.stats()).encode()
+		return None
 	
 	def _process_poll_items(self, items):
 		"""
 		On surcharge cette fonction pour pouvoir recuperer les events
 		sur ev_puller et les renvoyer sur ev_publisher.
 		"""
+		super(Server, self)._process_poll_items(items)
+		# abonnements d'abord, pour ne pas jeter les events d'un nouvel abonné
+		if self.ev_publisher in items:
+			self.events.process_subscriptions()
 		ev_puller = self.ev_puller
 		if ev_puller in items:
 			self._ev_puller_handler(ev_puller, items[ev_puller])
@@ -94,3 +530,267 @@ class Server(Proxy):
 	def __repr__(self):
 		return "Server(%s,%s,%s)"%(self._ft_addr, self._bc_addr, self._pb_addr)
 
+
+def _run_shard(identity, ft_addr, bc_addr, pb_addr, ctrl_addr, e_stop, mirror_config):
+	""" Point d'entrée d'un shard de :class:`ShardedServer` lancé dans un processus. """
+	router = Router(identity, ft_conn_addr=ft_addr, ft_type=zmq.DEALER,
+		bc_conn_addr=bc_addr, bc_type=zmq.DEALER, pb_conn_addr=pb_addr, ctrl_bind_addr=ctrl_addr)
+	router.set_mirror(*mirror_config)
+	router.start(False)
+	e_stop.wait()
+	router.stop()
+
+
+class ShardedServer(Base):
+	"""
+	Même rôle et mêmes adresses que :class:`Server`, mais le routage est
+	réparti entre *n_shards* :class:`Router`.
+
+	Les sockets publiques (ROUTER frontend et backend, publisher XPUB) sont
+	tenues par des devices :func:`zmq.proxy_steerable` qui tournent sans le
+	GIL et les relient à des sockets DEALER internes. Chaque shard est
+	connecté à ces DEALER et reçoit les messages à tour de rôle. Les shards
+	n'ont pas d'état : ils échangent seulement les deux frames d'identité,
+	et c'est toujours la socket ROUTER publique qui fait le routage. Un
+	message peut donc passer par n'importe quel shard. La recopie des
+	messages sur le publisher passe par un device XSUB/XPUB.
+
+	Les messages d'un même client peuvent être traités par des shards
+	différents et arriver dans le désordre, les réponses sont associées aux
+	requêtes par leur uid.
+
+	*n_shards* nombre de shards
+
+	*processes* si True les shards sont des processus reliés par ``ipc://``,
+	sinon des threads reliés par ``inproc://`` (le routage python reste alors
+	limité par le GIL, seules les entrées/sorties sont parallèles)
+
+	La recopie des messages se configure avec :meth:`set_mirror`, les shards
+	lancés dans des processus ne prennent en compte que la configuration
+	faite avant :meth:`start`.
+
+	*ctrl_bind_addr* adresse de la socket de contrôle, mêmes commandes que
+	:meth:`Router._control_handler`. PAUSE et RESUME sont transmis à chaque
+	shard (le PAUSE de :func:`zmq.proxy_steerable` n'arrête pas le transfert
+	avec libzmq 4.3), les messages attendent alors dans les files entre les
+	devices et les shards.
+
+	*ev_cache* et la commande EV_STATS : voir :class:`Server`, les events
+	sont traités par la boucle du serveur et non par les shards.
+	"""
+	# temps maximum d'attente de la réponse d'un shard à une commande (ms)
+	CTRL_TIMEOUT = 1000
+
+	def __init__(self, ft_bind_addr="tcp://*:5000", bc_bind_addr="tcp://*:5001",
+			pb_bind_addr="tcp://*:5002", ev_pl_bind_addr="tcp://*:5003", ev_pb_bind_addr="tcp://*:5004",
+			ctx=None, identity="Server", *, n_shards=4, processes=False, ctrl_bind_addr=None,
+			ev_cache=None):
+		super(ShardedServer, self).__init__(ctx)
+		self._e_stop = threading.Event()
+		self.identity = identity
+		self.n_shards = n_shards
+		self.processes = processes
+		self._ft_addr = ft_bind_addr
+		self._bc_addr = bc_bind_addr
+		self._pb_addr = pb_bind_addr
+		self._ev_pl_addr = ev_pl_bind_addr
+		self._ev_pb_addr = ev_pb_bind_addr
+		self._ctrl_addr = ctrl_bind_addr
+		# adresses internes entre les devices et les shards
+		if processes:
+			prefix = "ipc://%s/zerobot-%s-%s" % (tempfile.gettempdir(), identity, os.getpid())
+		else:
+			prefix = "inproc://%s-%s" % (identity, id(self))
+		self._shards_ft_addr = prefix + "-ft"
+		self._shards_bc_addr = prefix + "-bc"
+		self._shards_pb_addr = prefix + "-pb"
+		self._shards_ctrl_addr = prefix + "-shard-ctrl-%s"
+		# sockets publiques
+		self.frontend = self._socket(zmq.ROUTER, ft_bind_addr)
+		self.backend = self._socket(zmq.ROUTER, bc_bind_addr)
+		self.publisher = self._socket(zmq.XPUB, pb_bind_addr)
+		self.ev_puller = self._socket(zmq.ROUTER, ev_pl_bind_addr)
+		self.ev_publisher = self._socket(zmq.XPUB, ev_pb_bind_addr)
+		self.events = EventPublisher(self.ev_publisher, ev_cache)
+		# sockets internes
+		self._shards_ft = self._socket(zmq.DEALER, self._shards_ft_addr)
+		self._shards_bc = self._socket(zmq.DEALER, self._shards_bc_addr)
+		self._shards_pb = self._socket(zmq.XSUB, self._shards_pb_addr)
+		self.control = self._socket(zmq.REP, ctrl_bind_addr) if ctrl_bind_addr else None
+		self._ev_mirror = self.ctx.socket(zmq.XPUB)
+		self._ev_mirror.connect(self._shards_pb_addr)
+		self._to_close.append(self._ev_mirror)
+		self.mirror = Mirror(self._ev_mirror)
+		self._mirror_config = (True, 1, None)
+		self._devices = [
+			(self.frontend, self._shards_ft),
+			(self.backend, self._shards_bc),
+			(self.publisher, self._shards_pb),
+		]
+		self._device_threads = []
+		self._device_ctrls = []
+		self._shards = []
+		self._shard_ctrls = []
+		self._e_stop_shards = None
+		self._started = False
+
+	def set_mirror(self, enabled=True, sample=1, identities=None):
+		""" Configure la recopie des messages, voir :meth:`Mirror.configure`. """
+		self._mirror_config = (enabled, sample, identities)
+		self.mirror.configure(enabled, sample, identities)
+		if not self.processes:
+			for router in self._shards:
+				router.set_mirror(enabled, sample, identities)
+
+	def _socket(self, t, bind_addr):
+		socket = self.ctx.socket(t)
+		socket.setsockopt(zmq.IDENTITY, self.identity.encode())
+		socket.bind(bind_addr)
+		self._to_close.append(socket)
+		return socket
+
+	def _start_devices(self):
+		for i, (a, b) in enumerate(self._devices):
+			ctrl_addr = "inproc://%s-%s-ctrl-%s" % (self.identity, id(self), i)
+			ctrl = self._socket(zmq.PAIR, ctrl_addr)
+			ctrl_client = self.ctx.socket(zmq.PAIR)
+			ctrl_client.connect(ctrl_addr)
+			self._to_close.append(ctrl_client)
+			self._device_ctrls.append(ctrl_client)
+			t = threading.Thread(target=self._run_device, args=(a, b, ctrl),
+				name="Device-%s-%s" % (self.identity, i))
+			t.daemon = True
+			t.start()
+			self._device_threads.append(t)
+
+	def _run_device(self, a, b, ctrl):
+		try:
+			zmq.proxy_steerable(a, b, None, ctrl)
+		except zmq.ZMQError as ex:
+			if not self._e_stop.is_set():
+				self.logger.error("device error : %s", ex)
+
+	def _start_shards(self):
+		if self.processes:
+			mp = multiprocessing.get_context("spawn")
+			self._e_stop_shards = mp.Event()
+			for i in range(self.n_shards):
+				p = mp.Process(target=_run_shard, args=("%s-shard-%s" % (self.identity, i),
+					self._shards_ft_addr, self._shards_bc_addr, self._shards_pb_addr,
+					self._shards_ctrl_addr % i, self._e_stop_shards, self._mirror_config))
+				p.daemon = True
+				p.start()
+				self._shards.append(p)
+		else:
+			for i in range(self.n_shards):
+				router = Router("%s-shard-%s" % (self.identity, i), ctx=self.ctx,
+					ft_conn_addr=self._shards_ft_addr, ft_type=zmq.DEALER,
+					bc_conn_addr=self._shards_bc_addr, bc_type=zmq.DEALER,
+					pb_conn_addr=self._shards_pb_addr, ctrl_bind_addr=self._shards_ctrl_addr % i)
+				router.set_mirror(*self._mirror_config)
+				router.start(False)
+				self._shards.append(router)
+		for i in range(self.n_shards):
+			ctrl = self.ctx.socket(zmq.REQ)
+			ctrl.setsockopt(zmq.REQ_RELAXED, 1)
+			ctrl.setsockopt(zmq.REQ_CORRELATE, 1)
+			ctrl.connect(self._shards_ctrl_addr % i)
+			self._to_close.append(ctrl)
+			self._shard_ctrls.append(ctrl)
+
+	def start(self, block=True):
+		if not self._started:
+			self._started = True
+			self.logger.info("Server start, %s %s shards", self.n_shards,
+				"process" if self.processes else "thread")
+			self.logger.info("Listening\t%s", self._ft_addr)
+			self.logger.info("Backend\t%s", self._bc_addr)
+			self.logger.info("Publishing\t%s", self._pb_addr)
+			self.logger.info("Event puller\t%s", self._ev_pl_addr)
+			self.logger.info("Event publisher\t%s", self._ev_pb_addr)
+			if self._ctrl_addr:
+				self.logger.info("Control\t%s", self._ctrl_addr)
+			self._start_shards()
+			self._start_devices()
+		if not block:
+			t = threading.Thread(target=self._loop, name="Thread-%s" % self)
+			t.daemon = True
+			t.start()
+		else:
+			self._loop()
+
+	def _loop(self):
+		# seuls les events sont traités par la boucle python du serveur
+		poller = zmq.Poller()
+		poller.register(self.ev_puller, zmq.POLLIN)
+		poller.register(self._ev_mirror, zmq.POLLIN)
+		poller.register(self.ev_publisher, zmq.POLLIN)
+		if self.control is not None:
+			poller.register(self.control, zmq.POLLIN)
+		while not self._e_stop.is_set():
+			try:
+				items = dict(poller.poll(500))
+			except:
+				break # Interrupted
+			if self._ev_mirror in items:
+				self.mirror.process_subscriptions()
+			if self.ev_publisher in items:
+				self.events.process_subscriptions()
+			if self.ev_puller in items:
+				self._ev_puller_handler(self.ev_puller, items[self.ev_puller])
+			if self.control is not None and self.control in items:
+				self._control_handler(self.control, items[self.control])
+
+	def _control_handler(self, fd, _ev):
+		cmd = fd.recv()
+		self.logger.info("control command %s", cmd)
+		if cmd in (b"PAUSE", b"RESUME"):
+			for ctrl in self._shard_ctrls:
+				ctrl.send(cmd)
+			ok = True
+			for i, ctrl in enumerate(self._shard_ctrls):
+				if not ctrl.poll(self.CTRL_TIMEOUT) or ctrl.recv() != b"OK":
+					self.logger.error("shard %s did not execute %s", i, cmd)
+					ok = False
+			fd.send(b"OK" if ok else b"ERROR")
+		elif cmd == b"TERMINATE":
+			fd.send(b"OK")
+			self.stop()
+		elif cmd == b"EV_STATS":
+			fd.send(json.dumps(self.events.stats()).encode())
+		else:
+			fd.send(b"ERROR")
+
+	def _ev_puller_handler(self, fd, _ev):
+		msg = fd.recv_multipart(copy=False)
+		if self.mirror.active:
+			self.mirror.send(msg)
+		self.events.publish_batch(msg[0], msg[1:])
+
+	def stop(self):
+		if self._e_stop.is_set():
+			return
+		self.logger.info("stop event received")
+		self._e_stop.set()
+		if self.processes:
+			if self._e_stop_shards is not None:
+				self._e_stop_shards.set()
+			for p in self._shards:
+				p.join(1)
+		else:
+			for router in self._shards:
+				router.stop()
+		for ctrl in self._device_ctrls:
+			ctrl.send(b"TERMINATE")
+		for t in self._device_threads:
+			t.join(1)
+
+	def close(self):
+		self.stop()
+		if not self.processes:
+			for router in self._shards:
+				router.close()
+		super(ShardedServer, self).close()
+
+	def __repr__(self):
+		return "ShardedServer(%s,%s,%s)"%(self._ft_addr, self._bc_addr, self._pb_addr)
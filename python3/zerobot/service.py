@@ -2,11 +2,266 @@
 from .core import *
 from .proxy import Proxy
 
+import os
+import math
 import queue
+import tempfile
 import traceback
+import multiprocessing
+import concurrent.futures
+import collections
+import collections.abc
 import inspect
 import types
 
+def cached(ttl=None, maxsize=128):
+	"""
+	Décorateur marquant une méthode exposée comme pure : les services gardent
+	ses résultats dans un :class:`zerobot.core.ResultCache` (LRU de *maxsize*
+	résultats, chacun valable *ttl* secondes, sans limite si None) indexé par
+	les arguments de l'appel. La méthode est annoncée comme cacheable par
+	help, un :class:`zerobot.client.AsyncClient` créé avec cache=True garde
+	alors lui aussi ses résultats::
+
+		class Map:
+			@zerobot.cached(ttl=60)
+			def lookup(self, name):
+				...
+
+	Les appels locaux de la méthode ne passent pas par le cache.
+	"""
+	def decorator(f):
+		f.zerobot_cached = {'ttl': ttl, 'maxsize': maxsize}
+		return f
+	return decorator
+
+
+class Method:
+	"""
+	Méthode exposée, résolue une fois par :class:`DispatchTable`. Les
+	paramètres de sa signature sont relevés pour vérifier les arguments
+	d'un appel avant de l'exécuter.
+	"""
+	MAX_SHAPES = 64
+
+	def __init__(self, name, f, cache=None):
+		self.name = name
+		self.f = f
+		self.cache = cache
+		self.is_coroutine = inspect.iscoroutinefunction(f)
+		self.is_async_gen = inspect.isasyncgenfunction(f)
+		self.is_generator = inspect.isgeneratorfunction(f)
+		self.doc = (inspect.getdoc(f) or 'No documentation available').strip()
+		try:
+			self.signature = inspect.signature(f)
+		except (TypeError, ValueError):
+			# certaines fonctions built-in n'ont pas de signature, pas de vérification
+			self.signature = None
+			self.check = lambda args, kwargs: None
+			return
+		kind = inspect.Parameter
+		params = list(self.signature.parameters.values())
+		positional = [ p.name for p in params if p.kind in (kind.POSITIONAL_ONLY, kind.POSITIONAL_OR_KEYWORD) ]
+		required = [ p.name for p in params if p.default is p.empty
+			and p.kind not in (kind.VAR_POSITIONAL, kind.VAR_KEYWORD) ]
+		self._keywords = frozenset( p.name for p in params if p.kind in (kind.POSITIONAL_OR_KEYWORD, kind.KEYWORD_ONLY) )
+		self._var_keyword = any( p.kind == kind.VAR_KEYWORD for p in params )
+		self._max_args = len(positional)
+		if any( p.kind == kind.VAR_POSITIONAL for p in params ):
+			self._max_args = float('inf')
+		# pour n arguments positionnels : les paramètres déjà fournis et ceux
+		# qui doivent l'être par kwargs
+		# (les paramètres positional-only ne peuvent pas être passés par nom)
+		positional_only = frozenset( p.name for p in params if p.kind == kind.POSITIONAL_ONLY )
+		self._given = [ frozenset(positional[:n])-positional_only for n in range(len(positional)+1) ]
+		self._missing = [ frozenset(required)-frozenset(positional[:n]) for n in range(len(positional)+1) ]
+		self._missing_positional = [ missing & positional_only for missing in self._missing ]
+		# formes d'appel (nombre d'arguments, noms des kwargs) déjà vérifiées
+		self._valid = set()
+		# appel sans kwargs : seul le nombre d'arguments est à vérifier
+		self._min_args = len(positional)+1
+		for n, missing in enumerate(self._missing):
+			if not missing:
+				self._min_args = n
+				break
+
+	def check(self, args, kwargs):
+		""" Lève une exception si *args* et *kwargs* ne correspondent pas à la signature. """
+		n = len(args)
+		if not kwargs:
+			if self._min_args <= n <= self._max_args:
+				return
+		elif (n, *kwargs) in self._valid:
+			return
+		if n > self._max_args:
+			raise Exception("%s%s takes %s positional arguments but %s were given"
+				% (self.name, self.signature, self._max_args, n))
+		shape = (n, *kwargs)
+		n = min(n, len(self._given)-1)
+		if not self._var_keyword and not self._keywords.issuperset(kwargs):
+			raise Exception("%s%s got unexpected keyword arguments %s"
+				% (self.name, self.signature, sorted(set(kwargs)-self._keywords)))
+		if not self._given[n].isdisjoint(kwargs):
+			raise Exception("%s%s got multiple values for arguments %s"
+				% (self.name, self.signature, sorted(self._given[n].intersection(kwargs))))
+		if self._missing_positional[n] or not self._missing[n].issubset(kwargs):
+			raise Exception("%s%s missing required arguments %s"
+				% (self.name, self.signature, sorted(self._missing[n]-(self._keywords & kwargs.keys()))))
+		if len(self._valid) < self.MAX_SHAPES:
+			self._valid.add(shape)
+
+	def invoke(self, args, kwargs):
+		""" Appelle la méthode, un générateur est renvoyé sous forme de liste. """
+		r = self.f(*args, **kwargs)
+		if isinstance(r, types.GeneratorType):
+			return list(r)
+		return r
+
+	def call(self, args, kwargs):
+		""" Comme :meth:`invoke`, en passant par le cache de la méthode s'il y en a un. """
+		if self.cache is None:
+			return self.invoke(args, kwargs)
+		key = self.cache.key(args, kwargs)
+		if key is None:
+			return self.invoke(args, kwargs)
+		r = self.cache.get(key)
+		if r is ResultCache.MISSING:
+			r = self.invoke(args, kwargs)
+			self.cache.put(key, r)
+		return r
+
+	def describe(self):
+		""" Description de la méthode renvoyée par help. """
+		if self.signature is None:
+			signature, args = '(...)', None
+		else:
+			signature, args = str(self.signature), []
+			for p in self.signature.parameters.values():
+				arg = {'name': p.name, 'kind': p.kind.name}
+				if p.default is not p.empty:
+					arg['default'] = repr(p.default)
+				args.append(arg)
+		return {
+			'name': self.name,
+			'signature': signature,
+			'args': args,
+			'coroutine': self.is_coroutine,
+			'stream': self.is_generator or self.is_async_gen,
+			'cached': { 'ttl': self.cache.ttl, 'maxsize': self.cache.maxsize } if self.cache else None,
+			'doc': self.doc,
+		}
+
+
+class DispatchTable:
+	"""
+	Méthodes publiques (ne commençant pas par ``_``) de *exposed_obj*,
+	résolues une fois pour toutes. Les *builtins* (dictionnaire nom =>
+	fonction) sont prioritaires sur les méthodes de l'objet. Si des méthodes
+	sont ajoutées ou remplacées sur l'objet, la table doit être mise à jour
+	avec :meth:`refresh`. Les properties ne sont pas exposées.
+
+	Les méthodes décorées par :func:`cached` reçoivent un
+	:class:`zerobot.core.ResultCache`, rangé par nom dans *caches* qui peut
+	être partagé entre plusieurs tables exposant le même objet.
+	"""
+	def __init__(self, exposed_obj, builtins={}, caches=None):
+		self.exposed_obj = exposed_obj
+		self.builtins = builtins
+		self.caches = caches if caches is not None else {}
+		self.refresh()
+
+	def refresh(self):
+		methods = {}
+		for name in dir(self.exposed_obj):
+			if name.startswith('_'):
+				continue
+			# pas de getattr sur les properties qui exécuterait du code
+			if isinstance(inspect.getattr_static(self.exposed_obj, name, None), property):
+				continue
+			attr = getattr(self.exposed_obj, name, None)
+			if callable(attr):
+				methods[name] = Method(name, attr, self._cache_of(name, attr))
+		for name, f in self.builtins.items():
+			methods[name] = Method(name, f)
+		self.methods = methods
+
+	def _cache_of(self, name, f):
+		config = getattr(f, 'zerobot_cached', None)
+		if config is None:
+			return None
+		cache = self.caches.get(name)
+		if cache is None or (cache.ttl, cache.maxsize) != (config['ttl'], config['maxsize']):
+			cache = self.caches[name] = ResultCache(**config)
+		return cache
+
+	def cache_stats(self):
+		""" Compteurs (voir :meth:`zerobot.core.ResultCache.stats`) des caches, par méthode. """
+		return { name: cache.stats() for name, cache in self.caches.items() }
+
+	def __getitem__(self, name):
+		""" Renvoie la :class:`Method` *name*, lève une exception si elle n'est pas exposée. """
+		method = self.methods.get(name)
+		if method is None:
+			if name.startswith('_'):
+				raise Exception("Method %s is protected" % name)
+			raise Exception("%s has no method %s" % (self.exposed_obj, name))
+		return method
+
+	def help(self, f=None):
+		"""
+		Renvoie la description (voir :meth:`Method.describe`) de toutes les
+		méthodes, indexée par nom, ou seulement celle de la méthode *f*.
+		"""
+		if f is None:
+			return { name: method.describe() for name, method in self.methods.items() }
+		return self[f].describe()
+
+
+def _stream_items(r):
+	"""
+	Itérateur sur les éléments à envoyer pour le résultat *r* d'une
+	:class:`zerobot.core.StreamRequest` : ceux de *r* s'il est itérable
+	(hors str, bytes et dict), sinon *r* seul.
+	"""
+	if isinstance(r, (str, bytes, dict)) or not isinstance(r, collections.abc.Iterable):
+		return iter([r])
+	return iter(r)
+
+
+class _Stream:
+	""" :class:`zerobot.core.StreamRequest` en cours d'envoi par un :class:`Service`. """
+	def __init__(self, remote_id, request, codec, iterator):
+		self.remote_id = remote_id
+		self.uid = request.uid
+		self.codec = codec
+		self.iterator = iterator
+		self.chunk_size = max(1, request.chunk_size)
+		self.credit = request.window
+		self.seq = 0
+		self.last_activity = time.time()
+
+	def next_chunk(self):
+		""" Renvoie le prochain :class:`zerobot.core.StreamChunk`. """
+		try:
+			items = list(itertools.islice(self.iterator, self.chunk_size))
+		except Exception as ex:
+			chunk = StreamChunk(self.uid, [], {'tb': traceback.format_exc(), 'error': str(ex)}, self.seq)
+		else:
+			# un itérateur épuisé pile à la fin d'un paquet donne un dernier paquet vide
+			chunk = StreamChunk(self.uid, items, None, self.seq, len(items) == self.chunk_size)
+		self.seq += 1
+		self.credit -= 1
+		self.last_activity = time.time()
+		return chunk
+
+	def close(self, error):
+		""" Arrête le générateur, renvoie le dernier paquet avec l'erreur *error*. """
+		close = getattr(self.iterator, 'close', None)
+		if close is not None:
+			close()
+		return StreamChunk(self.uid, [], {'tb': '', 'error': error}, self.seq)
+
+
 #signal.signal(signal.SIGINT, signal_handler)
 class Service(BaseClient):
 	"""
@@ -21,20 +276,49 @@ class Service(BaseClient):
 	*exposed_obj* une instance de l'objet à exposer
 	
 	*ctx* zmq context
+
+	*batch_executor* un :class:`concurrent.futures.Executor` utilisé pour exécuter
+	en parallèle les appels d'une :class:`zerobot.core.BatchRequest`, par défaut
+	ils sont exécutés séquentiellement
+
+	*caches* dictionnaire des caches des méthodes décorées par :func:`cached`,
+	partagé par les workers d'un :class:`AsyncService`
+
+	*stream_timeout* durée en secondes après laquelle un stream dont le client
+	n'a plus demandé de paquet est abandonné
+
+	Les méthodes exposées sont résolues à la création du service dans une
+	:class:`DispatchTable`, :meth:`refresh` la met à jour si l'objet change.
+
+	Une méthode qui renvoie un générateur est renvoyée en une seule réponse
+	(la liste de ses éléments), sauf si elle est appelée par une
+	:class:`zerobot.core.StreamRequest` (voir :class:`zerobot.client.Stream`) :
+	ses éléments sont alors envoyés par paquets, au rythme des
+	:class:`zerobot.core.StreamCredit` du client. Le générateur est exécuté
+	dans le thread du service, entre les autres requêtes.
 	
 	"""
-	def __init__(self, identity, conn_addr, exposed_obj, *args, **kwargs):
+	def __init__(self, identity, conn_addr, exposed_obj, *args, batch_executor=None, caches=None,
+			stream_timeout=60, **kwargs):
 		super(Service,self).__init__(identity, conn_addr, *args, **kwargs)
 		self.exposed_obj = exposed_obj
+		self.batch_executor = batch_executor
+		self.stream_timeout = stream_timeout
+		self._streams = {}			# (remote_id, uid) => _Stream
+		self._expiry_scheduled = False
 
 		#on ajoute une méthode send_event à l'object exposé
 		exposed_obj.send_event = types.MethodType(lambda s, k, o : self.send_event(k, o), exposed_obj)
+		self.dispatch = DispatchTable(exposed_obj, {'help': self.help, 'stop': self.stop}, caches)
 
 	def _process(self, fd, _ev):
 		"""
-		Le message reçu est en 2 parties :
+		Le message reçu est en 2 ou 3 parties :
 		1. remote_id
-		2. packed request
+		2. header (optionnel, voir :func:`zerobot.core.pack_header`)
+		3. packed request
+
+		La réponse est renvoyée avec le même codec que la requête.
 		
 		Une Request est un dictionnaire:
 		{@code
@@ -46,62 +330,291 @@ class Service(BaseClient):
 			}
 		}
 		La fonction va unpack le message et la request pour extraire la fonction à appeller.
+
+		Une :class:`zerobot.core.BatchRequest` reçoit une seule réponse contenant
+		les résultats de tous ses appels.
 		"""
-		msg = fd.recv_multipart()
-		self.logger.debug("worker %s recv %s", self.identity, msg)
-		remote_id, packed_request = msg
-		request = Request.unpack(packed_request)
+		# traite toutes les requêtes déjà arrivées, l'ioloop ne prévient
+		# qu'une fois pour plusieurs messages
+		while True:
+			try:
+				msg = recv_msg(fd, zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			self.logger.debug("worker %s recv %s", self.identity, msg)
+			remote_id = msg[0]
+			request, codec = unpack_msg(Request, msg[1:])
+			if type(request) is Request:
+				response = self._call(request)
+			elif isinstance(request, BatchRequest):
+				response = self._call_batch(request)
+			elif isinstance(request, StreamCredit):
+				self._credit_stream(remote_id, request)
+				continue
+			else:
+				self._open_stream(remote_id, request, codec)
+				continue
+			self.send_multipart([remote_id] + pack_msg(response, codec))
+
+	def _open_stream(self, remote_id, request, codec):
+		try:
+			method = self.dispatch.methods.get(request.fct) or self.dispatch[request.fct]
+			method.check(request.args, request.kwargs)
+			iterator = _stream_items(method.f(*request.args, **request.kwargs))
+		except Exception as ex:
+			err = {'tb': traceback.format_exc(), 'error': str(ex)}
+			self.send_multipart([remote_id] + pack_msg(StreamChunk(request.uid, [], err), codec))
+			return
+		key = (remote_id, request.uid)
+		self._streams[key] = _Stream(remote_id, request, codec, iterator)
+		self._send_stream(key)
+		if self._streams and not self._expiry_scheduled:
+			self._expiry_scheduled = True
+			self.ioloop.call_later(self.stream_timeout, self._expire_streams)
+
+	def _credit_stream(self, remote_id, credit):
+		key = (remote_id, credit.uid)
+		stream = self._streams.get(key)
+		if stream is None:
+			self.logger.debug("drop credit %s, no stream", credit)
+		elif credit.cancel:
+			self._close_stream(key, "cancelled")
+		else:
+			stream.credit += credit.credit
+			self._send_stream(key)
+
+	def _send_stream(self, key):
+		""" Envoie les paquets autorisés par le crédit du client. """
+		stream = self._streams[key]
+		while stream.credit > 0:
+			chunk = stream.next_chunk()
+			self.send_multipart([stream.remote_id] + pack_msg(chunk, stream.codec))
+			if not chunk.more:
+				del self._streams[key]
+				break
+
+	def _close_stream(self, key, error):
+		stream = self._streams.pop(key)
+		# le dernier paquet libère aussi le worker d'un AsyncService
+		self.send_multipart([stream.remote_id] + pack_msg(stream.close(error), stream.codec))
+
+	def _expire_streams(self):
+		""" Abandonne les streams dont le client ne demande plus de paquet. """
+		self._expiry_scheduled = False
+		limit = time.time()-self.stream_timeout
+		for key, stream in list(self._streams.items()):
+			if stream.last_activity < limit:
+				self.logger.warning("stream %s of %s expired", stream.uid, stream.remote_id)
+				self._close_stream(key, "stream timeout")
+		if self._streams:
+			self._expiry_scheduled = True
+			self.ioloop.call_later(self.stream_timeout/2, self._expire_streams)
+		# les envois hors de _process peuvent masquer des requêtes arrivées
+		self._process(self.socket, None)
+
+	def _call(self, request):
+		""" Exécute la :class:`zerobot.core.Request` et renvoie la :class:`zerobot.core.Response`. """
 		err = None
 		r = None
 		try:
-			if request.fct=='help':
-				f = self.help
-			elif request.fct=='stop':
-				f = self.stop
-			else:
-				f = getattr(self.exposed_obj, request.fct)
-				if request.fct.startswith('_'):
-					raise Exception("Method %s is protected" % request.fct)
-			args,kwargs = request.args, request.kwargs
-			if args and kwargs:
-				r = f(*args, **kwargs)
-			elif kwargs:
-				r = f(**kwargs)
-			else:
-				r = f(*args)
+			method = self.dispatch.methods.get(request.fct) or self.dispatch[request.fct]
+			method.check(request.args, request.kwargs)
+			r = method.call(request.args, request.kwargs)
 		except Exception as ex:
 			err = {}
 			err['tb'] = traceback.format_exc()
 			err['error'] = str(ex)
-		response = Response(request.uid, r, err)
-		self.send_multipart([remote_id, response.pack()])
+		return Response(request.uid, r, err)
+
+	def _call_batch(self, batch):
+		if self.batch_executor is not None:
+			responses = self.batch_executor.map(self._call, batch.requests)
+		else:
+			responses = map(self._call, batch.requests)
+		return Response(batch.uid, [ [r.data, r.error] for r in responses ])
 
 	def help(self, f=None):
 		"""
-		Renvoie l'help pour le client ou pour la fonction *f* si précisée.
+		Renvoie l'help pour le client ou pour la fonction *f* si précisée :
+		nom, signature, arguments et documentation des méthodes, voir
+		:meth:`DispatchTable.help`.
 		"""
-		if not f:
-			# aide globale
-			return dir(self.exposed_obj)
-		else:
-			if hasattr(self.exposed_obj, f):
-				doc = getattr(self.exposed_obj,f).__doc__
-				if not doc:
-					doc = 'No documentation available'
-				return doc
-			else:
-				return str(self.exposed_obj)+' has no method '+f
+		return self.dispatch.help(f)
+
+	def refresh(self):
+		""" Met à jour la table des méthodes exposées. """
+		self.dispatch.refresh()
+
+	def cache_stats(self):
+		""" Compteurs hits/misses des méthodes décorées par :func:`cached`. """
+		return self.dispatch.cache_stats()
 	
 	def __repr__(self):
 		return "ServiceWorker(%s,%s,%s,..)" % (self.identity, self.conn_addr, self.exposed_obj)
 		
 
+class Autoscaler:
+	"""
+	Choisit le nombre de workers d'un :class:`AsyncService` lorsque
+	*dynamic_workers* vaut True.
+
+	À chaque échantillon (au plus un toutes les *interval* secondes) les
+	moyennes mobiles exponentielles de la profondeur de la file, de
+	l'utilisation des workers, du temps d'exécution et du débit des
+	requêtes sont mises à jour. La charge estimée est le maximum entre le
+	nombre de requêtes en cours ou en attente et débit * temps d'exécution,
+	le nombre de workers voulu est la charge divisée par
+	*target_utilisation*.
+
+	Les ajouts se font par paliers de *up_step* workers au plus, espacés
+	d'au moins *up_cooldown* secondes. Les retraits se font par paliers de
+	*down_step* workers quand la charge est restée basse pendant
+	*down_cooldown* secondes, ce qui garde les workers entre deux pics.
+
+	Les décisions sont loggées et gardées dans *decisions*, voir
+	:meth:`metrics`. Pour une autre politique il suffit de surcharger
+	:meth:`_decide`.
+
+	*alpha* poids du dernier échantillon dans les moyennes mobiles
+
+	*history* nombre de décisions gardées
+	"""
+	def __init__(self, *, interval=0.05, alpha=0.3, target_utilisation=0.75,
+			up_step=16, down_step=2, up_cooldown=0.1, down_cooldown=30, history=100):
+		self.logger = logging.getLogger(__name__+'.'+self.__class__.__name__)
+		self.interval = interval
+		self.alpha = alpha
+		self.target_utilisation = target_utilisation
+		self.up_step = up_step
+		self.down_step = down_step
+		self.up_cooldown = up_cooldown
+		self.down_cooldown = down_cooldown
+		# moyennes mobiles
+		self.queue_depth = None
+		self.utilisation = None
+		self.service_time = None
+		self.arrival_rate = None
+		self.demand = None
+		# décisions
+		self.decisions = collections.deque(maxlen=history)
+		self.n_samples = 0
+		self.n_grows = 0
+		self.n_shrinks = 0
+		self._last_sample = None
+		self._last_received = 0
+		self._last_up = float('-inf')
+		self._last_down = float('-inf')
+		self._last_high = float('-inf')
+
+	def _ewma(self, average, value):
+		if average is None:
+			return value
+		return average + self.alpha*(value-average)
+
+	def request_done(self, duration):
+		""" Appelée par le service à la fin de chaque requête. """
+		self.service_time = self._ewma(self.service_time, duration)
+
+	def update(self, now, n_workers, n_busy, n_queued, n_received, min_workers, max_workers):
+		"""
+		Prend un échantillon de l'état du service et renvoie le nombre de
+		workers voulu.
+
+		@param {float} now temps courant en secondes
+		@param {int} n_workers nombre de workers
+		@param {int} n_busy nombre de workers occupés
+		@param {int} n_queued nombre de requêtes en attente d'un worker
+		@param {int} n_received nombre de requêtes reçues depuis le démarrage
+		"""
+		if self._last_sample is not None and now-self._last_sample < self.interval:
+			return n_workers
+		if self._last_sample is not None:
+			rate = (n_received-self._last_received)/(now-self._last_sample)
+			self.arrival_rate = self._ewma(self.arrival_rate, rate)
+		self._last_sample = now
+		self._last_received = n_received
+		self.n_samples += 1
+		self.queue_depth = self._ewma(self.queue_depth, n_queued)
+		self.utilisation = self._ewma(self.utilisation, n_busy/n_workers if n_workers else 1)
+		self.demand = self._ewma(self.demand, n_busy+n_queued)
+		target = self._decide(now, n_workers, n_busy, n_queued, min_workers, max_workers)
+		target = max(min_workers, min(max_workers, target))
+		if target != n_workers:
+			if target > n_workers:
+				self._last_up = now
+				self.n_grows += 1
+			else:
+				self._last_down = now
+				self.n_shrinks += 1
+			self.decisions.append((now, n_workers, target))
+			self.logger.info("%s -> %s workers (queue %0.1f, utilisation %0.2f, demand %0.1f)",
+				n_workers, target, self.queue_depth, self.utilisation, self.demand)
+		return target
+
+	def _decide(self, now, n_workers, n_busy, n_queued, min_workers, max_workers):
+		""" Renvoie le nombre de workers voulu, les moyennes sont à jour. """
+		load = self.demand
+		if self.arrival_rate is not None and self.service_time is not None:
+			load = max(load, self.arrival_rate*self.service_time)
+		wanted = math.ceil(load/self.target_utilisation)
+		if wanted >= n_workers:
+			self._last_high = now
+		if wanted > n_workers and now-self._last_up >= self.up_cooldown:
+			return min(wanted, n_workers+self.up_step)
+		if (wanted < n_workers and now-self._last_high >= self.down_cooldown
+				and now-self._last_down >= self.down_cooldown):
+			return max(wanted, n_workers-self.down_step)
+		return n_workers
+
+	def metrics(self):
+		""" Moyennes courantes et décisions, sous forme de dictionnaire. """
+		return {
+			'queue_depth': self.queue_depth,
+			'utilisation': self.utilisation,
+			'service_time': self.service_time,
+			'arrival_rate': self.arrival_rate,
+			'demand': self.demand,
+			'samples': self.n_samples,
+			'grows': self.n_grows,
+			'shrinks': self.n_shrinks,
+			'decisions': list(self.decisions),
+		}
+
+
+class DoublingAutoscaler(Autoscaler):
+	"""
+	Politique historique : le nombre de workers double dès qu'une requête
+	attend sans worker libre, et les workers libres sont divisés par deux
+	lorsque plus de la moitié des workers sont libres, au plus une fois
+	toutes les *down_cooldown* secondes après un changement.
+	"""
+	def __init__(self, *, interval=0, down_cooldown=10, **kwargs):
+		super(DoublingAutoscaler, self).__init__(interval=interval, down_cooldown=down_cooldown, **kwargs)
+
+	def _decide(self, now, n_workers, n_busy, n_queued, min_workers, max_workers):
+		n_free = n_workers-n_busy
+		if n_free == 0 and n_queued:
+			return 2*n_workers
+		last_change = max(self._last_up, self._last_down)
+		if n_free > n_workers//2 and now-last_change > self.down_cooldown:
+			return n_workers-n_free//2
+		return n_workers
+
+
 class AsyncService(Proxy):
 	"""
 	Permet d'exposer les méthodes d'une classe à distance. Permet en plus
 	de lancer plusieurs méthodes bloquantes de la classe simultanément.
 	Des workers sont utilisés, chaque worker exécute une requête<=>méthode de la class exposée.
 
+	Les requêtes reçues sont rangées dans une file interne bornée puis
+	confiées au worker libre depuis le plus longtemps. Avec *priorities* et
+	*concurrency_limits* les méthodes rapides ne restent pas bloquées derrière
+	des méthodes lentes::
+
+		AsyncService('cool', 'tcp://localhost:5001', Cool(),
+			priorities={'ping': 0}, concurrency_limits={'sleep': 2})
+
 	*identity* string representant le nom unique du client
 	
 	*conn_addr* l'adresse du backend du serveur
@@ -117,84 +630,296 @@ class AsyncService(Proxy):
 	*min_workers* si non précisé est égale à init_workers
 	
 	*dynamic_workers* autorisé l'ajout/suppression de workers automatiquement
+
+	*autoscaler* politique choisissant le nombre de workers quand
+	*dynamic_workers* vaut True, un :class:`Autoscaler` par défaut (voir
+	aussi :class:`DoublingAutoscaler`), le préciser active *dynamic_workers*
+
+	*batch_workers* nombre de threads exécutant en parallèle les appels d'une
+	:class:`zerobot.core.BatchRequest` (0 pour les exécuter séquentiellement)
+
+	*max_queue* nombre maximum de requêtes en attente d'un worker, au delà le
+	frontend n'est plus lu et les requêtes attendent dans les files de zmq
+
+	*priorities* dictionnaire méthode => priorité, les requêtes de plus petite
+	priorité sont exécutées en premier (*DEFAULT_PRIORITY* par défaut)
+
+	*concurrency_limits* dictionnaire méthode => nombre maximum d'exécutions
+	simultanées de la méthode
+
+	Sans *priorities* ni *concurrency_limits* les requêtes ne sont pas décodées
+	et sont exécutées dans leur ordre d'arrivée.
+
+	Les workers partagent les caches des méthodes décorées par :func:`cached`,
+	voir :meth:`cache_stats`.
+
+	Un worker qui envoie un stream (voir :class:`Service`) reste occupé
+	jusqu'à son dernier paquet, les :class:`zerobot.core.StreamCredit` du
+	client lui sont transmis directement sans passer par la file.
 	"""
+	DEFAULT_PRIORITY = 10
+
 	def __init__(self, identity, conn_addr, exposed_obj, *, ctx=None,
-			init_workers=5, max_workers=50, min_workers=None, dynamic_workers=False):
+			init_workers=5, max_workers=50, min_workers=None, dynamic_workers=False,
+			batch_workers=10, max_queue=1000, priorities=None, concurrency_limits=None,
+			autoscaler=None):
 		# sauvegarde des adresses
 		super(AsyncService, self).__init__(
 			identity, ctx=ctx,
 			ft_conn_addr=conn_addr,
 			ft_type=zmq.DEALER,
-			bc_bind_addr="inproc://workers-%s"%identity,
-			bc_type=zmq.ROUTER
+			bc_bind_addr=self._workers_addr(identity),
+			bc_type=zmq.ROUTER,
+			copy=False
 		)
 		#
 		self.exposed_obj = exposed_obj
 		self.min_workers = min_workers or init_workers
 		self.max_workers = max_workers
-		self.dynamic_workers = dynamic_workers
+		self.dynamic_workers = dynamic_workers or autoscaler is not None
+		if batch_workers:
+			self._batch_executor = concurrent.futures.ThreadPoolExecutor(batch_workers)
+		else:
+			self._batch_executor = None
+		# ordonnancement
+		self.max_queue = max_queue
+		self.priorities = priorities or {}
+		self.concurrency_limits = concurrency_limits or {}
+		self._queues = {}			# priorité => {méthode => deque non vide de (seq, msg)}
+		self._n_queued = 0
+		self._seq = 0
+		self._running = defaultdict(int)	# méthode => nombre d'exécutions en cours (> 0)
+		self._worker_fct = {}		# worker_id => méthode en cours
+		self._started_at = {}		# worker_id => début de la requête en cours
+		self._stream_workers = {}	# (remote_id, uid) => worker_id du stream
+		self._worker_stream = {}	# worker_id => (remote_id, uid)
+		self._n_received = 0
+		# autoscaling
+		self.autoscaler = autoscaler or Autoscaler()
+		self._frontend_paused = False
+		self.caches = {}
 		# workers
 		self._workers = {}
-		self._free_workers = []
+		self._free_workers = collections.deque()
+		self._retiring = []			# threads qui ferment les workers retirés
 		for _ in range(init_workers):
 			self.add_worker()
-		self._timeout_can_reduce_workers = 0
 
 	def _frontend_handler(self, fd, ev):
-		# poll on frontend only if workers are available
-		if len(self._free_workers) > 0:
-			super(AsyncService, self)._frontend_handler(fd, ev)
-			if self.dynamic_workers and len(self._free_workers) > 0:
-				self.ungrow()
-		elif self.dynamic_workers:
-			self.grow()
-	
-	def grow(self):
-		"""
-		Si le client est en galere, des workers seront ajoutés, sinon
-		ne fait rien.
+		# lit tout ce qui est arrivé, dans la limite de la file
+		while self._n_queued < self.max_queue:
+			try:
+				msg = fd.recv_multipart(zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				break
+			self.logger.debug("frontend recv %s", msg)
+			if self._flags_of(msg) & FLAG_CREDIT:
+				self._route_credit(msg)
+				continue
+			self._enqueue(msg)
+		self._dispatch()
+		if self._n_queued >= self.max_queue and not self._frontend_paused:
+			# la file est pleine, on arrête de lire le frontend jusqu'à ce qu'elle se vide
+			self._frontend_paused = True
+			self._poller.unregister(self.frontend)
 
-		Fonction appellée en interne lorsque *dynamic_workers* veut True.
+	def _backend_handler(self, fd, ev):
+		super(AsyncService, self)._backend_handler(fd, ev)
+		self._dispatch()
+		if self._frontend_paused and self._n_queued < self.max_queue:
+			self._frontend_paused = False
+			self._poller.register(self.frontend, zmq.POLLIN)
+
+	def _flags_of(self, msg):
+		""" Flags du header de *msg* (remote_id, header, corps...), 0 à l'ancien format. """
+		if len(msg) < 3:
+			return 0
+		try:
+			return unpack_header(msg[1].bytes)[1]
+		except ZeroBotProtocolError:
+			return 0
+
+	def _stream_key(self, msg):
+		request, _codec = unpack_msg(Request, [ frame.bytes for frame in msg[1:] ])
+		return (msg[0].bytes, request.uid)
+
+	def _route_credit(self, msg):
+		""" Transmet un :class:`zerobot.core.StreamCredit` au worker qui envoie le stream. """
+		key = self._stream_key(msg)
+		worker_id = self._stream_workers.get(key)
+		if worker_id is None:
+			self.logger.debug("drop credit for %s, no stream", key)
+		else:
+			self.backend.send_multipart([worker_id.encode()]+msg, copy=False)
+
+	def _method_of(self, msg):
+		""" Nom de la méthode appelée par *msg*, None si inutile ou illisible. """
+		if not (self.priorities or self.concurrency_limits):
+			return None
+		try:
+			request, _codec = unpack_msg(Request, [ frame.bytes for frame in msg[1:] ])
+		except Exception:
+			return None
+		return getattr(request, 'fct', None)
+
+	def _enqueue(self, msg):
+		fct = self._method_of(msg)
+		prio = self.priorities.get(fct, self.DEFAULT_PRIORITY)
+		queues = self._queues.get(prio)
+		if queues is None:
+			queues = self._queues[prio] = {}
+		queue = queues.get(fct)
+		if queue is None:
+			queue = queues[fct] = collections.deque()
+		self._seq += 1
+		queue.append((self._seq, msg))
+		self._n_queued += 1
+		self._n_received += 1
+
+	def _next_request(self):
 		"""
+		Retire de la file la plus ancienne requête de plus petite priorité
+		dont la méthode n'a pas atteint sa limite d'exécutions simultanées.
+		"""
+		limits = self.concurrency_limits
+		for prio in sorted(self._queues):
+			best = None
+			for fct, queue in self._queues[prio].items():
+				limit = limits.get(fct)
+				if limit is not None and self._running.get(fct, 0) >= limit:
+					continue
+				if best is None or queue[0][0] < best[1][0][0]:
+					best = (fct, queue)
+			if best is not None:
+				fct, queue = best
+				_seq, msg = queue.popleft()
+				self._n_queued -= 1
+				if not queue:
+					# seules les méthodes en attente ont une file
+					del self._queues[prio][fct]
+					if not self._queues[prio]:
+						del self._queues[prio]
+				return fct, msg
+		return None
+
+	def _dispatch(self):
+		""" Donne les requêtes en attente aux workers libres. """
+		while self._n_queued:
+			if not self._free_workers:
+				if self.dynamic_workers:
+					self._autoscale()
+					if self._free_workers:
+						continue
+				break
+			item = self._next_request()
+			if item is None:
+				break
+			fct, msg = item
+			worker_id = self._free_workers.popleft()
+			if self._flags_of(msg) & FLAG_STREAM:
+				# le worker reste occupé jusqu'au dernier paquet
+				key = self._stream_key(msg)
+				self._stream_workers[key] = worker_id
+				self._worker_stream[worker_id] = key
+			self._worker_fct[worker_id] = fct
+			self._running[fct] += 1
+			self._started_at[worker_id] = time.time()
+			self.backend.send_multipart([worker_id.encode()]+msg, copy=False)
+		if self.dynamic_workers and self._free_workers:
+			self._autoscale()
+		
+	def _autoscale(self):
+		""" Ajoute ou retire des workers selon la décision de *autoscaler*. """
 		n_workers = len(self._workers)
-		if n_workers != self.max_workers:
-			for i in range(n_workers, min(self.max_workers,2*n_workers)):
+		n_free = len(self._free_workers)
+		target = self.autoscaler.update(time.time(), n_workers, n_workers-n_free,
+			self._n_queued, self._n_received, self.min_workers, self.max_workers)
+		if target > n_workers:
+			for _ in range(target-n_workers):
 				self.add_worker()
-			self._timeout_can_reduce_workers = time.time()+10
 			self.logger.info("%s grows to %s workers", self.identity, len(self._workers))
+		elif target < n_workers and n_free:
+			# seuls les workers libres peuvent être retirés
+			self._retire_workers(min(n_workers-target, n_free))
 
-	def ungrow(self):
+	def grow(self):
 		"""
-		Si le client n'est pas très occupé, des workers seront retirés,
-		sinon ne fait rien.
-		
-		Fonction appellée en interne lorsque *dynamic_workers* veut True.
+		Double le nombre de workers, sans dépasser *max_workers*.
+
+		Avec *dynamic_workers* le nombre de workers est choisi par *autoscaler*.
 		"""
-		# retirer des workers si on en a trop
-		n_free_workers = len(self._free_workers)
 		n_workers = len(self._workers)
-		if n_workers > self.min_workers and n_free_workers > n_workers//2 and time.time()>self._timeout_can_reduce_workers:
-			max_to_remove = n_workers-self.min_workers
-			for i in range(min(max_to_remove, n_free_workers//2)):
-				worker_id = self._free_workers.pop()
-				self._workers[worker_id].stop()
-				self._workers[worker_id] = None
-				del self._workers[worker_id]
-			self.logger.info("%s ungrows %s workers", self.identity,len(self._workers))
-			self._timeout_can_reduce_workers = time.time()+10
+		for _ in range(n_workers, min(self.max_workers, 2*n_workers)):
+			self.add_worker()
+		self.logger.info("%s grows to %s workers", self.identity, len(self._workers))
+
+	def ungrow(self):
+		"""
+		Retire la moitié des workers libres, sans descendre sous *min_workers*.
+
+		Avec *dynamic_workers* le nombre de workers est choisi par *autoscaler*.
+		"""
+		n = min(len(self._workers)-self.min_workers, len(self._free_workers)//2)
+		if n > 0:
+			self._retire_workers(n)
+
+	def _retire_workers(self, n):
+		"""
+		Retire *n* workers libres : ils ne reçoivent plus de requêtes tout de
+		suite, leur fermeture (arrêt du thread ou attente du processus) se
+		fait dans un thread pour ne pas bloquer le routage.
+		"""
+		workers = [ self._workers.pop(self._free_workers.pop()) for _ in range(n) ]
+		self._retiring = [ t for t in self._retiring if t.is_alive() ]
+		t = threading.Thread(target=self._close_workers, args=(workers,),
+			name="Retire-%s"%self.identity, daemon=True)
+		t.start()
+		self._retiring.append(t)
+		self.logger.info("%s ungrows to %s workers", self.identity, len(self._workers))
+
+	def _close_workers(self, workers):
+		for worker in workers:
+			self.logger.info("close %s" % worker)
+			worker.close()
+
+	def _process_poll_items(self, items):
+		# échantillonnage régulier, même sans requête
+		if self.dynamic_workers:
+			self._autoscale()
+			# les workers ajoutés sont libres tout de suite
+			self._dispatch()
 
 	def close(self):
 		self.logger.info("close event received")
 		for worker in self._workers.values():
 			self.logger.info("close %s" % worker)
 			worker.close()
+		# les sockets des workers retirés doivent être fermées avant le contexte
+		for t in self._retiring:
+			t.join()
+		if self._batch_executor is not None:
+			self._batch_executor.shutdown(False)
 		super(AsyncService, self).close()
 		self.logger.info("closed")
 	
+	def refresh(self):
+		""" Met à jour la table des méthodes exposées de chaque worker. """
+		for worker in self._workers.values():
+			worker.refresh()
+
+	def cache_stats(self):
+		""" Compteurs hits/misses des méthodes décorées par :func:`cached`. """
+		return { name: cache.stats() for name, cache in self.caches.items() }
+
+	def _workers_addr(self, identity):
+		""" Adresse de la socket à laquelle se connectent les workers. """
+		return "inproc://workers-%s" % identity
+
 	def add_worker(self):
 		""" Ajoute un worker au client. """
 		worker_id = "Worker-%s-%s" % (self.identity, uuid.uuid1())
-		worker = Service(worker_id, self._bc_addr, self.exposed_obj, ctx=self.ctx)
+		worker = Service(worker_id, self._bc_addr, self.exposed_obj, ctx=self.ctx,
+			batch_executor=self._batch_executor, caches=self.caches)
 		# démarage en mode non bloquant pour qu'ils soient dans des threads
 		worker.start(False)
 		self._free_workers.append(worker_id)
@@ -203,15 +928,136 @@ class AsyncService(Proxy):
 	def _backend_process_msg(self, msg):
 		self.logger.debug("backend recv %s", msg)
 		worker_id, msg = msg[0], msg[1:]
-		worker_id = worker_id.decode()
+		worker_id = worker_id.bytes.decode()
+		if worker_id in self._worker_stream:
+			if self._flags_of(msg) & FLAG_MORE:
+				return msg
+			self._stream_workers.pop(self._worker_stream.pop(worker_id), None)
+		if worker_id not in self._worker_fct:
+			# pas de requête en cours : ni compteur ni worker à libérer
+			self.logger.warning("unexpected message from idle worker %s", worker_id)
+			return msg
+		fct = self._worker_fct.pop(worker_id)
+		self._running[fct] -= 1
+		if not self._running[fct]:
+			del self._running[fct]
+		started_at = self._started_at.pop(worker_id, None)
+		if started_at is not None:
+			self.autoscaler.request_done(time.time()-started_at)
 		self._free_workers.append(worker_id)
 		return msg
-			
-	def _frontend_process_msg(self, msg):
-		#print('Service %s received: %s' % (self.identity, msg))
-		self.logger.debug("frontend recv %s", msg)
-		worker_id = self._free_workers.pop()
-		return [worker_id.encode()]+msg
 
 	def __repr__(self):
 		return "AsyncService(%s,%s,%s,..)" % (self.identity, self._ft_addr, self.exposed_obj)
+
+
+WORKER_READY = b"\x00READY"
+
+def _run_worker(worker_id, bc_addr, exposed_obj, factory, e_stop):
+	""" Point d'entrée d'un worker de :class:`ProcessPoolService` lancé dans un processus. """
+	if factory is not None:
+		exposed_obj = factory()
+	worker = Service(worker_id, bc_addr, exposed_obj)
+	worker.start(False)
+	# le service n'envoie de requêtes qu'aux workers qui se sont annoncés,
+	# l'annonce part de l'ioloop une fois qu'elle surveille la socket
+	worker.ioloop.add_callback(worker.send_multipart, [WORKER_READY])
+	e_stop.wait()
+	worker.close()
+
+
+class _WorkerProcess:
+	""" Worker de :class:`ProcessPoolService`, même interface que :class:`Service`. """
+	def __init__(self, mp, worker_id, bc_addr, exposed_obj, factory):
+		self.worker_id = worker_id
+		self._e_stop = mp.Event()
+		self.process = mp.Process(target=_run_worker,
+			args=(worker_id, bc_addr, exposed_obj, factory, self._e_stop))
+		self.process.daemon = True
+
+	def start(self, block=False):
+		self.process.start()
+
+	def stop(self):
+		self._e_stop.set()
+
+	def refresh(self):
+		# le processus a sa propre copie de l'objet, sa table est construite au démarrage
+		pass
+
+	def close(self, timeout=1):
+		self.stop()
+		self.process.join(timeout)
+		if self.process.is_alive():
+			self.process.terminate()
+
+	def __repr__(self):
+		return "WorkerProcess(%s,%s)" % (self.worker_id, self.process.pid)
+
+
+class ProcessPoolService(AsyncService):
+	"""
+	Comme :class:`AsyncService` mais chaque worker est un processus relié au
+	service par ``ipc://``, les méthodes qui utilisent le CPU s'exécutent
+	donc en parallèle sans être limitées par le GIL::
+
+		ProcessPoolService('planner', 'tcp://localhost:5001', factory=Planner,
+			init_workers=4, dynamic_workers=True)
+
+	Chaque worker a sa propre instance de l'objet exposé : une copie de
+	*exposed_obj* ou le résultat de *factory()*. Les processus sont lancés
+	avec le contexte ``spawn``, *exposed_obj* ou *factory* doivent donc
+	pouvoir être pickle (par exemple une classe ou une fonction définie au
+	niveau d'un module) et le script principal doit être protégé par
+	``if __name__ == '__main__':``. L'état de l'objet n'est pas partagé entre
+	les workers, les caches des méthodes décorées par :func:`cached` non
+	plus : ils restent dans les processus et :meth:`cache_stats` est vide.
+
+	Un worker ne reçoit des requêtes qu'une fois démarré et annoncé au
+	service, avec *dynamic_workers* le service attend que les workers
+	ajoutés soient prêts avant d'en ajouter d'autres.
+
+	*factory* callable sans argument créant l'objet exposé dans chaque worker
+
+	Les autres paramètres sont ceux de :class:`AsyncService`, *batch_workers*
+	n'est pas utilisé : les appels d'une :class:`zerobot.core.BatchRequest`
+	sont exécutés séquentiellement dans le worker.
+	"""
+	def __init__(self, identity, conn_addr, exposed_obj=None, *, factory=None, **kwargs):
+		if exposed_obj is None and factory is None:
+			raise Exception("exposed_obj or factory must be precised")
+		self.factory = factory
+		self._mp = multiprocessing.get_context("spawn")
+		self._starting = set()
+		kwargs['batch_workers'] = 0
+		super(ProcessPoolService, self).__init__(identity, conn_addr, exposed_obj, **kwargs)
+
+	def _workers_addr(self, identity):
+		return "ipc://%s/zerobot-workers-%s-%s" % (tempfile.gettempdir(), identity, os.getpid())
+
+	def add_worker(self):
+		""" Lance un worker, il sera utilisé dès qu'il se sera annoncé. """
+		worker_id = "Worker-%s-%s" % (self.identity, uuid.uuid1())
+		worker = _WorkerProcess(self._mp, worker_id, self._bc_addr,
+			None if self.factory else self.exposed_obj, self.factory)
+		worker.start()
+		self._starting.add(worker_id)
+		self._workers[worker_id] = worker
+
+	def _autoscale(self):
+		# les workers ajoutés précédemment ne sont pas encore prêts
+		if not self._starting:
+			super(ProcessPoolService, self)._autoscale()
+
+	def _backend_process_msg(self, msg):
+		if len(msg) == 2 and msg[1].bytes == WORKER_READY:
+			worker_id = msg[0].bytes.decode()
+			if worker_id in self._starting:
+				self._starting.remove(worker_id)
+				self._free_workers.append(worker_id)
+				self.logger.debug("worker %s ready", worker_id)
+			return None
+		return super(ProcessPoolService, self)._backend_process_msg(msg)
+
+	def __repr__(self):
+		return "ProcessPoolService(%s,%s,%s,..)" % (self.identity, self._ft_addr, self.exposed_obj)